@@ -0,0 +1,429 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    FrozenSet,
+    Iterable,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    Type,
+)
+
+import numpy as np
+
+from . import metrics
+from .clustering import geohash_cell_indices, geohash_from_cells, interleave_cell_indices
+from .config import settings
+
+# Tag component matching any region or any origin cell.
+ANY = "*"
+
+# Invalidations remembered for ``put``; a result read before the oldest one is not stored.
+_INVALIDATION_LOG_SIZE = 1024
+
+
+def cell_precision() -> int:
+    """Geohash characters of the origin cells results are tagged with."""
+    return max(1, min(settings.analytics_cache_cell_precision, settings.geohash_precision))
+
+
+def cache_key(endpoint: str, params: Mapping[str, Any]) -> str:
+    """Normalised key of a query: unset parameters are dropped and the rest sorted and canonicalised."""
+    normalised = {}
+    for name, value in params.items():
+        if value is None:
+            continue
+        if isinstance(value, float):
+            value = round(value, 6)
+        elif isinstance(value, datetime):
+            if value.tzinfo is not None:
+                value = value.astimezone(timezone.utc).replace(tzinfo=None)
+            value = value.isoformat()
+        normalised[name] = value
+    return json.dumps([endpoint, normalised], sort_keys=True, separators=(",", ":"))
+
+
+def scope_tags(regions: Optional[Iterable[str]] = None, prefixes: Optional[Iterable[str]] = None) -> FrozenSet[str]:
+    """Tags of a result that reads trips in ``regions`` whose origin geohash starts with one of ``prefixes``.
+
+    ``None`` stands for every region or cell. Prefixes longer than ``cell_precision()`` are cut to it.
+    """
+    precision = cell_precision()
+    region_names = [ANY] if regions is None else list(regions)
+    cells = [ANY] if prefixes is None else [prefix[:precision] or ANY for prefix in prefixes]
+    return frozenset(f"{region}|{cell}" for region in region_names for cell in cells)
+
+
+def bbox_prefixes(
+    min_lat: float, min_lng: float, max_lat: float, max_lng: float, max_cells: int = 64
+) -> Optional[Set[str]]:
+    """Geohash cells covering a bounding box, at the finest precision up to ``cell_precision()`` needing at most
+    ``max_cells``; ``None`` when even single-character cells exceed it."""
+    for precision in range(cell_precision(), 0, -1):
+        lats, lngs = np.array([min_lat, max_lat]), np.array([min_lng, max_lng])
+        lat_index, lng_index = geohash_cell_indices(lats, lngs, precision)
+        rows = np.arange(lat_index[0], lat_index[1] + 1)
+        columns = np.arange(lng_index[0], lng_index[1] + 1)
+        if len(rows) * len(columns) > max_cells:
+            continue
+        grid_rows, grid_columns = np.meshgrid(rows, columns)
+        cells = interleave_cell_indices(grid_rows.reshape(-1), grid_columns.reshape(-1), precision)
+        return set(geohash_from_cells(cells, precision).tolist())
+    return None
+
+
+def touched_tags(cells: Mapping[str, Iterable[str]]) -> Set[str]:
+    """Tags whose results change when trips arrive in these origin cells, per region."""
+    tags: Set[str] = set()
+    for region, region_cells in cells.items():
+        prefixes = {ANY}
+        for cell in region_cells:
+            prefixes.update(cell[:length] for length in range(1, len(cell) + 1))
+        for name in (region, ANY):
+            tags.update(f"{name}|{prefix}" for prefix in prefixes)
+    return tags
+
+
+InvalidationCallback = Callable[[Optional[Set[str]]], None]
+
+
+class CacheBackend(ABC):
+    """Shared store behind every replica's in-process cache, e.g. Redis.
+
+    Values are encoded results; ``invalidate`` drops the entries carrying any of the tags
+    (every entry for ``None``) and tells every subscribed cache to do the same.
+    """
+
+    name = "base"
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[Tuple[bytes, FrozenSet[str]]]:
+        ...
+
+    @abstractmethod
+    def set(self, key: str, value: bytes, tags: FrozenSet[str], ttl_seconds: float) -> None:
+        ...
+
+    @abstractmethod
+    def invalidate(self, tags: Optional[Set[str]]) -> None:
+        ...
+
+    @abstractmethod
+    def subscribe(self, callback: InvalidationCallback) -> None:
+        ...
+
+
+class NoBackend(CacheBackend):
+    """Cache in-process only."""
+
+    name = "none"
+
+    def get(self, key: str) -> Optional[Tuple[bytes, FrozenSet[str]]]:
+        return None
+
+    def set(self, key: str, value: bytes, tags: FrozenSet[str], ttl_seconds: float) -> None:
+        pass
+
+    def invalidate(self, tags: Optional[Set[str]]) -> None:
+        pass
+
+    def subscribe(self, callback: InvalidationCallback) -> None:
+        pass
+
+
+class LocalCacheBackend(CacheBackend):
+    """Stand-in for a Redis-style shared cache.
+
+    Entries and tag sets live in a namespace shared by every instance in the process, and
+    invalidations are relayed to every subscriber, so several caches on one namespace
+    behave like API replicas sharing a real cache server.
+    """
+
+    name = "local"
+    _namespaces: Dict[str, "LocalCacheBackend._Namespace"] = {}
+    _namespaces_lock = threading.Lock()
+
+    class _Namespace:
+        def __init__(self) -> None:
+            self.lock = threading.Lock()
+            self.entries: Dict[str, Tuple[bytes, FrozenSet[str], float]] = {}
+            self.tagged: Dict[str, Set[str]] = {}
+            self.subscribers: List[InvalidationCallback] = []
+
+    def __init__(self, namespace: str = "analytics-cache") -> None:
+        with self._namespaces_lock:
+            self._namespace = self._namespaces.setdefault(namespace, self._Namespace())
+
+    def get(self, key: str) -> Optional[Tuple[bytes, FrozenSet[str]]]:
+        space = self._namespace
+        with space.lock:
+            entry = space.entries.get(key)
+            if entry is None:
+                return None
+            value, tags, expires_at = entry
+            if expires_at <= time.monotonic():
+                self._drop(key)
+                return None
+            return value, tags
+
+    def set(self, key: str, value: bytes, tags: FrozenSet[str], ttl_seconds: float) -> None:
+        space = self._namespace
+        with space.lock:
+            self._drop(key)
+            space.entries[key] = (bytes(value), tags, time.monotonic() + ttl_seconds)
+            for tag in tags:
+                space.tagged.setdefault(tag, set()).add(key)
+
+    def invalidate(self, tags: Optional[Set[str]]) -> None:
+        space = self._namespace
+        with space.lock:
+            if tags is None:
+                space.entries.clear()
+                space.tagged.clear()
+            else:
+                for key in {key for tag in tags for key in space.tagged.get(tag, ())}:
+                    self._drop(key)
+            subscribers = list(space.subscribers)
+        for callback in subscribers:
+            callback(None if tags is None else set(tags))
+
+    def subscribe(self, callback: InvalidationCallback) -> None:
+        with self._namespace.lock:
+            self._namespace.subscribers.append(callback)
+
+    def _drop(self, key: str) -> None:
+        space = self._namespace
+        entry = space.entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[1]:
+            keys = space.tagged.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del space.tagged[tag]
+
+
+CACHE_BACKENDS: Dict[str, Type[CacheBackend]] = {backend.name: backend for backend in (NoBackend, LocalCacheBackend)}
+
+
+def get_cache_backend(name: Optional[str] = None) -> CacheBackend:
+    name = name or settings.analytics_cache_backend
+    if name not in CACHE_BACKENDS:
+        raise ValueError(f"Unknown analytics cache backend: {name}")
+    return CACHE_BACKENDS[name]()
+
+
+class CacheStats(NamedTuple):
+    hits: int
+    misses: int
+    coalesced: int
+    entries: int
+    bytes: int
+    evictions: int
+    expirations: int
+    invalidations: int
+
+    @property
+    def hit_ratio(self) -> float:
+        lookups = self.hits + self.misses + self.coalesced
+        return (self.hits + self.coalesced) / lookups if lookups else 0.0
+
+
+class _Entry(NamedTuple):
+    value: bytes
+    tags: FrozenSet[str]
+    expires_at: float
+
+
+class ResultCache:
+    """Read-through TTL and LRU cache of encoded analytics results.
+
+    Entries are tagged with the regions and origin cells their query reads (``scope_tags``), and
+    ingestion drops only those matching the cells a committed chunk touched (``touched_tags``).
+    Concurrent misses for one key share a single computation. A result computed across an
+    invalidation of one of its tags is returned but not stored.
+    """
+
+    def __init__(self, maxsize: int, ttl_seconds: float, backend: Optional[CacheBackend] = None) -> None:
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self.backend = backend or NoBackend()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._bytes = 0
+        self._generation = 0
+        self._log: Deque[Tuple[int, Optional[Set[str]]]] = deque(maxlen=_INVALIDATION_LOG_SIZE)
+        self._pending: Dict[str, "asyncio.Future[Optional[bytes]]"] = {}
+        self._lock = threading.Lock()
+        self.backend.subscribe(self._invalidate_local)
+
+    @property
+    def enabled(self) -> bool:
+        return self.maxsize > 0 and self.ttl_seconds > 0
+
+    async def get_or_compute(
+        self, endpoint: str, key: str, tags: FrozenSet[str], compute: Callable[[], Awaitable[bytes]]
+    ) -> bytes:
+        """The cached result for ``key``, or the result of ``compute()`` (awaited once however many callers)."""
+        if not self.enabled:
+            return await compute()
+        while True:
+            value = self._lookup(key)
+            if value is not None:
+                self._count(endpoint, "hit")
+                return value
+            pending = self._pending.get(key)
+            if pending is None:
+                break
+            value = await asyncio.shield(pending)
+            if value is not None:
+                self._count(endpoint, "coalesced")
+                return value
+            # The leading request was cancelled; retry, becoming the leader if no other waiter has.
+        self._count(endpoint, "miss")
+        future: "asyncio.Future[Optional[bytes]]" = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        generation = self._generation
+        try:
+            value = await compute()
+        except asyncio.CancelledError:
+            # Only this request was cancelled, so waiters recompute instead of failing with it.
+            future.set_result(None)
+            raise
+        except BaseException as exc:
+            future.set_exception(exc)
+            # Waiters re-raise the error; nobody else needs to retrieve it.
+            future.exception()
+            raise
+        finally:
+            del self._pending[key]
+        future.set_result(value)
+        self._store(key, value, tags, generation)
+        return value
+
+    def invalidate(self, tags: Optional[Iterable[str]] = None) -> None:
+        """Drop the entries carrying any of ``tags`` (all entries for ``None``), here and in the shared backend."""
+        tags = None if tags is None else set(tags)
+        self._invalidate_local(tags)
+        self.backend.invalidate(tags)
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return CacheStats(
+                self.hits,
+                self.misses,
+                self.coalesced,
+                len(self._entries),
+                self._bytes,
+                self.evictions,
+                self.expirations,
+                self.invalidations,
+            )
+
+    def _lookup(self, key: str) -> Optional[bytes]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at <= now:
+                self._remove(key)
+                self.expirations += 1
+                metrics.CACHE_EVICTIONS.inc(reason="expired")
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry.value
+        shared = self.backend.get(key)
+        if shared is None:
+            return None
+        value, tags = shared
+        # Shared entries are re-cached locally for the rest of a local TTL.
+        self._store(key, value, tags, self._generation, share=False)
+        return value
+
+    def _store(self, key: str, value: bytes, tags: FrozenSet[str], generation: int, share: bool = True) -> None:
+        with self._lock:
+            if self._invalidated_since(generation, tags):
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = _Entry(value, tags, time.monotonic() + self.ttl_seconds)
+            self._bytes += len(value)
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+                metrics.CACHE_EVICTIONS.inc(reason="lru")
+            self._publish_size()
+        if share:
+            self.backend.set(key, value, tags, self.ttl_seconds)
+
+    def _invalidated_since(self, generation: int, tags: FrozenSet[str]) -> bool:
+        if generation == self._generation:
+            return False
+        if not self._log or self._log[0][0] > generation + 1:
+            # The log no longer reaches back to the read.
+            return True
+        return any(
+            logged > generation and (logged_tags is None or not logged_tags.isdisjoint(tags))
+            for logged, logged_tags in self._log
+        )
+
+    def _invalidate_local(self, tags: Optional[Set[str]]) -> None:
+        with self._lock:
+            self._generation += 1
+            self._log.append((self._generation, tags))
+            if tags is None:
+                dropped = list(self._entries)
+            else:
+                dropped = [key for key, entry in self._entries.items() if not entry.tags.isdisjoint(tags)]
+            for key in dropped:
+                self._remove(key)
+            self.invalidations += len(dropped)
+            if dropped:
+                metrics.CACHE_EVICTIONS.inc(len(dropped), reason="invalidated")
+            self._publish_size()
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key)
+        self._bytes -= len(entry.value)
+
+    def _publish_size(self) -> None:
+        metrics.CACHE_ENTRIES.set(len(self._entries))
+        metrics.CACHE_BYTES.set(self._bytes)
+
+    def _count(self, endpoint: str, result: str) -> None:
+        with self._lock:
+            if result == "hit":
+                self.hits += 1
+            elif result == "miss":
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        metrics.CACHE_REQUESTS.inc(endpoint=endpoint, result=result)
+
+
+analytics_cache = ResultCache(
+    settings.analytics_cache_size,
+    settings.analytics_cache_ttl_seconds,
+    get_cache_backend(),
+)
@@ -1,18 +1,38 @@
 from __future__ import annotations
 
+import math
+from abc import ABC, abstractmethod
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from typing import Tuple
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple, Type
+
+import numpy as np
 
 from .config import settings
 
+# Region, origin geohash, destination geohash and time bucket start of a trip group.
+GroupKey = Tuple[str, str, str, datetime]
+# Region, origin geohash and time bucket start: the spatial hash cell neighbouring groups are found in.
+CellKey = Tuple[str, str, datetime]
+
+METRES_PER_DEGREE = 111_320.0
+
 _BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+_BASE32_CHARS = np.array(list(_BASE32))
+_SPREAD_MASKS = (
+    (16, np.uint64(0x0000FFFF0000FFFF)),
+    (8, np.uint64(0x00FF00FF00FF00FF)),
+    (4, np.uint64(0x0F0F0F0F0F0F0F0F)),
+    (2, np.uint64(0x3333333333333333)),
+    (1, np.uint64(0x5555555555555555)),
+)
 
 
 def parse_point(point: str) -> Tuple[float, float]:
     point = point.strip()
     if not point.startswith("POINT"):
         raise ValueError(f"Unsupported point format: {point}")
-    coords = point[6:-1]
+    coords = point[5:].strip().lstrip("(").rstrip(")")
     lng_str, lat_str = coords.split()
     return float(lat_str), float(lng_str)
 
@@ -55,3 +75,402 @@ def time_bucket(dt: datetime, minutes: int | None = None) -> datetime:
     minutes = minutes or settings.time_bucket_minutes
     bucket_start = dt - timedelta(minutes=dt.minute % minutes, seconds=dt.second, microseconds=dt.microsecond)
     return bucket_start
+
+
+def _quantize(values: np.ndarray, low: float, high: float, bits: int) -> np.ndarray:
+    """Index of the ``2**bits`` equal-width cell holding each value, as bisection assigns it."""
+    cells = 1 << bits
+    width = (high - low) / cells
+    index = np.clip(np.ceil((values - low) / width) - 1, 0, cells - 1).astype(np.int64)
+    # Cell edges are exact in float64, so one step in either direction repairs
+    # rounding in the division. Values on an edge belong to the lower cell.
+    index -= (index > 0) & (low + index * width >= values)
+    index += (index < cells - 1) & (low + (index + 1) * width < values)
+    return index
+
+
+def _spread_bits(values: np.ndarray) -> np.ndarray:
+    spread = values.astype(np.uint64)
+    for shift, mask in _SPREAD_MASKS:
+        spread = (spread | (spread << np.uint64(shift))) & mask
+    return spread
+
+
+def geohash_axis_bits(precision: int) -> Tuple[int, int]:
+    """Number of latitude and longitude bits in a geohash of ``precision`` characters."""
+    bits = 5 * precision
+    return bits // 2, (bits + 1) // 2
+
+
+def geohash_cell_indices(
+    lats: np.ndarray, lngs: np.ndarray, precision: int | None = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Row (latitude) and column (longitude) index of each point's geohash cell."""
+    precision = precision or settings.geohash_precision
+    lat_bits, lng_bits = geohash_axis_bits(precision)
+    lat_index = _quantize(np.asarray(lats, dtype=np.float64), -90.0, 90.0, lat_bits)
+    lng_index = _quantize(np.asarray(lngs, dtype=np.float64), -180.0, 180.0, lng_bits)
+    return lat_index, lng_index
+
+
+def covered_cell_range(
+    min_value: float, max_value: float, low: float, high: float, bits: int
+) -> Tuple[int, int, float, float] | None:
+    """Cells whose whole extent lies inside ``[min_value, max_value]`` on one axis.
+
+    Returns the first and last covered cell index plus the outer edges of that
+    run, or ``None`` when no cell is covered. The outermost cells of the axis are
+    never reported because they also hold out-of-range values clamped into them.
+    """
+    cells = 1 << bits
+    width = (high - low) / cells
+    first = max(int(np.ceil((min_value - low) / width)), 1)
+    while first > 1 and low + (first - 1) * width >= min_value:
+        first -= 1
+    while low + first * width < min_value:
+        first += 1
+    last = min(int(np.floor((max_value - low) / width)) - 1, cells - 2)
+    while last < cells - 2 and low + (last + 2) * width <= max_value:
+        last += 1
+    while last >= first and low + (last + 1) * width > max_value:
+        last -= 1
+    if first > last:
+        return None
+    return first, last, low + first * width, low + (last + 1) * width
+
+
+def geohash_cells(lats: np.ndarray, lngs: np.ndarray, precision: int | None = None) -> np.ndarray:
+    """Encode coordinate arrays as integer geohash cells (the interleaved geohash bits)."""
+    precision = precision or settings.geohash_precision
+    lat_index, lng_index = geohash_cell_indices(lats, lngs, precision)
+    return interleave_cell_indices(lat_index, lng_index, precision)
+
+
+def interleave_cell_indices(lat_index: np.ndarray, lng_index: np.ndarray, precision: int) -> np.ndarray:
+    """Integer geohash cells from row and column indices, the inverse of ``geohash_cell_indices``."""
+    lat_index = np.asarray(lat_index, dtype=np.uint64)
+    lng_index = np.asarray(lng_index, dtype=np.uint64)
+    # Geohash bits start with longitude, so longitude takes the odd positions
+    # when the total bit count is even and the even positions otherwise.
+    if (5 * precision) % 2 == 0:
+        cells = (_spread_bits(lng_index) << np.uint64(1)) | _spread_bits(lat_index)
+    else:
+        cells = _spread_bits(lng_index) | (_spread_bits(lat_index) << np.uint64(1))
+    return cells.astype(np.int64)
+
+
+def origin_cells(lats: np.ndarray, lngs: np.ndarray) -> np.ndarray:
+    """Integer geohash cells stored in ``trips.origin_cell`` for range-scanned bounding-box queries."""
+    return geohash_cells(lats, lngs, settings.origin_cell_precision)
+
+
+def bbox_cell_ranges(
+    min_lat: float,
+    min_lng: float,
+    max_lat: float,
+    max_lng: float,
+    precision: int | None = None,
+    max_ranges: int = 32,
+) -> List[Tuple[int, int]]:
+    """Inclusive ranges of integer geohash cells that together cover a bounding box.
+
+    The box is refined one geohash bit at a time, keeping cells that lie wholly
+    inside it and splitting those crossing its edge, until splitting further would
+    exceed ``max_ranges`` cells. Adjacent cells are merged into one range. The ranges
+    are a superset of the box, so queries must still filter on exact coordinates.
+    """
+    precision = precision or settings.origin_cell_precision
+    total_bits = 5 * precision
+    # (prefix, lng index, lat index) of the cells at the current depth; geohash bits alternate lng, lat.
+    inside: List[Tuple[int, int]] = []
+    edge: List[Tuple[int, int, int]] = [(0, 0, 0)]
+    depth = 0
+    while edge and depth < total_bits:
+        lng_bits, lat_bits = (depth + 2) // 2, (depth + 1) // 2
+        split_lng = depth % 2 == 0
+        lng_width = 360.0 / (1 << lng_bits)
+        lat_width = 180.0 / (1 << lat_bits)
+        children_inside: List[Tuple[int, int]] = []
+        children_edge: List[Tuple[int, int, int]] = []
+        for prefix, lng_index, lat_index in edge:
+            for bit in (0, 1):
+                child_lng = lng_index * 2 + bit if split_lng else lng_index
+                child_lat = lat_index if split_lng else lat_index * 2 + bit
+                west, south = -180.0 + child_lng * lng_width, -90.0 + child_lat * lat_width
+                east, north = west + lng_width, south + lat_width
+                if east < min_lng or west > max_lng or north < min_lat or south > max_lat:
+                    continue
+                if west >= min_lng and east <= max_lng and south >= min_lat and north <= max_lat:
+                    children_inside.append((prefix * 2 + bit, depth + 1))
+                else:
+                    children_edge.append((prefix * 2 + bit, child_lng, child_lat))
+        if len(inside) + len(children_inside) + len(children_edge) > max_ranges and depth > 0:
+            break
+        inside.extend(children_inside)
+        edge = children_edge
+        depth += 1
+    spans = [(prefix << (total_bits - bits), ((prefix + 1) << (total_bits - bits)) - 1) for prefix, bits in inside]
+    spans.extend(
+        (prefix << (total_bits - depth), ((prefix + 1) << (total_bits - depth)) - 1) for prefix, _, _ in edge
+    )
+    return merge_cell_ranges(spans)
+
+
+def merge_cell_ranges(spans: Sequence[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """Sort inclusive cell ranges and merge those that overlap or touch."""
+    merged: List[Tuple[int, int]] = []
+    for low, high in sorted(spans):
+        if merged and low <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], high))
+        else:
+            merged.append((low, high))
+    return merged
+
+
+def geohash_from_cells(cells: np.ndarray, precision: int | None = None) -> np.ndarray:
+    precision = precision or settings.geohash_precision
+    shifts = 5 * np.arange(precision - 1, -1, -1, dtype=np.int64)
+    digits = (np.asarray(cells, dtype=np.int64)[:, None] >> shifts) & 31
+    chars = np.ascontiguousarray(_BASE32_CHARS[digits])
+    return chars.view(f"<U{precision}").reshape(-1)
+
+
+def encode_geohash_batch(lats: np.ndarray, lngs: np.ndarray, precision: int | None = None) -> np.ndarray:
+    """Vectorised ``encode_geohash`` returning an array of geohash strings."""
+    precision = precision or settings.geohash_precision
+    return geohash_from_cells(geohash_cells(lats, lngs, precision), precision)
+
+
+def to_epoch_seconds(values: Sequence[datetime]) -> np.ndarray:
+    return np.array(values, dtype="datetime64[s]").astype(np.int64)
+
+
+def from_epoch_seconds(values: np.ndarray) -> np.ndarray:
+    return np.asarray(values, dtype=np.int64).astype("datetime64[s]").astype(object)
+
+
+def week_start_batch(epoch_seconds: np.ndarray) -> np.ndarray:
+    """Start (Monday 00:00) of the ISO week holding each epoch second."""
+    days = np.asarray(epoch_seconds, dtype=np.int64) // 86400
+    # 1970-01-01 was a Thursday, three days after the start of its ISO week.
+    return (days - (days + 3) % 7) * 86400
+
+
+def from_epoch_micros(values: np.ndarray) -> np.ndarray:
+    return np.asarray(values, dtype=np.int64).astype("datetime64[us]").astype(object)
+
+
+def time_bucket_batch(epoch_seconds: np.ndarray, minutes: int | None = None) -> np.ndarray:
+    """Vectorised ``time_bucket`` over epoch seconds, returning bucket starts as epoch seconds."""
+    minutes = minutes or settings.time_bucket_minutes
+    epoch_seconds = np.asarray(epoch_seconds, dtype=np.int64)
+    hour_start = epoch_seconds - epoch_seconds % 3600
+    minute = (epoch_seconds % 3600) // 60
+    return hour_start + (minute - minute % minutes) * 60
+
+
+class Anchor(NamedTuple):
+    """The trip that founded a group; ``started_at`` is in epoch seconds."""
+
+    origin_lat: float
+    origin_lng: float
+    destination_lat: float
+    destination_lng: float
+    started_at: int
+
+
+# Returns the groups stored in the given cells, with their anchor when they have one.
+AnchorLoader = Callable[[Sequence[CellKey]], Iterable[Tuple[GroupKey, Optional[Anchor]]]]
+
+
+def distance_m(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    """Equirectangular distance in metres, accurate at the short distances trips are grouped over."""
+    x = (lng2 - lng1) * math.cos(math.radians((lat1 + lat2) / 2))
+    return math.hypot(x, lat2 - lat1) * METRES_PER_DEGREE
+
+
+class ClusteringStrategy(ABC):
+    """Decides which trip group each trip of a chunk joins.
+
+    ``assign`` receives the trips' exact group keys and coordinates (``started_at`` in
+    epoch seconds) and returns the key of the group each trip joins, plus the anchors of
+    groups the chunk founded so they can be stored with the new groups.
+    """
+
+    name = "base"
+
+    @abstractmethod
+    def assign(
+        self,
+        keys: Sequence[GroupKey],
+        origin_lats: np.ndarray,
+        origin_lngs: np.ndarray,
+        destination_lats: np.ndarray,
+        destination_lngs: np.ndarray,
+        started_at: np.ndarray,
+        load: AnchorLoader,
+    ) -> Tuple[List[GroupKey], Dict[GroupKey, Anchor]]:
+        ...
+
+
+class ExactCellStrategy(ClusteringStrategy):
+    """Trips share a group only when both endpoints share geohash cells and their time bucket matches."""
+
+    name = "exact"
+
+    def assign(self, keys, origin_lats, origin_lngs, destination_lats, destination_lngs, started_at, load):
+        return list(keys), {}
+
+
+class NeighborCellStrategy(ClusteringStrategy):
+    """Also groups trips across cell and bucket edges when they are close to a group's founding trip.
+
+    A trip joins the group of its own cell and bucket when there is one. Otherwise it joins
+    the nearest group, among those in the adjacent origin cells (the 3x3 neighbourhood)
+    and adjacent time buckets, whose anchor has both endpoints within ``distance_m`` and a
+    start within the time tolerance. Failing that, it founds a group at its own key. Only
+    cells within reach of the trip are probed, so each trip costs a few hash lookups.
+    Groups are kept in a spatial hash keyed by ``CellKey`` and loaded from the database
+    cell by cell; at most ``max_cells`` cells are kept, least recently used first out.
+    """
+
+    name = "neighbor"
+
+    def __init__(
+        self,
+        distance_m: Optional[float] = None,
+        time_tolerance_minutes: Optional[float] = None,
+        max_cells: Optional[int] = None,
+    ) -> None:
+        self.distance_m = settings.clustering_distance_m if distance_m is None else distance_m
+        minutes = time_tolerance_minutes
+        if minutes is None:
+            minutes = settings.clustering_time_tolerance_minutes
+        self.time_tolerance = int(minutes * 60)
+        self.precision = settings.geohash_precision
+        self.bucket_minutes = settings.time_bucket_minutes
+        self.max_cells = max_cells or settings.group_cache_size
+        lat_bits, _ = geohash_axis_bits(self.precision)
+        cell_height_m = 180.0 / (1 << lat_bits) * METRES_PER_DEGREE
+        if self.distance_m > cell_height_m:
+            raise ValueError(
+                f"Clustering distance {self.distance_m}m exceeds the {cell_height_m:.0f}m geohash cell height; "
+                "lower GEOHASH_PRECISION or the distance"
+            )
+        if minutes > self.bucket_minutes:
+            raise ValueError(f"Clustering time tolerance {minutes} exceeds the {self.bucket_minutes}-minute bucket")
+        self._cells: "OrderedDict[CellKey, Dict[str, Optional[Anchor]]]" = OrderedDict()
+
+    def _candidate_cells(
+        self, keys: Sequence[GroupKey], origin_lats: np.ndarray, origin_lngs: np.ndarray, started_at: np.ndarray
+    ) -> List[List[CellKey]]:
+        """Cells each trip's group may be in: those of its 3x3 neighbourhood and adjacent buckets within reach."""
+        candidates = [[(key[0], key[1], key[3])] for key in keys]
+        reach_lat = self.distance_m / METRES_PER_DEGREE
+        reach_lng = reach_lat / np.maximum(np.cos(np.radians(origin_lats)), 0.01)
+        lat_low, lng_low = geohash_cell_indices(origin_lats - reach_lat, origin_lngs - reach_lng, self.precision)
+        lat_high, lng_high = geohash_cell_indices(origin_lats + reach_lat, origin_lngs + reach_lng, self.precision)
+        buckets = np.stack(
+            [
+                time_bucket_batch(started_at - self.time_tolerance, self.bucket_minutes),
+                time_bucket_batch(started_at, self.bucket_minutes),
+                time_bucket_batch(started_at + self.time_tolerance, self.bucket_minutes),
+            ],
+            axis=1,
+        )
+        # Most trips are out of reach of every edge and only need their own cell.
+        edge = np.flatnonzero((lat_low != lat_high) | (lng_low != lng_high) | (buckets[:, 0] != buckets[:, 2]))
+        if not len(edge):
+            return candidates
+        lat_index, lng_index = geohash_cell_indices(origin_lats[edge], origin_lngs[edge], self.precision)
+        lat_low, lat_high, lng_low, lng_high = lat_low[edge], lat_high[edge], lng_low[edge], lng_high[edge]
+        columns = []
+        for lat_step in (-1, 0, 1):
+            for lng_step in (-1, 0, 1):
+                lat_cell, lng_cell = lat_index + lat_step, lng_index + lng_step
+                inside = (lat_cell >= lat_low) & (lat_cell <= lat_high) & (lng_cell >= lng_low) & (lng_cell <= lng_high)
+                hashes = np.full(len(edge), "", dtype=f"<U{self.precision}")
+                cells = interleave_cell_indices(lat_cell[inside], lng_cell[inside], self.precision)
+                hashes[inside] = geohash_from_cells(cells, self.precision)
+                columns.append(hashes)
+        unique = np.unique(buckets[edge])
+        starts = dict(zip(unique.tolist(), from_epoch_seconds(unique).tolist()))
+        rows = zip(edge.tolist(), np.stack(columns, axis=1).tolist(), buckets[edge].tolist())
+        for position, trip_hashes, trip_buckets in rows:
+            region = keys[position][0]
+            trip_starts = [starts[value] for value in dict.fromkeys(trip_buckets)]
+            candidates[position] = [(region, value, bucket) for value in trip_hashes if value for bucket in trip_starts]
+        return candidates
+
+    def _load(self, cells: Iterable[CellKey], load: AnchorLoader) -> None:
+        missing = []
+        for cell in cells:
+            if cell in self._cells:
+                self._cells.move_to_end(cell)
+            else:
+                self._cells[cell] = {}
+                missing.append(cell)
+        if missing:
+            for (region, origin_hash, destination_hash, bucket), anchor in load(missing):
+                self._cells[(region, origin_hash, bucket)][destination_hash] = anchor
+
+    def assign(self, keys, origin_lats, origin_lngs, destination_lats, destination_lngs, started_at, load):
+        started_at = np.asarray(started_at, dtype=np.int64)
+        candidates = self._candidate_cells(keys, origin_lats, origin_lngs, started_at)
+        self._load(dict.fromkeys(cell for trip_cells in candidates for cell in trip_cells), load)
+
+        assigned: List[GroupKey] = []
+        founded: Dict[GroupKey, Anchor] = {}
+        trips = zip(
+            keys,
+            candidates,
+            origin_lats.tolist(),
+            origin_lngs.tolist(),
+            destination_lats.tolist(),
+            destination_lngs.tolist(),
+            started_at.tolist(),
+        )
+        for key, trip_cells, origin_lat, origin_lng, destination_lat, destination_lng, started in trips:
+            region, origin_hash, destination_hash, bucket = key
+            own_cell = self._cells[(region, origin_hash, bucket)]
+            if destination_hash in own_cell:
+                assigned.append(key)
+                continue
+            best: Optional[GroupKey] = None
+            best_distance = math.inf
+            for cell in trip_cells:
+                for group_destination, anchor in self._cells[cell].items():
+                    if anchor is None or abs(anchor.started_at - started) > self.time_tolerance:
+                        continue
+                    origin_distance = distance_m(origin_lat, origin_lng, anchor.origin_lat, anchor.origin_lng)
+                    if origin_distance > self.distance_m:
+                        continue
+                    destination_distance = distance_m(
+                        destination_lat, destination_lng, anchor.destination_lat, anchor.destination_lng
+                    )
+                    total = origin_distance + destination_distance
+                    if destination_distance <= self.distance_m and total < best_distance:
+                        best = (cell[0], cell[1], group_destination, cell[2])
+                        best_distance = total
+            if best is None:
+                anchor = Anchor(origin_lat, origin_lng, destination_lat, destination_lng, started)
+                own_cell[destination_hash] = anchor
+                founded[key] = anchor
+                best = key
+            assigned.append(best)
+        while len(self._cells) > self.max_cells:
+            self._cells.popitem(last=False)
+        return assigned, founded
+
+
+CLUSTERING_STRATEGIES: Dict[str, Type[ClusteringStrategy]] = {
+    strategy.name: strategy for strategy in (ExactCellStrategy, NeighborCellStrategy)
+}
+
+
+def get_clustering_strategy(name: Optional[str] = None) -> ClusteringStrategy:
+    """A fresh strategy for one ingestion job; strategies keep per-job state."""
+    name = name or settings.clustering
+    if name not in CLUSTERING_STRATEGIES:
+        raise ValueError(f"Unknown clustering strategy: {name}")
+    return CLUSTERING_STRATEGIES[name]()
@@ -2,7 +2,7 @@ from __future__ import annotations
 
 from functools import lru_cache
 from pathlib import Path
-from typing import Literal, Optional
+from typing import List, Literal, Optional
 
 from pydantic import BaseSettings, validator
 
@@ -11,9 +11,51 @@ class Settings(BaseSettings):
     app_name: str = "Trip Analytics API"
     database_url: str = "sqlite+aiosqlite:///./tripdata.db"
     sync_database_url: str = "sqlite:///./tripdata.db"
+    db_pool_size: int = 5
+    db_max_overflow: int = 10
+    db_pool_pre_ping: bool = True
+    db_statement_timeout_ms: Optional[int] = None
+    sqlite_tuning: bool = True
+    sqlite_cache_size_kib: int = 64 * 1024
+    sqlite_mmap_size_bytes: int = 256 * 1024 * 1024
+    sqlite_busy_timeout_ms: int = 30_000
+    trip_partitioning: Literal["none", "native", "sharded"] = "none"
     ingestion_chunk_size: int = 1000
+    csv_parser: Literal["auto", "pandas", "python"] = "auto"
+    ingestion_read_buffer_bytes: int = 1024 * 1024
+    ingestion_workers: int = 1
+    ingestion_shard_bytes: int = 8 * 1024 * 1024
+    ingestion_queue_depth: int = 4
+    ingestion_stream_queue_size: int = 16
+    ingestion_stream_tee: bool = True
+    ingestion_bulk_load: bool = False
+    resume_jobs_on_startup: bool = True
+    ingestion_max_concurrent_jobs: int = 1
+    ingestion_max_queued_jobs: int = 100
+    ingestion_retry_after_seconds: int = 30
+    progress_broker: Literal["memory", "local"] = "memory"
+    progress_updates_per_second: float = 4.0
+    websocket_send_timeout_seconds: float = 5.0
+    websocket_buffer_size: int = 8
+    metrics_enabled: bool = True
+    analytics_cache_size: int = 256
+    analytics_cache_ttl_seconds: float = 300.0
+    analytics_cache_backend: Literal["none", "local"] = "none"
+    analytics_cache_cell_precision: int = 4
+    group_cache_size: int = 100_000
+    grouping_mode: Literal["cache", "staging"] = "cache"
+    clustering: Literal["exact", "neighbor"] = "exact"
+    clustering_distance_m: float = 150.0
+    clustering_time_tolerance_minutes: float = 10.0
+    ingestion_loader: Literal["auto", "orm", "core", "copy_csv", "copy_binary"] = "auto"
     geohash_precision: int = 5
     time_bucket_minutes: int = 60
+    rollup_geohash_precision: int = 6
+    # Trip group rollup levels are opt-in: each one is another upsert per ingested chunk.
+    group_rollup_precisions: List[int] = []
+    group_rollup_bucket_minutes: List[int] = [15, 60, 1440]
+    origin_cell_precision: int = 8
+    bbox_max_cell_ranges: int = 64
     environment: Literal["development", "production", "test"] = "development"
     data_dir: Path = Path("data")
 
@@ -21,6 +63,23 @@ class Settings(BaseSettings):
         env_file = ".env"
         env_file_encoding = "utf-8"
 
+    @validator("group_rollup_precisions")
+    def check_group_rollup_precisions(cls, value: List[int]) -> List[int]:
+        if any(not 1 <= precision <= 12 for precision in value):
+            raise ValueError("Group rollup precisions must be between 1 and 12")
+        return sorted(set(value))
+
+    @validator("group_rollup_bucket_minutes")
+    def check_group_rollup_bucket_minutes(cls, value: List[int]) -> List[int]:
+        value = sorted(set(value))
+        # Nested buckets let each level be derived from the finest one, and day-aligned
+        # buckets fall inside the ISO weeks that partitions are detached by.
+        if any(minutes < 1 for minutes in value) or any(
+            larger % smaller for smaller, larger in zip(value, value[1:] + [24 * 60])
+        ):
+            raise ValueError("Group rollup bucket minutes must each divide the next and divide a day")
+        return value
+
     @validator("data_dir", pre=True)
     def ensure_data_dir(cls, value: Optional[str]) -> Path:
         path = Path(value) if value is not None else Path("data")
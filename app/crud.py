@@ -1,64 +1,432 @@
 from __future__ import annotations
 
-from datetime import datetime
-from typing import Iterable, List, Optional, Tuple
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Mapping, NamedTuple, Optional, Sequence, Tuple
 
-from sqlalchemy import and_, func, select
-from sqlalchemy.exc import IntegrityError
+import numpy as np
+from sqlalchemy import (
+    Table,
+    and_,
+    bindparam,
+    delete,
+    func,
+    insert,
+    inspect,
+    literal,
+    not_,
+    or_,
+    select,
+    true,
+    tuple_,
+    update,
+)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Connection, Row
 from sqlalchemy.orm import Session
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.sql import FromClause
 
-from .clustering import encode_geohash, time_bucket
+from .clustering import (
+    Anchor,
+    CellKey,
+    GroupKey,
+    bbox_cell_ranges,
+    covered_cell_range,
+    encode_geohash_batch,
+    from_epoch_micros,
+    from_epoch_seconds,
+    geohash_axis_bits,
+    geohash_cell_indices,
+    geohash_cells,
+    geohash_from_cells,
+    merge_cell_ranges,
+    origin_cells,
+    time_bucket_batch,
+    to_epoch_seconds,
+    week_start_batch,
+)
 from .config import settings
-from .models import IngestionJob, Trip, TripGroup
+from .metrics import timed_query, timed_stage
+from .models import (
+    IngestionChunk,
+    IngestionJob,
+    Trip,
+    TripGroup,
+    TripGroupRollup,
+    TripWeeklyRollup,
+    group_rollup_staging,
+    trip_staging,
+)
+from .partitioning import WEEK, partition_mode, partition_table_name, shard_table, trip_source, week_start
 
+# Indexes that ``index=True`` used to create on every ``trips`` column.
+LEGACY_TRIP_INDEXES = (
+    "ix_trips_id",
+    "ix_trips_region",
+    "ix_trips_origin_lat",
+    "ix_trips_origin_lng",
+    "ix_trips_destination_lat",
+    "ix_trips_destination_lng",
+    "ix_trips_started_at",
+    "ix_trips_datasource",
+)
 
-def get_or_create_trip_group(
+# Keeps the bound parameters of a single lookup well below SQLite's limit.
+_GROUP_LOOKUP_BATCH = 500
+
+
+class TripGroupCache:
+    """Bounded LRU mapping of trip group keys to group ids."""
+
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[GroupKey, int]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: GroupKey) -> Optional[int]:
+        group_id = self._entries.get(key)
+        if group_id is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return group_id
+
+    def put(self, key: GroupKey, group_id: int) -> None:
+        self._entries[key] = group_id
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+
+def trip_group_keys(
+    regions: Sequence[str],
+    origin_lats: np.ndarray,
+    origin_lngs: np.ndarray,
+    destination_lats: np.ndarray,
+    destination_lngs: np.ndarray,
+    started_at: np.ndarray,
+) -> List[GroupKey]:
+    """Group keys for a whole chunk; ``started_at`` holds epoch seconds."""
+    origin_hashes = encode_geohash_batch(origin_lats, origin_lngs)
+    destination_hashes = encode_geohash_batch(destination_lats, destination_lngs)
+    buckets = from_epoch_seconds(time_bucket_batch(started_at, settings.time_bucket_minutes))
+    return list(zip(regions, origin_hashes.tolist(), destination_hashes.tolist(), buckets.tolist()))
+
+
+def _dialect_insert(session: Session, table: Table):
+    dialect = session.get_bind().dialect.name
+    if dialect == "postgresql":
+        return postgresql.insert(table)
+    if dialect == "sqlite":
+        return sqlite.insert(table)
+    raise ValueError(f"Unsupported dialect for upserts: {dialect}")
+
+
+def insert_ignore(session: Session, table: Table, rows: Sequence[dict]) -> None:
+    if not rows:
+        return
+    session.execute(_dialect_insert(session, table).on_conflict_do_nothing(), list(rows))
+
+
+def _lookup_trip_groups(session: Session, keys: Sequence[GroupKey]) -> Dict[GroupKey, int]:
+    found: Dict[GroupKey, int] = {}
+    key_columns = tuple_(
+        TripGroup.region,
+        TripGroup.origin_geohash,
+        TripGroup.destination_geohash,
+        TripGroup.time_bucket_start,
+    )
+    for offset in range(0, len(keys), _GROUP_LOOKUP_BATCH):
+        batch = keys[offset : offset + _GROUP_LOOKUP_BATCH]
+        query = select(
+            TripGroup.id,
+            TripGroup.region,
+            TripGroup.origin_geohash,
+            TripGroup.destination_geohash,
+            TripGroup.time_bucket_start,
+        ).where(key_columns.in_(batch))
+        for group_id, region, origin_hash, destination_hash, bucket in session.execute(query):
+            found[(region, origin_hash, destination_hash, bucket)] = group_id
+    return found
+
+
+@timed_stage("group_lookup")
+def resolve_trip_groups(
     session: Session,
-    *,
-    region: str,
-    origin_lat: float,
-    origin_lng: float,
-    destination_lat: float,
-    destination_lng: float,
-    started_at: datetime,
-) -> TripGroup:
-    bucket = time_bucket(started_at, settings.time_bucket_minutes)
-    origin_hash = encode_geohash(origin_lat, origin_lng)
-    destination_hash = encode_geohash(destination_lat, destination_lng)
-
-    query = select(TripGroup).where(
-        TripGroup.region == region,
-        TripGroup.origin_geohash == origin_hash,
-        TripGroup.destination_geohash == destination_hash,
-        TripGroup.time_bucket_start == bucket,
-    )
-    result = session.execute(query).scalar_one_or_none()
-    if result:
-        return result
-
-    group = TripGroup(
-        region=region,
-        origin_geohash=origin_hash,
-        destination_geohash=destination_hash,
-        time_bucket_start=bucket,
-        time_bucket_minutes=settings.time_bucket_minutes,
-    )
-    session.add(group)
-    try:
-        session.flush()
-    except IntegrityError:
-        session.rollback()
-        return session.execute(query).scalar_one()
-    return group
+    keys: Iterable[GroupKey],
+    cache: Optional[TripGroupCache] = None,
+) -> Dict[GroupKey, int]:
+    """Map every distinct group key to a group id, creating missing groups in bulk."""
+    resolved: Dict[GroupKey, int] = {}
+    pending: List[GroupKey] = []
+    for key in dict.fromkeys(keys):
+        group_id = cache.get(key) if cache is not None else None
+        if group_id is None:
+            pending.append(key)
+        else:
+            resolved[key] = group_id
+
+    if pending:
+        found = _lookup_trip_groups(session, pending)
+        missing = [key for key in pending if key not in found]
+        if missing:
+            insert_ignore(
+                session,
+                TripGroup.__table__,
+                [
+                    {
+                        "region": region,
+                        "origin_geohash": origin_hash,
+                        "destination_geohash": destination_hash,
+                        "time_bucket_start": bucket,
+                        "time_bucket_minutes": settings.time_bucket_minutes,
+                    }
+                    for region, origin_hash, destination_hash, bucket in missing
+                ],
+            )
+            found.update(_lookup_trip_groups(session, missing))
+        for key in pending:
+            resolved[key] = found[key]
+            if cache is not None:
+                cache.put(key, found[key])
+    return resolved
+
+
+def load_group_anchors(session: Session, cells: Sequence[CellKey]) -> List[Tuple[GroupKey, Optional[Anchor]]]:
+    """Every trip group in ``cells`` with the anchor of those the ``neighbor`` strategy founded."""
+    groups: List[Tuple[GroupKey, Optional[Anchor]]] = []
+    cell_columns = tuple_(TripGroup.region, TripGroup.origin_geohash, TripGroup.time_bucket_start)
+    for offset in range(0, len(cells), _GROUP_LOOKUP_BATCH):
+        query = select(
+            TripGroup.region,
+            TripGroup.origin_geohash,
+            TripGroup.destination_geohash,
+            TripGroup.time_bucket_start,
+            TripGroup.anchor_origin_lat,
+            TripGroup.anchor_origin_lng,
+            TripGroup.anchor_destination_lat,
+            TripGroup.anchor_destination_lng,
+            TripGroup.anchor_started_at,
+        ).where(cell_columns.in_(cells[offset : offset + _GROUP_LOOKUP_BATCH]))
+        for region, origin_hash, destination_hash, bucket, *anchor, started in session.execute(query):
+            groups.append(
+                (
+                    (region, origin_hash, destination_hash, bucket),
+                    None if started is None else Anchor(*anchor, int(to_epoch_seconds([started])[0])),
+                )
+            )
+    return groups
+
+
+def create_anchored_groups(session: Session, anchors: Mapping[GroupKey, Anchor]) -> None:
+    """Create the groups a chunk founded together with their anchors; existing groups are left alone."""
+    insert_ignore(
+        session,
+        TripGroup.__table__,
+        [
+            {
+                "region": region,
+                "origin_geohash": origin_hash,
+                "destination_geohash": destination_hash,
+                "time_bucket_start": bucket,
+                "time_bucket_minutes": settings.time_bucket_minutes,
+                "anchor_origin_lat": anchor.origin_lat,
+                "anchor_origin_lng": anchor.origin_lng,
+                "anchor_destination_lat": anchor.destination_lat,
+                "anchor_destination_lng": anchor.destination_lng,
+                "anchor_started_at": from_epoch_seconds(np.array([anchor.started_at]))[0],
+            }
+            for (region, origin_hash, destination_hash, bucket), anchor in anchors.items()
+        ],
+    )
+
+
+@timed_stage("insert")
+def insert_trips_via_staging(session: Session, rows: Sequence[dict]) -> None:
+    """Group and insert a chunk of trips with set-based SQL instead of per-key lookups.
+
+    ``rows`` carry the trip columns plus precomputed ``origin_geohash``,
+    ``destination_geohash`` and ``time_bucket_start``. They are loaded into a
+    per-connection temporary table, the distinct keys are inserted into
+    ``trip_groups`` in one statement and the trips are inserted joined to their groups.
+    """
+    if not rows:
+        return
+    connection = session.connection()
+    trip_staging.create(bind=connection, checkfirst=True)
+    session.execute(delete(trip_staging))
+    session.execute(insert(trip_staging), list(rows))
+
+    staging = trip_staging.c
+    distinct_keys = (
+        select(
+            staging.region,
+            staging.origin_geohash,
+            staging.destination_geohash,
+            staging.time_bucket_start,
+            literal(settings.time_bucket_minutes),
+        )
+        .distinct()
+        # SQLite needs a WHERE clause to tell ON CONFLICT apart from a join constraint.
+        .where(true())
+    )
+    group_insert = _dialect_insert(session, TripGroup.__table__).from_select(
+        ["region", "origin_geohash", "destination_geohash", "time_bucket_start", "time_bucket_minutes"],
+        distinct_keys,
+    )
+    session.execute(group_insert.on_conflict_do_nothing())
+
+    trip_columns = [
+        "region",
+        "origin_lat",
+        "origin_lng",
+        "destination_lat",
+        "destination_lng",
+        "started_at",
+        "datasource",
+        "origin_cell",
+    ]
+    grouped = select(*(staging[name] for name in trip_columns), TripGroup.id).join(
+        TripGroup,
+        and_(
+            TripGroup.region == staging.region,
+            TripGroup.origin_geohash == staging.origin_geohash,
+            TripGroup.destination_geohash == staging.destination_geohash,
+            TripGroup.time_bucket_start == staging.time_bucket_start,
+        ),
+    )
+    if partition_mode(session.get_bind().dialect.name) == "sharded":
+        # Each shard takes its region and week of the staged rows.
+        for region, week in sorted({(row["region"], week_start(row["started_at"])) for row in rows}):
+            shard_rows = grouped.where(
+                staging.region == region, staging.started_at >= week, staging.started_at < week + WEEK
+            )
+            target = shard_table(partition_table_name(region, week))
+            session.execute(insert(target).from_select([*trip_columns, "group_id"], shard_rows))
+    else:
+        session.execute(insert(Trip.__table__).from_select([*trip_columns, "group_id"], grouped))
+    counts = grouped.with_only_columns(TripGroup.id, func.count()).group_by(TripGroup.id)
+    add_trip_group_counts(session, dict(session.execute(counts).all()))
+    session.execute(delete(trip_staging))
+
+
+@timed_stage("group_counts")
+def add_trip_group_counts(session: Session, counts: Mapping[int, int]) -> None:
+    """Add a chunk's per-group trip counts to ``trip_groups.trip_count``."""
+    if not counts:
+        return
+    table = TripGroup.__table__
+    statement = (
+        update(table)
+        .where(table.c.id == bindparam("group_id"))
+        .values(trip_count=table.c.trip_count + bindparam("added"))
+    )
+    # Updating in id order keeps concurrent jobs from deadlocking on shared groups.
+    session.execute(statement, [{"group_id": group_id, "added": counts[group_id]} for group_id in sorted(counts)])
+
+
+def rebuild_trip_group_counts(session: Session) -> None:
+    """Recompute ``trip_groups.trip_count`` from ``trips``, e.g. for a database created before the column."""
+    trips = trip_source(session)
+    session.execute(update(TripGroup).values(trip_count=0))
+    counts = select(trips.c.group_id, func.count()).group_by(trips.c.group_id)
+    add_trip_group_counts(session, dict(session.execute(counts).all()))
+
+
+def add_missing_columns(connection: Connection, batch_size: int = 50_000) -> Dict[str, List[str]]:
+    """Add the ``trip_groups``, ``trips`` and ``ingestion_jobs`` columns missing from databases created before them.
 
+    ``create_all`` never alters an existing table. Derived columns are backfilled in the same transaction, so a
+    crash cannot leave them at their placeholder defaults: ``trips.origin_cell`` from the origin coordinates and
+    ``trip_groups.trip_count`` from ``trips``. Runs before ``create_trip_indexes``, which indexes ``origin_cell``.
+    Returns the added columns per table.
+    """
+    added = {}
+    for table in (TripGroup.__table__, Trip.__table__, IngestionJob.__table__):
+        existing = {column["name"] for column in inspect(connection).get_columns(table.name)}
+        added[table.name] = [column.name for column in table.columns if column.name not in existing]
+        for name in added[table.name]:
+            ddl = CreateColumn(table.c[name]).compile(dialect=connection.dialect)
+            # Rows are backfilled below, but ADD COLUMN ... NOT NULL needs a value for them meanwhile.
+            default = " DEFAULT 0" if table is Trip.__table__ and name == "origin_cell" else ""
+            connection.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {ddl}{default}")
+        # ``create_trip_indexes`` builds the ``trips`` indexes once the backfill is done.
+        if added[table.name] and table is not Trip.__table__:
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+    if "origin_cell" in added[Trip.__tablename__]:
+        _backfill_origin_cells(connection, batch_size)
+        if connection.dialect.name == "postgresql":
+            connection.exec_driver_sql("ALTER TABLE trips ALTER COLUMN origin_cell DROP DEFAULT")
+    if "trip_count" in added[TripGroup.__tablename__]:
+        with Session(bind=connection) as session:
+            rebuild_trip_group_counts(session)
+    return {name: columns for name, columns in added.items() if columns}
 
+
+def _backfill_origin_cells(connection: Connection, batch_size: int) -> None:
+    """Compute ``trips.origin_cell`` from the origin coordinates, ``batch_size`` trips at a time in id order."""
+    trips = Trip.__table__
+    statement = update(trips).where(trips.c.id == bindparam("trip_id")).values(origin_cell=bindparam("cell"))
+    last_id = None
+    while True:
+        query = select(trips.c.id, trips.c.origin_lat, trips.c.origin_lng).order_by(trips.c.id).limit(batch_size)
+        if last_id is not None:
+            query = query.where(trips.c.id > last_id)
+        rows = connection.execute(query).all()
+        if not rows:
+            return
+        ids, lats, lngs = zip(*rows)
+        cells = origin_cells(np.array(lats, dtype=np.float64), np.array(lngs, dtype=np.float64))
+        connection.execute(statement, [{"trip_id": id_, "cell": cell} for id_, cell in zip(ids, cells.tolist())])
+        last_id = ids[-1]
+
+
+def drop_legacy_trip_indexes(connection: Connection) -> None:
+    """Drop the single-column ``trips`` indexes of databases created before the composite index profile."""
+    for name in LEGACY_TRIP_INDEXES:
+        connection.exec_driver_sql(f"DROP INDEX IF EXISTS {name}")
+
+
+def drop_trip_indexes(connection: Connection) -> None:
+    """Drop the secondary indexes of ``trips`` so a bulk load only appends table rows."""
+    for index in Trip.__table__.indexes:
+        index.drop(connection, checkfirst=True)
+
+
+def create_trip_indexes(connection: Connection) -> None:
+    """Build any missing ``trips`` index, e.g. after a bulk load or one interrupted mid-job."""
+    for index in Trip.__table__.indexes:
+        index.create(connection, checkfirst=True)
+
+
+@timed_stage("bulk_insert")
 def bulk_insert_trips(session: Session, rows: Iterable[Trip]) -> None:
     session.add_all(rows)
     session.flush()
 
 
-def create_ingestion_job(session: Session, filename: str) -> IngestionJob:
-    job = IngestionJob(filename=filename, status="pending", processed_rows=0)
+def create_ingestion_job(
+    session: Session,
+    filename: str,
+    grouping_mode: Optional[str] = None,
+    source_path: Optional[str] = None,
+    clustering: Optional[str] = None,
+) -> IngestionJob:
+    job = IngestionJob(
+        filename=filename,
+        source_path=source_path,
+        status="pending",
+        processed_rows=0,
+        grouping_mode=grouping_mode or settings.grouping_mode,
+        clustering=clustering or settings.clustering,
+    )
     session.add(job)
     session.flush()
     return job
@@ -71,7 +439,15 @@ def update_ingestion_job(
     status: Optional[str] = None,
     total_rows: Optional[int] = None,
     processed_rows: Optional[int] = None,
+    total_bytes: Optional[int] = None,
+    processed_bytes: Optional[int] = None,
     message: Optional[str] = None,
+    group_cache_hits: Optional[int] = None,
+    group_cache_misses: Optional[int] = None,
+    read_seconds: Optional[float] = None,
+    parse_seconds: Optional[float] = None,
+    write_seconds: Optional[float] = None,
+    metrics: Optional[dict] = None,
 ) -> IngestionJob:
     job = session.get(IngestionJob, job_id)
     if not job:
@@ -82,46 +458,604 @@ def update_ingestion_job(
         job.total_rows = total_rows
     if processed_rows is not None:
         job.processed_rows = processed_rows
+    if total_bytes is not None:
+        job.total_bytes = total_bytes
+    if processed_bytes is not None:
+        job.processed_bytes = processed_bytes
     if message is not None:
         job.message = message
+    if group_cache_hits is not None:
+        job.group_cache_hits = group_cache_hits
+    if group_cache_misses is not None:
+        job.group_cache_misses = group_cache_misses
+    if read_seconds is not None:
+        job.read_seconds = read_seconds
+    if parse_seconds is not None:
+        job.parse_seconds = parse_seconds
+    if write_seconds is not None:
+        job.write_seconds = write_seconds
+    if metrics is not None:
+        job.metrics = metrics
     session.add(job)
     session.flush()
     return job
 
 
-def list_trip_groups(session: Session, limit: int = 100) -> List[Tuple[TripGroup, int]]:
-    query = (
-        select(TripGroup, func.count(Trip.id).label("trip_count"))
-        .join(Trip, Trip.group_id == TripGroup.id)
-        .group_by(TripGroup.id)
-        .order_by(func.count(Trip.id).desc())
-        .limit(limit)
+def record_ingestion_chunk(session: Session, job_id: int, start_offset: int, end_offset: int, row_count: int) -> bool:
+    """Claim a chunk for ``job_id``; ``False`` means it was already committed and must be skipped."""
+    statement = _dialect_insert(session, IngestionChunk.__table__).values(
+        job_id=job_id, start_offset=start_offset, end_offset=end_offset, row_count=row_count
+    )
+    return session.execute(statement.on_conflict_do_nothing()).rowcount == 1
+
+
+def clear_ingestion_chunks(session: Session, job_id: int) -> None:
+    session.execute(delete(IngestionChunk).where(IngestionChunk.job_id == job_id))
+
+
+def enqueue_ingestion_job(
+    session: Session,
+    filename: str,
+    source_path: str,
+    grouping_mode: Optional[str] = None,
+    priority: int = 0,
+    clustering: Optional[str] = None,
+) -> IngestionJob:
+    job = create_ingestion_job(
+        session, filename, grouping_mode=grouping_mode, source_path=source_path, clustering=clustering
     )
-    return list(session.execute(query))
+    job.status = "queued"
+    job.priority = priority
+    job.queued_at = datetime.utcnow()
+    session.flush()
+    return job
+
+
+def requeue_ingestion_job(session: Session, job_id: int) -> IngestionJob:
+    job = update_ingestion_job(session, job_id, status="queued")
+    job.queued_at = datetime.utcnow()
+    job.started_at = None
+    session.flush()
+    return job
+
+
+def claim_next_ingestion_job(session: Session) -> Optional[IngestionJob]:
+    """Mark the highest-priority, longest-waiting queued job as running and return it."""
+    statement = (
+        select(IngestionJob)
+        .where(IngestionJob.status == "queued")
+        .order_by(IngestionJob.priority.desc(), IngestionJob.queued_at, IngestionJob.id)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+    )
+    job = session.execute(statement).scalar_one_or_none()
+    if job is None:
+        return None
+    job.status = "running"
+    job.started_at = datetime.utcnow()
+    session.flush()
+    return job
+
+
+def cancel_queued_ingestion_job(session: Session, job_id: int) -> bool:
+    result = session.execute(
+        update(IngestionJob)
+        .where(IngestionJob.id == job_id, IngestionJob.status == "queued")
+        .values(status="cancelled", message="Cancelled before it started", updated_at=datetime.utcnow())
+    )
+    return result.rowcount == 1
+
+
+def count_queued_ingestion_jobs(session: Session) -> int:
+    return session.execute(select(func.count(IngestionJob.id)).where(IngestionJob.status == "queued")).scalar_one()
+
+
+def ingestion_queue_waits(session: Session, recent: int = 50) -> Tuple[Optional[datetime], List[float]]:
+    """Return when the oldest queued job was queued and the queue waits of recently started jobs."""
+    oldest = session.execute(
+        select(func.min(IngestionJob.queued_at)).where(IngestionJob.status == "queued")
+    ).scalar_one()
+    started = session.execute(
+        select(IngestionJob.queued_at, IngestionJob.started_at)
+        .where(IngestionJob.started_at.is_not(None), IngestionJob.queued_at.is_not(None))
+        .order_by(IngestionJob.started_at.desc())
+        .limit(recent)
+    ).all()
+    return oldest, [(started_at - queued_at).total_seconds() for queued_at, started_at in started]
+
+
+def list_resumable_jobs(session: Session) -> List[IngestionJob]:
+    """Jobs left ``pending`` or ``running`` by a process that stopped before finishing them."""
+    statement = select(IngestionJob).where(IngestionJob.status.in_(("pending", "running"))).order_by(IngestionJob.id)
+    return list(session.execute(statement).scalars())
 
 
+@timed_query("trip_groups")
+def list_trip_groups(
+    session: Session,
+    limit: int = 100,
+    after_count: Optional[int] = None,
+    after_id: Optional[int] = None,
+    region: Optional[str] = None,
+    bucket_from: Optional[datetime] = None,
+    bucket_to: Optional[datetime] = None,
+    geohash_prefix: Optional[str] = None,
+) -> List[TripGroup]:
+    """Most populated trip groups first, paged by the ``(trip_count, id)`` of the previous page's last group."""
+    query = select(TripGroup).where(TripGroup.trip_count > 0)
+    if after_count is not None and after_id is not None:
+        query = query.where(
+            or_(
+                TripGroup.trip_count < after_count,
+                and_(TripGroup.trip_count == after_count, TripGroup.id < after_id),
+            )
+        )
+    if region is not None:
+        query = query.where(TripGroup.region == region)
+    if bucket_from is not None:
+        query = query.where(TripGroup.time_bucket_start >= bucket_from)
+    if bucket_to is not None:
+        query = query.where(TripGroup.time_bucket_start < bucket_to)
+    if geohash_prefix:
+        query = query.where(TripGroup.origin_geohash.startswith(geohash_prefix, autoescape=True))
+    query = query.order_by(TripGroup.trip_count.desc(), TripGroup.id.desc()).limit(limit)
+    return list(session.execute(query).scalars())
+
+
+@timed_stage("rollup")
+def update_weekly_rollup(
+    session: Session,
+    region_codes: np.ndarray,
+    regions: Sequence[str],
+    origin_lats: np.ndarray,
+    origin_lngs: np.ndarray,
+    started_at: np.ndarray,
+) -> None:
+    """Fold a chunk of trips (``started_at`` in epoch microseconds) into ``trip_weekly_rollup``."""
+    if len(region_codes) == 0:
+        return
+    precision = settings.rollup_geohash_precision
+    lat_index, lng_index = geohash_cell_indices(origin_lats, origin_lngs, precision)
+    cells = geohash_cells(origin_lats, origin_lngs, precision)
+    weeks = week_start_batch(started_at // 1_000_000)
+    keys = np.stack([np.asarray(region_codes, dtype=np.int64), cells, weeks], axis=1)
+    unique_keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    counts = np.bincount(inverse, minlength=len(unique_keys))
+    min_started = np.full(len(unique_keys), np.iinfo(np.int64).max)
+    max_started = np.full(len(unique_keys), np.iinfo(np.int64).min)
+    np.minimum.at(min_started, inverse, started_at)
+    np.maximum.at(max_started, inverse, started_at)
+    key_lat_index = np.empty(len(unique_keys), dtype=np.int64)
+    key_lng_index = np.empty(len(unique_keys), dtype=np.int64)
+    key_lat_index[inverse] = lat_index
+    key_lng_index[inverse] = lng_index
+
+    rows = [
+        {
+            "region": regions[region_code],
+            "origin_cell": cell,
+            "week_start": week_start,
+            "cell_lat_index": cell_lat_index,
+            "cell_lng_index": cell_lng_index,
+            "trip_count": trip_count,
+            "min_started_at": first,
+            "max_started_at": last,
+        }
+        for (region_code, cell, _), week_start, cell_lat_index, cell_lng_index, trip_count, first, last in zip(
+            unique_keys.tolist(),
+            from_epoch_seconds(unique_keys[:, 2]).tolist(),
+            key_lat_index.tolist(),
+            key_lng_index.tolist(),
+            counts.tolist(),
+            from_epoch_micros(min_started).tolist(),
+            from_epoch_micros(max_started).tolist(),
+        )
+    ]
+
+    table = TripWeeklyRollup.__table__
+    statement = _dialect_insert(session, table)
+    if session.get_bind().dialect.name == "postgresql":
+        least, greatest = func.least, func.greatest
+    else:
+        # SQLite's multi-argument min()/max() are scalar functions.
+        least, greatest = func.min, func.max
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.region, table.c.origin_cell, table.c.week_start],
+        set_={
+            "trip_count": table.c.trip_count + statement.excluded.trip_count,
+            "min_started_at": least(table.c.min_started_at, statement.excluded.min_started_at),
+            "max_started_at": greatest(table.c.max_started_at, statement.excluded.max_started_at),
+        },
+    )
+    session.execute(statement, rows)
+
+
+def rebuild_weekly_rollup(session: Session, batch_size: int = 100_000) -> None:
+    """Recompute ``trip_weekly_rollup`` from ``trips``, e.g. after changing the rollup precision."""
+    session.execute(delete(TripWeeklyRollup))
+    trips = trip_source(session)
+    query = select(trips.c.region, trips.c.origin_lat, trips.c.origin_lng, trips.c.started_at).execution_options(
+        yield_per=batch_size
+    )
+    for partition in session.execute(query).partitions():
+        regions, origin_lats, origin_lngs, started_at = zip(*partition)
+        names, region_codes = np.unique(np.array(regions, dtype=object), return_inverse=True)
+        update_weekly_rollup(
+            session,
+            region_codes.reshape(-1),
+            names.tolist(),
+            np.array(origin_lats, dtype=np.float64),
+            np.array(origin_lngs, dtype=np.float64),
+            np.array(started_at, dtype="datetime64[us]").astype(np.int64),
+        )
+
+
+def backfill_weekly_rollup(session: Session) -> bool:
+    """Build ``trip_weekly_rollup`` when it is empty but ``trips`` is not, e.g. for trips ingested before it.
+
+    Returns whether it was rebuilt.
+    """
+    if session.execute(select(TripWeeklyRollup.region).limit(1)).first() is not None:
+        return False
+    trips = trip_source(session)
+    if session.execute(select(trips.c.id).limit(1)).first() is None:
+        return False
+    rebuild_weekly_rollup(session)
+    return True
+
+
+class RollupLevel(NamedTuple):
+    """Resolution of one ``trip_group_rollups`` level."""
+
+    geohash_precision: int
+    bucket_minutes: int
+
+
+def group_rollup_levels() -> List[RollupLevel]:
+    return [
+        RollupLevel(precision, minutes)
+        for precision in settings.group_rollup_precisions
+        for minutes in settings.group_rollup_bucket_minutes
+    ]
+
+
+def choose_rollup_level(geohash_precision: int, bucket_minutes: int) -> RollupLevel:
+    """The coarsest level whose cells and buckets nest in the requested ones, so the fewest rows are merged."""
+    candidates = [
+        level
+        for level in group_rollup_levels()
+        if level.geohash_precision >= geohash_precision and bucket_minutes % level.bucket_minutes == 0
+    ]
+    if not settings.group_rollup_precisions:
+        raise ValueError("Trip group rollups are disabled; set GROUP_ROLLUP_PRECISIONS to enable them")
+    if not candidates:
+        raise ValueError(
+            f"No trip group rollup level answers geohash precision {geohash_precision} "
+            f"and {bucket_minutes}-minute buckets (levels: precisions {settings.group_rollup_precisions}, "
+            f"bucket minutes {settings.group_rollup_bucket_minutes})"
+        )
+    return min(candidates, key=lambda level: (level.geohash_precision, -level.bucket_minutes))
+
+
+@timed_stage("rollup")
+def update_group_rollups(
+    session: Session,
+    region_codes: np.ndarray,
+    regions: Sequence[str],
+    origin_lats: np.ndarray,
+    origin_lngs: np.ndarray,
+    destination_lats: np.ndarray,
+    destination_lngs: np.ndarray,
+    started_at: np.ndarray,
+) -> None:
+    """Fold a chunk of trips (``started_at`` in epoch microseconds) into every ``trip_group_rollups`` level.
+
+    The chunk is counted once at the finest precision and bucket and staged in a per-connection
+    temporary table; each level then merges those counts in one ``INSERT ... SELECT ... GROUP BY``.
+    """
+    levels = group_rollup_levels()
+    if len(region_codes) == 0 or not levels:
+        return
+    finest_precision = settings.group_rollup_precisions[-1]
+    seconds = np.asarray(started_at, dtype=np.int64) // 1_000_000
+    keys = np.stack(
+        [
+            np.asarray(region_codes, dtype=np.int64),
+            seconds - seconds % (settings.group_rollup_bucket_minutes[0] * 60),
+            geohash_cells(origin_lats, origin_lngs, finest_precision).astype(np.int64),
+            geohash_cells(destination_lats, destination_lngs, finest_precision).astype(np.int64),
+        ],
+        axis=1,
+    )
+    unique_keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+    counts = np.bincount(inverse.reshape(-1), minlength=len(unique_keys))
+    rows = [
+        {
+            "region": regions[region_code],
+            "bucket_start": bucket_start,
+            "origin_geohash": origin,
+            "destination_geohash": destination,
+            "trip_count": trip_count,
+        }
+        for region_code, bucket_start, origin, destination, trip_count in zip(
+            unique_keys[:, 0].tolist(),
+            unique_keys[:, 1].tolist(),
+            geohash_from_cells(unique_keys[:, 2], finest_precision).tolist(),
+            geohash_from_cells(unique_keys[:, 3], finest_precision).tolist(),
+            counts.tolist(),
+        )
+    ]
+    group_rollup_staging.create(bind=session.connection(), checkfirst=True)
+    session.execute(delete(group_rollup_staging))
+    session.execute(insert(group_rollup_staging), rows)
+
+    staging = group_rollup_staging.c
+    table = TripGroupRollup.__table__
+    for precision, minutes in levels:
+        # Dropping trailing geohash characters and rounding bucket starts down gives the enclosing cell and bucket.
+        bucket = staging.bucket_start - staging.bucket_start % (minutes * 60)
+        origin = func.substr(staging.origin_geohash, 1, precision)
+        destination = func.substr(staging.destination_geohash, 1, precision)
+        merged = (
+            select(
+                literal(precision),
+                literal(minutes),
+                staging.region,
+                bucket,
+                origin,
+                destination,
+                func.sum(staging.trip_count),
+            )
+            # SQLite needs a WHERE clause to tell ON CONFLICT apart from a join constraint.
+            .where(true())
+            .group_by(staging.region, bucket, origin, destination)
+        )
+        statement = _dialect_insert(session, table).from_select(
+            [
+                "geohash_precision",
+                "bucket_minutes",
+                "region",
+                "bucket_start",
+                "origin_geohash",
+                "destination_geohash",
+                "trip_count",
+            ],
+            merged,
+        )
+        statement = statement.on_conflict_do_update(
+            index_elements=list(table.primary_key.columns),
+            set_={"trip_count": table.c.trip_count + statement.excluded.trip_count},
+        )
+        session.execute(statement)
+    session.execute(delete(group_rollup_staging))
+
+
+def rebuild_group_rollups(session: Session, batch_size: int = 100_000) -> None:
+    """Recompute ``trip_group_rollups`` from ``trips``, e.g. after changing the rollup levels."""
+    session.execute(delete(TripGroupRollup))
+    if not group_rollup_levels():
+        return
+    trips = trip_source(session)
+    query = select(
+        trips.c.region,
+        trips.c.origin_lat,
+        trips.c.origin_lng,
+        trips.c.destination_lat,
+        trips.c.destination_lng,
+        trips.c.started_at,
+    ).execution_options(yield_per=batch_size)
+    for partition in session.execute(query).partitions():
+        regions, *coordinates, started_at = zip(*partition)
+        names, region_codes = np.unique(np.array(regions, dtype=object), return_inverse=True)
+        update_group_rollups(
+            session,
+            region_codes.reshape(-1),
+            names.tolist(),
+            *(np.array(values, dtype=np.float64) for values in coordinates),
+            np.array(started_at, dtype="datetime64[us]").astype(np.int64),
+        )
+
+
+def sync_group_rollup_levels(session: Session) -> bool:
+    """Rebuild ``trip_group_rollups`` when its stored levels differ from the configured ones.
+
+    Every trip is counted at every level, so with any trips stored the table holds rows for exactly the
+    configured levels; levels added to a live database would otherwise count only trips ingested since.
+    Returns whether it was rebuilt.
+    """
+    stored = session.execute(select(TripGroupRollup.geohash_precision, TripGroupRollup.bucket_minutes).distinct())
+    configured = set(group_rollup_levels())
+    if {RollupLevel(*level) for level in stored} == configured:
+        return False
+    trips = trip_source(session)
+    if configured and session.execute(select(trips.c.id).limit(1)).first() is None:
+        return False
+    rebuild_group_rollups(session)
+    return True
+
+
+def _epoch_seconds(value: datetime) -> int:
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return int(to_epoch_seconds([value])[0])
+
+
+@timed_query("trip_group_rollups")
+def list_trip_group_rollups(
+    session: Session,
+    *,
+    geohash_precision: int,
+    bucket_minutes: int,
+    limit: int = 50,
+    region: Optional[str] = None,
+    bucket_from: Optional[datetime] = None,
+    bucket_to: Optional[datetime] = None,
+    geohash_prefix: Optional[str] = None,
+) -> Tuple[RollupLevel, List[Row]]:
+    """Trip counts per origin/destination cell pair and bucket at the requested resolution, most trips first.
+
+    The coarsest level that nests in the resolution answers the query; when it is finer, its
+    geohashes are truncated and its buckets rounded down and merged with ``GROUP BY``.
+    """
+    level = choose_rollup_level(max(geohash_precision, len(geohash_prefix or "")), bucket_minutes)
+    step = bucket_minutes * 60
+    origin, destination, bucket = (
+        TripGroupRollup.origin_geohash,
+        TripGroupRollup.destination_geohash,
+        TripGroupRollup.bucket_start,
+    )
+    if level.geohash_precision > geohash_precision:
+        origin = func.substr(origin, 1, geohash_precision)
+        destination = func.substr(destination, 1, geohash_precision)
+    if level.bucket_minutes < bucket_minutes:
+        bucket = bucket - bucket % step
+    filters = [
+        TripGroupRollup.geohash_precision == level.geohash_precision,
+        TripGroupRollup.bucket_minutes == level.bucket_minutes,
+    ]
+    if region is not None:
+        filters.append(TripGroupRollup.region == region)
+    # A requested bucket is made of the level buckets starting inside it, so bounds
+    # rounded up to whole requested buckets select exactly the level rows needed.
+    if bucket_from is not None:
+        filters.append(TripGroupRollup.bucket_start >= -(-_epoch_seconds(bucket_from) // step) * step)
+    if bucket_to is not None:
+        filters.append(TripGroupRollup.bucket_start < -(-_epoch_seconds(bucket_to) // step) * step)
+    if geohash_prefix:
+        filters.append(TripGroupRollup.origin_geohash.startswith(geohash_prefix, autoescape=True))
+
+    if level == (geohash_precision, bucket_minutes):
+        trip_count = TripGroupRollup.trip_count
+        query = select(TripGroupRollup.region, origin, destination, bucket, trip_count).where(*filters)
+    else:
+        trip_count = func.sum(TripGroupRollup.trip_count)
+        query = (
+            select(
+                TripGroupRollup.region,
+                origin.label("origin_geohash"),
+                destination.label("destination_geohash"),
+                bucket.label("bucket_start"),
+                trip_count.label("trip_count"),
+            )
+            .where(*filters)
+            .group_by(TripGroupRollup.region, origin, destination, bucket)
+        )
+    query = query.order_by(trip_count.desc(), TripGroupRollup.region, bucket, origin, destination).limit(limit)
+    return level, list(session.execute(query))
+
+
+def _weekly_average(
+    total_trips: int, min_date: Optional[datetime], max_date: Optional[datetime]
+) -> Tuple[float, int, int]:
+    if total_trips == 0 or not min_date or not max_date:
+        return 0.0, 0, 0
+
+    week_span = max((max_date - min_date).days / 7, 0)
+    week_count = max(1, int(week_span) + 1)
+    weekly_average = total_trips / week_count
+    return weekly_average, total_trips, week_count
+
+
+@timed_query("weekly_average")
 def compute_weekly_average(
     session: Session,
     *,
     region: Optional[str] = None,
     bbox: Optional[Tuple[float, float, float, float]] = None,
 ) -> Tuple[float, int, int]:
+    """Weekly average answered from ``trip_weekly_rollup``.
+
+    Rollup cells entirely inside the bounding box are summed directly; only trips
+    in the partially covered cells along its edge are read from ``trips``.
+    """
+    rollup_query = select(
+        func.coalesce(func.sum(TripWeeklyRollup.trip_count), 0),
+        func.min(TripWeeklyRollup.min_started_at),
+        func.max(TripWeeklyRollup.max_started_at),
+    )
+    rollup_filters = []
+    if region:
+        rollup_filters.append(TripWeeklyRollup.region == region)
+    if not bbox:
+        return _weekly_average(*session.execute(rollup_query.where(*rollup_filters)).one())
+
+    min_lat, min_lng, max_lat, max_lng = bbox
+    lat_bits, lng_bits = geohash_axis_bits(settings.rollup_geohash_precision)
+    lat_cells = covered_cell_range(min_lat, max_lat, -90.0, 90.0, lat_bits)
+    lng_cells = covered_cell_range(min_lng, max_lng, -180.0, 180.0, lng_bits)
+    trips = trip_source(session, region=region)
+    raw_filters = _trip_filters(trips, region, bbox)
+    raw_boxes = [bbox]
+    totals = []
+    if lat_cells and lng_cells:
+        first_lat, last_lat, lat_low, lat_high = lat_cells
+        first_lng, last_lng, lng_low, lng_high = lng_cells
+        rollup_filters.append(TripWeeklyRollup.cell_lat_index.between(first_lat, last_lat))
+        rollup_filters.append(TripWeeklyRollup.cell_lng_index.between(first_lng, last_lng))
+        totals.append(session.execute(rollup_query.where(*rollup_filters)).one())
+        # A point on a cell edge belongs to the lower cell, so covered cells hold
+        # exactly the points strictly above the low edges and up to the high edges.
+        raw_filters.append(
+            not_(
+                and_(
+                    trips.c.origin_lat > lat_low,
+                    trips.c.origin_lat <= lat_high,
+                    trips.c.origin_lng > lng_low,
+                    trips.c.origin_lng <= lng_high,
+                )
+            )
+        )
+        # Only the strips around the covered cells need raw trips.
+        raw_boxes = [
+            (min_lat, min_lng, lat_low, max_lng),
+            (lat_high, min_lng, max_lat, max_lng),
+            (lat_low, min_lng, lat_high, lng_low),
+            (lat_low, lng_high, lat_high, max_lng),
+        ]
+    # Range scans over origin cells narrow the rows; the exact coordinate filters then trim the edge cells.
+    raw_filters.append(_origin_cell_filter(trips, *raw_boxes))
+    raw_query = select(func.count(trips.c.id), func.min(trips.c.started_at), func.max(trips.c.started_at)).where(
+        *raw_filters
+    )
+    totals.append(session.execute(raw_query).one())
+
+    total_trips = sum(count for count, _, _ in totals)
+    min_dates = [first for _, first, _ in totals if first is not None]
+    max_dates = [last for _, _, last in totals if last is not None]
+    return _weekly_average(total_trips, min(min_dates, default=None), max(max_dates, default=None))
+
+
+def _trip_filters(
+    trips: FromClause, region: Optional[str], bbox: Optional[Tuple[float, float, float, float]]
+) -> list:
     filters = []
     if region:
-        filters.append(Trip.region == region)
+        filters.append(trips.c.region == region)
     if bbox:
         min_lat, min_lng, max_lat, max_lng = bbox
-        filters.append(and_(Trip.origin_lat >= min_lat, Trip.origin_lat <= max_lat))
-        filters.append(and_(Trip.origin_lng >= min_lng, Trip.origin_lng <= max_lng))
+        filters.append(and_(trips.c.origin_lat >= min_lat, trips.c.origin_lat <= max_lat))
+        filters.append(and_(trips.c.origin_lng >= min_lng, trips.c.origin_lng <= max_lng))
+    return filters
+
 
-    base_query = select(func.count(Trip.id), func.min(Trip.started_at), func.max(Trip.started_at))
+def _origin_cell_filter(trips: FromClause, *boxes: Tuple[float, float, float, float]):
+    """OR of ``origin_cell`` ranges covering ``boxes``, which share the ``BBOX_MAX_CELL_RANGES`` budget."""
+    budget = max(settings.bbox_max_cell_ranges // len(boxes), 1)
+    spans = [span for box in boxes for span in bbox_cell_ranges(*box, max_ranges=budget)]
+    return or_(*(trips.c.origin_cell.between(low, high) for low, high in merge_cell_ranges(spans)))
+
+
+def compute_weekly_average_from_trips(
+    session: Session,
+    *,
+    region: Optional[str] = None,
+    bbox: Optional[Tuple[float, float, float, float]] = None,
+) -> Tuple[float, int, int]:
+    """Reference implementation that aggregates the raw ``trips`` table."""
+    trips = trip_source(session, region=region)
+    base_query = select(func.count(trips.c.id), func.min(trips.c.started_at), func.max(trips.c.started_at))
+    filters = _trip_filters(trips, region, bbox)
     if filters:
         base_query = base_query.where(*filters)
-    total_trips, min_date, max_date = session.execute(base_query).one()
-    if total_trips == 0 or not min_date or not max_date:
-        return 0.0, 0, 0
-
-    week_span = max((max_date - min_date).days / 7, 0)
-    week_count = max(1, int(week_span) + 1)
-    weekly_average = total_trips / week_count
-    return weekly_average, total_trips, week_count
+    return _weekly_average(*session.execute(base_query).one())
@@ -1,19 +1,100 @@
 from __future__ import annotations
 
 from contextlib import contextmanager
-from typing import AsyncGenerator, Generator
+from typing import Any, AsyncGenerator, Dict, Generator, List
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import URL, Engine, make_url
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 from .config import settings
+from .metrics import count_round_trips
 
-async_engine = create_async_engine(settings.database_url, future=True, echo=False)
+
+def _is_sqlite_file(url: URL) -> bool:
+    return url.get_backend_name() == "sqlite" and url.database not in (None, "", ":memory:")
+
+
+def engine_options(database_url: str, writer: bool = False) -> Dict[str, Any]:
+    """Pool and timeout keyword arguments for ``create_engine`` from the settings.
+
+    With ``SQLITE_TUNING`` the writer engine of a SQLite file gets a single connection,
+    so writes queue in the pool instead of contending for the database lock.
+    """
+    url = make_url(database_url)
+    options: Dict[str, Any] = {"pool_pre_ping": settings.db_pool_pre_ping}
+    backend = url.get_backend_name()
+    # In-memory SQLite databases use a single shared connection and no sized pool.
+    if backend != "sqlite" or url.database not in (None, "", ":memory:"):
+        options["pool_size"] = settings.db_pool_size
+        options["max_overflow"] = settings.db_max_overflow
+        if url.get_driver_name() == "aiosqlite":
+            # aiosqlite defaults to NullPool, which opens a connection per checkout.
+            options["poolclass"] = AsyncAdaptedQueuePool
+    if writer and settings.sqlite_tuning and _is_sqlite_file(url):
+        options.update(pool_size=1, max_overflow=0, pool_timeout=settings.sqlite_busy_timeout_ms / 1000)
+    if settings.db_statement_timeout_ms and backend == "postgresql":
+        timeout = str(settings.db_statement_timeout_ms)
+        if url.get_driver_name() == "asyncpg":
+            options["connect_args"] = {"server_settings": {"statement_timeout": timeout}}
+        else:
+            options["connect_args"] = {"options": f"-c statement_timeout={timeout}"}
+    return options
+
+
+def sqlite_pragmas() -> List[str]:
+    """The SQLite tuning profile applied to every new connection."""
+    return [
+        # WAL lets the API keep reading while ingestion writes, and NORMAL only syncs at checkpoints.
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        f"PRAGMA cache_size=-{settings.sqlite_cache_size_kib}",
+        f"PRAGMA mmap_size={settings.sqlite_mmap_size_bytes}",
+        "PRAGMA temp_store=MEMORY",
+        f"PRAGMA busy_timeout={settings.sqlite_busy_timeout_ms}",
+    ]
+
+
+def tune_sqlite(engine: Engine) -> None:
+    """Apply :func:`sqlite_pragmas` on connect when ``engine`` is a SQLite file and ``SQLITE_TUNING`` is on."""
+    if not _is_sqlite_file(engine.url):
+        return
+
+    @event.listens_for(engine, "connect")
+    def _apply_pragmas(dbapi_connection, connection_record) -> None:
+        if not settings.sqlite_tuning:
+            return
+        cursor = dbapi_connection.cursor()
+        try:
+            for statement in sqlite_pragmas():
+                cursor.execute(statement)
+        finally:
+            cursor.close()
+
+
+async_engine = create_async_engine(
+    settings.database_url, future=True, echo=False, **engine_options(settings.database_url)
+)
 AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
 
-sync_engine = create_engine(settings.sync_database_url, future=True, echo=False)
-SyncSessionLocal = sessionmaker(bind=sync_engine, autocommit=False, autoflush=False)
+# The API reads through the async engine's pool; ingestion writes through the sync engine.
+sync_engine = create_engine(
+    settings.sync_database_url, future=True, echo=False, **engine_options(settings.sync_database_url, writer=True)
+)
+# Job queue bookkeeping from the API (enqueue, claim, cancel, stats) has its own pool, so it never
+# waits for the writer connection a running chunk holds until it commits.
+queue_engine = create_engine(
+    settings.sync_database_url, future=True, echo=False, **engine_options(settings.sync_database_url)
+)
+tune_sqlite(async_engine.sync_engine)
+tune_sqlite(sync_engine)
+tune_sqlite(queue_engine)
+if settings.metrics_enabled:
+    count_round_trips(sync_engine)
+SyncSessionLocal = sessionmaker(bind=sync_engine, autocommit=False, autoflush=False, expire_on_commit=False)
+QueueSessionLocal = sessionmaker(bind=queue_engine, autocommit=False, autoflush=False, expire_on_commit=False)
 
 
 async def get_async_session() -> AsyncGenerator[AsyncSession, None]:
@@ -23,7 +104,19 @@ async def get_async_session() -> AsyncGenerator[AsyncSession, None]:
 
 @contextmanager
 def get_sync_session() -> Generator[Session, None, None]:
-    session: Session = SyncSessionLocal()
+    with _session_scope(SyncSessionLocal) as session:
+        yield session
+
+
+@contextmanager
+def get_queue_session() -> Generator[Session, None, None]:
+    with _session_scope(QueueSessionLocal) as session:
+        yield session
+
+
+@contextmanager
+def _session_scope(factory: sessionmaker) -> Generator[Session, None, None]:
+    session: Session = factory()
     try:
         yield session
         session.commit()
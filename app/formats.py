@@ -0,0 +1,82 @@
+from __future__ import annotations
+
+import gzip
+import io
+import zlib
+from pathlib import Path
+from typing import BinaryIO, Iterable, Iterator, Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+CSV = "csv"
+CSV_GZIP = "csv.gz"
+CSV_ZSTD = "csv.zst"
+PARQUET = "parquet"
+
+SUPPORTED_SUFFIXES = (".csv", ".csv.gz", ".csv.zst", ".parquet")
+
+
+def detect_format(filename: str) -> Optional[str]:
+    """Return the input format implied by ``filename``'s suffix, or ``None`` if unsupported."""
+    name = filename.lower()
+    for suffix in SUPPORTED_SUFFIXES:
+        if name.endswith(suffix):
+            return suffix[1:]
+    return None
+
+
+def ensure_available(input_format: str) -> None:
+    """Raise ``RuntimeError`` if the optional package needed for ``input_format`` is missing."""
+    if input_format == CSV_ZSTD and zstandard is None:
+        raise RuntimeError("Reading .csv.zst uploads requires the zstandard package")
+    if input_format == PARQUET and pq is None:
+        raise RuntimeError("Reading .parquet uploads requires the pyarrow package")
+
+
+def open_csv(path: Path, input_format: str, buffering: int) -> BinaryIO:
+    """Open a plain or compressed CSV for binary line iteration, decompressing on the fly."""
+    if input_format == CSV:
+        return path.open("rb", buffering=buffering)
+    if input_format == CSV_GZIP:
+        return io.BufferedReader(gzip.GzipFile(path, "rb"), buffer_size=buffering)
+    if input_format == CSV_ZSTD:
+        ensure_available(input_format)
+        reader = zstandard.ZstdDecompressor().stream_reader(path.open("rb"), closefd=True)
+        return io.BufferedReader(reader, buffer_size=buffering)
+    raise ValueError(f"{input_format} is not a CSV format")
+
+
+def decompress_pieces(pieces: Iterable[bytes], input_format: str) -> Iterator[bytes]:
+    """Decompress a stream of arbitrarily sized byte pieces as they arrive."""
+    if input_format == CSV:
+        yield from pieces
+    elif input_format == CSV_GZIP:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        for piece in pieces:
+            while piece:
+                yield decompressor.decompress(piece)
+                # gzip allows several concatenated members; start a new one after each end.
+                piece = decompressor.unused_data if decompressor.eof else b""
+                if piece:
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        yield decompressor.flush()
+    elif input_format == CSV_ZSTD:
+        ensure_available(input_format)
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+        for piece in pieces:
+            yield decompressor.decompress(piece)
+    else:
+        raise ValueError(f"{input_format} uploads cannot be decompressed as a stream")
+
+
+def open_parquet(path: Path) -> "pq.ParquetFile":
+    ensure_available(PARQUET)
+    return pq.ParquetFile(path)
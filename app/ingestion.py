@@ -2,117 +2,1224 @@ from __future__ import annotations
 
 import asyncio
 import csv
+import multiprocessing
+import queue
+import threading
+import time
+from collections import Counter, deque
+from contextlib import closing, contextmanager
 from datetime import datetime
+from concurrent.futures import Future, ProcessPoolExecutor
 from functools import partial
+from itertools import islice
 from pathlib import Path
-from typing import List
+from typing import (
+    Any,
+    AsyncIterator,
+    BinaryIO,
+    Callable,
+    Deque,
+    Dict,
+    Generator,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    TypeVar,
+    Union,
+)
 
+import numpy as np
 from sqlalchemy.orm import Session
 
-from .clustering import parse_point
+from .cache import analytics_cache, cell_precision, touched_tags
+from .clustering import (
+    ClusteringStrategy,
+    ExactCellStrategy,
+    geohash_cells,
+    geohash_from_cells,
+    get_clustering_strategy,
+    origin_cells,
+)
 from .config import settings
 from .crud import (
-    bulk_insert_trips,
+    GroupKey,
+    TripGroupCache,
+    add_trip_group_counts,
+    cancel_queued_ingestion_job,
+    claim_next_ingestion_job,
+    clear_ingestion_chunks,
+    count_queued_ingestion_jobs,
+    create_anchored_groups,
     create_ingestion_job,
-    get_or_create_trip_group,
+    create_trip_indexes,
+    drop_trip_indexes,
+    enqueue_ingestion_job,
+    ingestion_queue_waits,
+    insert_trips_via_staging,
+    list_resumable_jobs,
+    load_group_anchors,
+    record_ingestion_chunk,
+    requeue_ingestion_job,
+    resolve_trip_groups,
+    trip_group_keys,
+    update_group_rollups,
     update_ingestion_job,
+    update_weekly_rollup,
 )
-from .db import get_sync_session
-from .models import Trip
-from .notifications import manager
+from .db import get_queue_session, get_sync_session, sync_engine
+from .formats import CSV, PARQUET, decompress_pieces, detect_format, open_csv, open_parquet
+from . import metrics
+from .loaders import TRIP_COLUMNS, TripLoader, TripRow, get_loader
+from .models import IngestionJob
+from .notifications import progress
+from .partitioning import chunk_partitions, ensure_partitions, insert_sharded_trips, partition_mode
+from .parsing import REQUIRED_COLUMNS, TripColumns, parse_csv_block, parse_record_batch
+
+
+T = TypeVar("T")
+R = TypeVar("R")
 
 
 class IngestionError(Exception):
     """Raised when an ingestion job fails."""
 
 
-def parse_datetime(value: str) -> datetime:
-    return datetime.fromisoformat(value.strip())
+class JobNotResumableError(IngestionError):
+    """Raised when a job is running, finished or has lost its upload and cannot be resumed."""
 
 
-def _count_rows(file_path: Path) -> int:
-    with file_path.open("r", encoding="utf-8") as csvfile:
-        return max(sum(1 for _ in csvfile) - 1, 0)
+class JobCancelledError(IngestionError):
+    """Raised inside a running job once its cancellation has been requested."""
 
 
-def _persist_chunk(session: Session, records: List[dict]) -> None:
-    trips: List[Trip] = []
-    for record in records:
-        origin_lat, origin_lng = parse_point(record["origin_coord"])
-        destination_lat, destination_lng = parse_point(record["destination_coord"])
-        started_at = parse_datetime(record["datetime"])
-        datasource = record["datasource"]
-        group = get_or_create_trip_group(
-            session,
-            region=record["region"],
-            origin_lat=origin_lat,
-            origin_lng=origin_lng,
-            destination_lat=destination_lat,
-            destination_lng=destination_lng,
-            started_at=started_at,
+class QueueFullError(IngestionError):
+    """Raised when the ingestion queue cannot accept another job; retry after ``retry_after`` seconds."""
+
+    def __init__(self, message: str, retry_after: int) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+# Jobs with an ingestion thread in this process; anything else left running is orphaned.
+_active_jobs: Set[int] = set()
+# Running jobs asked to stop; checked by the writer between chunks.
+_cancel_requested: Set[int] = set()
+
+
+class ParsedChunk(NamedTuple):
+    """A parsed chunk of CSV lines, its trip group keys and the byte range it came from."""
+
+    columns: TripColumns
+    keys: List[GroupKey]
+    origin_cells: np.ndarray
+    start_offset: int
+    end_offset: int
+
+    @property
+    def row_count(self) -> int:
+        return self.columns.row_count
+
+
+def _parse_lines(
+    lines: List[bytes], fieldnames: List[str], start_offset: int, first_row: Optional[int] = None
+) -> ParsedChunk:
+    data = b"".join(lines)
+    columns = parse_csv_block(data, fieldnames, first_row=first_row, start_offset=start_offset)
+    return _chunk_from_columns(columns, start_offset, start_offset + len(data))
+
+
+def _chunk_from_columns(columns: TripColumns, start_offset: int, end_offset: int) -> ParsedChunk:
+    with metrics.stage("geohash"):
+        keys = trip_group_keys(
+            columns.region_values(),
+            columns.origin_lat,
+            columns.origin_lng,
+            columns.destination_lat,
+            columns.destination_lng,
+            columns.started_at_seconds(),
+        )
+        cells = origin_cells(columns.origin_lat, columns.origin_lng)
+    return ParsedChunk(columns, keys, cells, start_offset, end_offset)
+
+
+def _parse_header(line: bytes) -> List[str]:
+    return next(csv.reader([line.decode("utf-8")]))
+
+
+def _read_header(raw: BinaryIO) -> List[str]:
+    return _parse_header(raw.readline())
+
+
+def _stage_chunk(session: Session, chunk: ParsedChunk) -> None:
+    columns = chunk.columns
+    trip_values = zip(
+        columns.origin_lat.tolist(),
+        columns.origin_lng.tolist(),
+        columns.destination_lat.tolist(),
+        columns.destination_lng.tolist(),
+        columns.started_at_datetimes(),
+        columns.datasource_values(),
+        chunk.origin_cells.tolist(),
+    )
+    rows = [
+        {
+            "region": region,
+            "origin_lat": origin_lat,
+            "origin_lng": origin_lng,
+            "destination_lat": destination_lat,
+            "destination_lng": destination_lng,
+            "started_at": started,
+            "datasource": datasource,
+            "origin_cell": origin_cell,
+            "origin_geohash": origin_geohash,
+            "destination_geohash": destination_geohash,
+            "time_bucket_start": bucket_start,
+        }
+        for (region, origin_geohash, destination_geohash, bucket_start), (
+            origin_lat,
+            origin_lng,
+            destination_lat,
+            destination_lng,
+            started,
+            datasource,
+            origin_cell,
+        ) in zip(chunk.keys, trip_values)
+    ]
+    insert_trips_via_staging(session, rows)
+
+
+def _load_chunk(session: Session, chunk: ParsedChunk, cache: TripGroupCache, loader: TripLoader) -> None:
+    group_ids = resolve_trip_groups(session, chunk.keys, cache)
+    columns = chunk.columns
+    rows: List[TripRow] = [
+        (key[0], origin_lat, origin_lng, destination_lat, destination_lng, started, datasource, group_ids[key], cell)
+        for key, origin_lat, origin_lng, destination_lat, destination_lng, started, datasource, cell in zip(
+            chunk.keys,
+            columns.origin_lat.tolist(),
+            columns.origin_lng.tolist(),
+            columns.destination_lat.tolist(),
+            columns.destination_lng.tolist(),
+            columns.started_at_datetimes(),
+            columns.datasource_values(),
+            chunk.origin_cells.tolist(),
         )
-        trip = Trip(
-            region=record["region"],
-            origin_lat=origin_lat,
-            origin_lng=origin_lng,
-            destination_lat=destination_lat,
-            destination_lng=destination_lng,
-            started_at=started_at,
-            datasource=datasource,
-            group_id=group.id,
+    ]
+    with metrics.stage("insert"):
+        if partition_mode(session.get_bind().dialect.name) == "sharded":
+            # Shard tables are created on demand, so they are written with plain Core inserts.
+            insert_sharded_trips(session, [dict(zip(TRIP_COLUMNS, row)) for row in rows])
+        else:
+            loader.load(session, rows)
+    add_trip_group_counts(session, Counter(group_ids[key] for key in chunk.keys))
+
+
+def _persist_chunk(
+    session: Session,
+    chunk: ParsedChunk,
+    cache: TripGroupCache,
+    loader: TripLoader,
+    grouping_mode: str = "cache",
+    strategy: ClusteringStrategy = ExactCellStrategy(),
+) -> Dict[str, Set[str]]:
+    """Write a chunk's trips, groups and rollups; returns the origin cells it touched per region."""
+    chunk = _cluster_chunk(session, chunk, strategy)
+    if grouping_mode == "staging":
+        _stage_chunk(session, chunk)
+    else:
+        _load_chunk(session, chunk, cache, loader)
+    columns = chunk.columns
+    update_weekly_rollup(
+        session,
+        columns.region_codes,
+        columns.regions,
+        columns.origin_lat,
+        columns.origin_lng,
+        columns.started_at,
+    )
+    update_group_rollups(
+        session,
+        columns.region_codes,
+        columns.regions,
+        columns.origin_lat,
+        columns.origin_lng,
+        columns.destination_lat,
+        columns.destination_lng,
+        columns.started_at,
+    )
+    return _touched_cells(chunk)
+
+
+def _touched_cells(chunk: ParsedChunk) -> Dict[str, Set[str]]:
+    """Origin cells, at the analytics cache's tag precision, of a chunk's trips and of the groups they joined."""
+    precision = cell_precision()
+    columns = chunk.columns
+    cells = geohash_cells(columns.origin_lat, columns.origin_lng, precision)
+    pairs = np.unique(np.stack([columns.region_codes.astype(np.int64), cells]), axis=1)
+    touched: Dict[str, Set[str]] = {}
+    for code, cell in zip(pairs[0].tolist(), geohash_from_cells(pairs[1], precision).tolist()):
+        touched.setdefault(columns.regions[code], set()).add(cell)
+    # Neighbour clustering can put a trip in a group keyed by an adjacent cell.
+    for region, origin_geohash, _, _ in set(chunk.keys):
+        touched.setdefault(region, set()).add(origin_geohash[:precision])
+    return touched
+
+
+def _cluster_chunk(session: Session, chunk: ParsedChunk, strategy: ClusteringStrategy) -> ParsedChunk:
+    """Replace the chunk's exact group keys with those of the groups ``strategy`` assigns."""
+    if isinstance(strategy, ExactCellStrategy):
+        return chunk
+    columns = chunk.columns
+    with metrics.stage("clustering"):
+        keys, founded = strategy.assign(
+            chunk.keys,
+            columns.origin_lat,
+            columns.origin_lng,
+            columns.destination_lat,
+            columns.destination_lng,
+            columns.started_at_seconds(),
+            partial(load_group_anchors, session),
         )
-        trips.append(trip)
-    bulk_insert_trips(session, trips)
+        if founded:
+            create_anchored_groups(session, founded)
+    return chunk._replace(keys=keys)
 
 
-def _ingest_file(job_id: int, file_path: Path, loop: asyncio.AbstractEventLoop) -> None:
+class Checkpoint(NamedTuple):
+    """Source offset of the first uncommitted row and the number of rows committed before it."""
+
+    offset: int = 0
+    rows: int = 0
+
+
+class RawBlock(NamedTuple):
+    """Unparsed CSV lines of one chunk and their position in the file."""
+
+    lines: List[bytes]
+    fieldnames: List[str]
+    start_offset: int
+    first_row: int
+
+
+def _iter_line_blocks(lines: Iterator[bytes], checkpoint: Checkpoint = Checkpoint()) -> Iterator[RawBlock]:
+    """Group a header line followed by CSV lines into chunk-sized blocks, resuming after ``checkpoint``.
+
+    Rows are split on line boundaries, so quoted fields must not contain newlines.
+    """
+    header = next(lines, None)
+    if header is None:
+        return
+    offset = len(header)
+    while offset < checkpoint.offset:
+        line = next(lines, None)
+        if line is None:
+            return
+        offset += len(line)
+    yield from _line_blocks(lines, _parse_header(header), offset, checkpoint.rows + 2)
+
+
+def _line_blocks(lines: Iterator[bytes], fieldnames: List[str], offset: int, first_row: int) -> Iterator[RawBlock]:
+    block_lines: List[bytes] = []
+    for line in lines:
+        block_lines.append(line)
+        if len(block_lines) >= settings.ingestion_chunk_size:
+            yield RawBlock(block_lines, fieldnames, offset, first_row)
+            offset += sum(map(len, block_lines))
+            first_row += len(block_lines)
+            block_lines = []
+    if block_lines:
+        yield RawBlock(block_lines, fieldnames, offset, first_row)
+
+
+def _parse_block(block: RawBlock) -> ParsedChunk:
+    return _parse_lines(block.lines, block.fieldnames, block.start_offset, block.first_row)
+
+
+def _iter_blocks(file_path: Path, input_format: str = CSV, checkpoint: Checkpoint = Checkpoint()) -> Iterator[RawBlock]:
+    with open_csv(file_path, input_format, settings.ingestion_read_buffer_bytes) as raw:
+        if input_format == CSV and checkpoint.offset:
+            fieldnames = _read_header(raw)
+            raw.seek(checkpoint.offset)
+            yield from _line_blocks(iter(raw), fieldnames, checkpoint.offset, checkpoint.rows + 2)
+        else:
+            # Compressed streams cannot seek, so committed rows are decompressed and skipped.
+            yield from _iter_line_blocks(iter(raw), checkpoint)
+
+
+def _iter_chunks(file_path: Path) -> Iterator[ParsedChunk]:
+    """Read the CSV exactly once, yielding parsed chunks tagged with their byte range."""
+    return map(_parse_block, _iter_blocks(file_path))
+
+
+class BatchBlock(NamedTuple):
+    """A Parquet record batch and its position in the file.
+
+    Offsets count uncompressed row-group bytes, interpolated by row within a row group.
+    """
+
+    batch: Any
+    start_offset: int
+    end_offset: int
+    first_row: int
+
+
+def _iter_batch_blocks(file_path: Path, row_groups: Iterable[int], skip_rows: int = 0) -> Iterator[BatchBlock]:
+    """Yield record batches of ``row_groups``, leaving out the first ``skip_rows`` rows of the file."""
+    parquet = open_parquet(file_path)
+    metadata = parquet.metadata
+    names = parquet.schema_arrow.names
+    columns = [column for column in REQUIRED_COLUMNS if column in names]
+    starts = [0]
+    first_rows = [1]
+    for index in range(metadata.num_row_groups):
+        starts.append(starts[-1] + metadata.row_group(index).total_byte_size)
+        first_rows.append(first_rows[-1] + metadata.row_group(index).num_rows)
+    for index in row_groups:
+        group_rows = metadata.row_group(index).num_rows
+        group_bytes = starts[index + 1] - starts[index]
+        skip = max(skip_rows - (first_rows[index] - 1), 0)
+        if skip >= group_rows:
+            continue
+        done = 0
+        for batch in parquet.iter_batches(
+            batch_size=settings.ingestion_chunk_size, row_groups=[index], columns=columns
+        ):
+            if skip >= batch.num_rows:
+                skip -= batch.num_rows
+                done += batch.num_rows
+                continue
+            if skip:
+                batch = batch.slice(skip)
+                done += skip
+                skip = 0
+            start_offset = starts[index] + group_bytes * done // group_rows
+            done += batch.num_rows
+            end_offset = starts[index] + group_bytes * done // group_rows
+            yield BatchBlock(batch, start_offset, end_offset, first_rows[index] + done - batch.num_rows)
+
+
+def _parse_batch_block(block: BatchBlock) -> ParsedChunk:
+    columns = parse_record_batch(block.batch, first_row=block.first_row, start_offset=block.start_offset)
+    return _chunk_from_columns(columns, block.start_offset, block.end_offset)
+
+
+def _split_lines(pieces: Iterable[bytes]) -> Iterator[bytes]:
+    """Re-assemble arbitrarily sized byte pieces into complete lines."""
+    remainder = b""
+    for piece in pieces:
+        lines = (remainder + piece).splitlines(keepends=True)
+        remainder = lines.pop() if lines and not lines[-1].endswith(b"\n") else b""
+        yield from lines
+    if remainder:
+        yield remainder
+
+
+class StageTimings:
+    """Seconds spent in each ingestion stage, excluding time blocked on neighbouring stages.
+
+    Besides read, parse and write it collects the finer stages timed with ``metrics.stage``
+    (geohash, group_lookup, insert, rollup, commit, ...) and the chunks and database round
+    trips behind the job's metrics summary.
+    """
+
+    def __init__(self) -> None:
+        self.read = 0.0
+        self.parse = 0.0
+        self.write = 0.0
+        self.stages: Dict[str, float] = {}
+        self.chunks = 0
+        self.round_trips = 0
+
+    def record(self, stage: str, seconds: float) -> None:
+        if stage in ("read", "parse", "write"):
+            setattr(self, stage, getattr(self, stage) + seconds)
+        else:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def add(self, stage: str, seconds: float) -> None:
+        self.record(stage, seconds)
+        metrics.STAGE_SECONDS.observe(seconds, stage=stage)
+
+    def timed(self, stage: str, func: Callable[[T], R]) -> Callable[[T], R]:
+        def wrapper(item: T) -> R:
+            start = time.perf_counter()
+            try:
+                with metrics.collecting(self):
+                    return func(item)
+            finally:
+                self.add(stage, time.perf_counter() - start)
+
+        return wrapper
+
+    def timed_iter(self, stage: str, items: Iterable[T]) -> Iterator[T]:
+        iterator = iter(items)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.add(stage, time.perf_counter() - start)
+            yield item
+
+    def as_dict(self) -> Dict[str, float]:
+        return {"read_seconds": self.read, "parse_seconds": self.parse, "write_seconds": self.write}
+
+    def summary(self, rows: int, seconds: float, cache: TripGroupCache) -> Optional[dict]:
+        """Per-job metrics stored on ``IngestionJob.metrics``, or ``None`` with ``METRICS_ENABLED`` off."""
+        if not settings.metrics_enabled:
+            return None
+        lookups = cache.hits + cache.misses
+        return {
+            "rows_per_second": rows / seconds if seconds > 0 else 0.0,
+            "chunks": self.chunks,
+            "db_round_trips": self.round_trips,
+            "db_round_trips_per_chunk": self.round_trips / self.chunks if self.chunks else 0.0,
+            "group_cache_hit_rate": cache.hits / lookups if lookups else None,
+            "stage_seconds": {"read": self.read, "parse": self.parse, "write": self.write, **self.stages},
+        }
+
+
+class _StageFailure(NamedTuple):
+    error: BaseException
+
+
+_STAGE_DONE = object()
+
+
+def _put_until_stopped(target: queue.Queue, item: object, stop: threading.Event) -> bool:
+    while not stop.is_set():
+        try:
+            target.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _drain(source: queue.Queue, stop: threading.Event) -> Iterator:
+    while not stop.is_set():
+        try:
+            item = source.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if item is _STAGE_DONE:
+            return
+        if isinstance(item, _StageFailure):
+            raise item.error
+        yield item
+
+
+def _run_stage(items: Iterator, target: queue.Queue, stop: threading.Event) -> None:
+    try:
+        for item in items:
+            if not _put_until_stopped(target, item, stop):
+                return
+        last: object = _STAGE_DONE
+    except BaseException as exc:  # noqa: BLE001
+        last = _StageFailure(exc)
+    _put_until_stopped(target, last, stop)
+
+
+def _pipeline(source: Iterable, steps: Sequence[Callable], depth: int) -> Generator:
+    """Run ``source`` and each of ``steps`` on its own thread, linked by queues of ``depth`` items.
+
+    Items keep their order, errors surface in the consumer, and at most ``depth``
+    items wait between two stages. A depth of 0 runs everything in the caller's thread.
+    """
+    if depth <= 0:
+        items: Iterable = source
+        for step in steps:
+            items = map(step, items)
+        yield from items
+        return
+    stop = threading.Event()
+    try:
+        items = iter(source)
+        for index, step in enumerate((None, *steps)):
+            if step is not None:
+                items = map(step, _drain(output, stop))
+            output: queue.Queue = queue.Queue(depth)
+            threading.Thread(
+                target=_run_stage, args=(items, output, stop), name=f"ingestion-stage-{index}", daemon=True
+            ).start()
+        yield from _drain(output, stop)
+    finally:
+        # Lets the stages exit when the writer stops early; they never block past the next queue poll.
+        stop.set()
+
+
+def _tee(pieces: Iterable[bytes], path: Path) -> Iterator[bytes]:
+    with path.open("wb") as copy:
+        for piece in pieces:
+            copy.write(piece)
+            yield piece
+
+
+class StreamFeed:
+    """Bounded hand-off of request body pieces from the event loop to the ingestion thread.
+
+    ``put`` waits while the queue is full, so a slow writer throttles the upload
+    instead of buffering it in memory. Once the consumer stops (finished or failed)
+    further pieces are dropped.
+    """
+
+    def __init__(self, maxsize: int) -> None:
+        self._queue: "queue.Queue[Union[bytes, BaseException, None]]" = queue.Queue(maxsize)
+        self._stopped = threading.Event()
+
+    async def put(self, piece: bytes) -> None:
+        try:
+            self._queue.put_nowait(piece)
+        except queue.Full:
+            await asyncio.to_thread(self._put_blocking, piece)
+
+    def _put_blocking(self, item: Union[bytes, BaseException, None]) -> None:
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    async def close(self) -> None:
+        await asyncio.to_thread(self._put_blocking, None)
+
+    async def abort(self, exc: BaseException) -> None:
+        await asyncio.to_thread(self._put_blocking, exc)
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    def __iter__(self) -> Iterator[bytes]:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if isinstance(item, BaseException):
+                raise IngestionError(f"Upload interrupted: {item}") from item
+            yield item
+
+
+def _shard_ranges(
+    file_path: Path, shard_bytes: int, start_offset: int = 0
+) -> Tuple[List[str], List[Tuple[int, int]]]:
+    """Split the CSV body from ``start_offset`` into byte ranges that start and end on line boundaries."""
+    size = file_path.stat().st_size
+    with file_path.open("rb") as raw:
+        fieldnames = _read_header(raw)
+        start = max(raw.tell(), start_offset)
+        ranges: List[Tuple[int, int]] = []
+        while start < size:
+            raw.seek(min(start + shard_bytes, size))
+            raw.readline()
+            end = raw.tell()
+            ranges.append((start, end))
+            start = end
+    return fieldnames, ranges
+
+
+def _init_shard_worker(worker_settings: dict) -> None:
+    for name, value in worker_settings.items():
+        setattr(settings, name, value)
+
+
+def _parse_shard(file_path: Path, start: int, end: int, fieldnames: List[str]) -> List[ParsedChunk]:
+    with file_path.open("rb") as raw:
+        raw.seek(start)
+        lines = raw.read(end - start).splitlines(keepends=True)
+    chunks: List[ParsedChunk] = []
+    chunk_size = settings.ingestion_chunk_size
+    for index in range(0, len(lines), chunk_size):
+        chunk = _parse_lines(lines[index : index + chunk_size], fieldnames, start)
+        start = chunk.end_offset
+        chunks.append(chunk)
+    return chunks
+
+
+def _parse_row_group(file_path: Path, index: int, skip_rows: int = 0) -> List[ParsedChunk]:
+    return [_parse_batch_block(block) for block in _iter_batch_blocks(file_path, [index], skip_rows)]
+
+
+def _iter_parallel(
+    tasks: Iterable[Tuple[Callable[..., List[ParsedChunk]], tuple]], workers: int
+) -> Iterator[ParsedChunk]:
+    """Run ``(function, args)`` tasks in worker processes, yielding their chunks in task order."""
+    executor = ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_shard_worker,
+        initargs=(settings.dict(),),
+    )
+    try:
+        tasks = iter(tasks)
+        # Keep a bounded window of tasks in flight so memory does not grow
+        # with the file when the writer is slower than the parsers.
+        pending: Deque[Future] = deque(executor.submit(func, *args) for func, args in islice(tasks, 2 * workers))
+        while pending:
+            chunks = pending.popleft().result()
+            for func, args in islice(tasks, 1):
+                pending.append(executor.submit(func, *args))
+            yield from chunks
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def _iter_chunks_parallel(file_path: Path, workers: int, start_offset: int = 0) -> Iterator[ParsedChunk]:
+    """Parse byte-range shards in worker processes, yielding chunks in file order."""
+    fieldnames, ranges = _shard_ranges(file_path, settings.ingestion_shard_bytes, start_offset)
+    return _iter_parallel(((_parse_shard, (file_path, start, end, fieldnames)) for start, end in ranges), workers)
+
+
+class ChunkSource(NamedTuple):
+    chunks: Generator[ParsedChunk, None, None]
+    total_bytes: Optional[int]
+    total_rows: Optional[int] = None
+
+
+def _run_ingestion(
+    job_id: int,
+    open_source: Callable[[StageTimings, Checkpoint], ChunkSource],
+    loop: asyncio.AbstractEventLoop,
+) -> None:
+    """Ingest ``job_id`` from its last committed checkpoint.
+
+    Each chunk commits its trips, its ledger entry and the new checkpoint together,
+    so a job interrupted at any point can be resumed without duplicating trips.
+    """
+
     def notify(message: dict) -> None:
-        asyncio.run_coroutine_threadsafe(manager.send_update(job_id, message), loop)
+        progress.publish_threadsafe(loop, job_id, message)
 
+    run_start = time.perf_counter()
+    timings = StageTimings()
+    cache = TripGroupCache(settings.group_cache_size)
+    checkpoint = Checkpoint()
+    processed = 0
     try:
-        total_rows = _count_rows(file_path)
         with get_sync_session() as session:
-            update_ingestion_job(session, job_id, status="running", total_rows=total_rows, processed_rows=0)
-        notify({"status": "running", "processed_rows": 0, "total_rows": total_rows})
-
-        processed = 0
-        with file_path.open("r", encoding="utf-8") as csvfile:
-            reader = csv.DictReader(csvfile)
-            buffer: List[dict] = []
-            for record in reader:
-                buffer.append(record)
-                if len(buffer) >= settings.ingestion_chunk_size:
-                    with get_sync_session() as session:
-                        _persist_chunk(session, buffer)
-                        processed += len(buffer)
-                        update_ingestion_job(session, job_id, processed_rows=processed)
-                    notify({"status": "running", "processed_rows": processed, "total_rows": total_rows})
-                    buffer.clear()
-            if buffer:
+            job = update_ingestion_job(session, job_id, status="running")
+            checkpoint = Checkpoint(job.processed_bytes or 0, job.processed_rows or 0)
+            grouping_mode = job.grouping_mode
+            strategy = get_clustering_strategy(job.clustering)
+        chunks, total_bytes, total_rows = open_source(timings, checkpoint)
+        with get_sync_session() as session:
+            update_ingestion_job(
+                session,
+                job_id,
+                total_bytes=total_bytes,
+                message=f"Resumed from row {checkpoint.rows}" if checkpoint.rows else None,
+            )
+        notify(
+            {
+                "status": "running",
+                "processed_rows": checkpoint.rows,
+                "processed_bytes": checkpoint.offset,
+                "total_bytes": total_bytes,
+            }
+        )
+
+        processed = checkpoint.rows
+        processed_bytes = checkpoint.offset
+        loader = get_loader(sync_engine.dialect.name)
+        partitioned = partition_mode(sync_engine.dialect.name) != "none"
+        bulk_load = settings.ingestion_bulk_load and not partitioned
+        with closing(chunks), _deferred_trip_indexes(bulk_load, timings), metrics.collecting(timings):
+            for chunk in chunks:
+                if job_id in _cancel_requested:
+                    raise JobCancelledError(f"Cancelled after {processed} rows")
+                if total_rows is None and total_bytes:
+                    # Extrapolate the row count from the first chunk's average row width.
+                    chunk_bytes = max(chunk.end_offset - chunk.start_offset, 1)
+                    remaining = round(chunk.row_count * (total_bytes - chunk.start_offset) / chunk_bytes)
+                    total_rows = processed + remaining
+                write_start = time.perf_counter()
+                round_trips_before = metrics.round_trips()
+                cache_before = (cache.hits, cache.misses)
+                if partitioned:
+                    # New partitions are created in their own transaction, before the chunk's.
+                    ensure_partitions(sync_engine, chunk_partitions(chunk.columns))
                 with get_sync_session() as session:
-                    _persist_chunk(session, buffer)
-                    processed += len(buffer)
-                    update_ingestion_job(session, job_id, processed_rows=processed)
-                notify({"status": "running", "processed_rows": processed, "total_rows": total_rows})
+                    # A chunk already in the ledger was committed by an earlier attempt; skip its rows.
+                    touched: Dict[str, Set[str]] = {}
+                    if record_ingestion_chunk(
+                        session, job_id, chunk.start_offset, chunk.end_offset, chunk.row_count
+                    ):
+                        touched = _persist_chunk(session, chunk, cache, loader, grouping_mode, strategy)
+                    processed += chunk.row_count
+                    processed_bytes = chunk.end_offset
+                    update_ingestion_job(
+                        session,
+                        job_id,
+                        total_rows=total_rows,
+                        processed_rows=processed,
+                        processed_bytes=processed_bytes,
+                        group_cache_hits=cache.hits,
+                        group_cache_misses=cache.misses,
+                        **timings.as_dict(),
+                    )
+                    commit_start = time.perf_counter()
+                timings.add("commit", time.perf_counter() - commit_start)
+                round_trips = metrics.round_trips() - round_trips_before
+                _observe_chunk(timings, chunk.row_count, round_trips, cache, cache_before)
+                # The chunk is committed; cached results reading its regions and cells are stale.
+                if touched:
+                    analytics_cache.invalidate(touched_tags(touched))
+                timings.add("write", time.perf_counter() - write_start)
+                notify(
+                    {
+                        "status": "running",
+                        "processed_rows": processed,
+                        "total_rows": total_rows,
+                        "processed_bytes": processed_bytes,
+                        "total_bytes": total_bytes,
+                    }
+                )
+        total_bytes = total_bytes or processed_bytes
         with get_sync_session() as session:
-            update_ingestion_job(session, job_id, status="completed", processed_rows=processed)
-        notify({"status": "completed", "processed_rows": processed, "total_rows": total_rows})
+            update_ingestion_job(
+                session,
+                job_id,
+                status="completed",
+                total_rows=processed,
+                processed_rows=processed,
+                total_bytes=total_bytes,
+                processed_bytes=total_bytes,
+                metrics=_finish_metrics(timings, "completed", processed - checkpoint.rows, run_start, cache),
+                **timings.as_dict(),
+            )
+            clear_ingestion_chunks(session, job_id)
+        notify(
+            {
+                "status": "completed",
+                "processed_rows": processed,
+                "total_rows": processed,
+                "processed_bytes": total_bytes,
+                "total_bytes": total_bytes,
+                "group_cache_hits": cache.hits,
+                "group_cache_misses": cache.misses,
+                **timings.as_dict(),
+            }
+        )
     except Exception as exc:  # noqa: BLE001
+        status = "cancelled" if isinstance(exc, JobCancelledError) else "failed"
+        summary = _finish_metrics(timings, status, processed - checkpoint.rows, run_start, cache)
         with get_sync_session() as session:
-            update_ingestion_job(session, job_id, status="failed", message=str(exc))
-        notify({"status": "failed", "message": str(exc)})
+            update_ingestion_job(session, job_id, status=status, message=str(exc), metrics=summary)
+        notify({"status": status, "message": str(exc)})
+        if isinstance(exc, IngestionError):
+            raise
         raise IngestionError(str(exc)) from exc
+    finally:
+        _cancel_requested.discard(job_id)
+
+
+def _observe_chunk(
+    timings: StageTimings, rows: int, round_trips: int, cache: TripGroupCache, cache_before: Tuple[int, int]
+) -> None:
+    timings.chunks += 1
+    timings.round_trips += round_trips
+    metrics.INGESTED_ROWS.inc(rows)
+    metrics.INGESTED_CHUNKS.inc()
+    metrics.CHUNK_ROUND_TRIPS.observe(round_trips)
+    metrics.GROUP_CACHE.inc(cache.hits - cache_before[0], result="hit")
+    metrics.GROUP_CACHE.inc(cache.misses - cache_before[1], result="miss")
+
+
+def _finish_metrics(
+    timings: StageTimings, status: str, rows: int, run_start: float, cache: TripGroupCache
+) -> Optional[dict]:
+    summary = timings.summary(rows, time.perf_counter() - run_start, cache)
+    metrics.JOBS.inc(status=status)
+    if summary is not None:
+        metrics.ROWS_PER_SECOND.set(summary["rows_per_second"])
+    return summary
+
+
+@contextmanager
+def _deferred_trip_indexes(enabled: bool, timings: StageTimings) -> Iterator[None]:
+    """With ``INGESTION_BULK_LOAD``, drop the ``trips`` indexes for the job and rebuild them once at its end."""
+    if not enabled:
+        yield
+        return
+    with sync_engine.begin() as connection:
+        drop_trip_indexes(connection)
+    try:
+        yield
+    finally:
+        start = time.perf_counter()
+        with sync_engine.begin() as connection:
+            create_trip_indexes(connection)
+        timings.add("write", time.perf_counter() - start)
+
+
+def _pipelined_chunks(
+    blocks: Iterator[Union[RawBlock, BatchBlock]],
+    parse: Callable[[Any], ParsedChunk],
+    timings: StageTimings,
+) -> Generator[ParsedChunk, None, None]:
+    return _pipeline(
+        timings.timed_iter("read", blocks),
+        (timings.timed("parse", parse),),
+        settings.ingestion_queue_depth,
+    )
+
+
+def _open_file_source(file_path: Path, timings: StageTimings, checkpoint: Checkpoint) -> ChunkSource:
+    input_format = detect_format(file_path.name) or CSV
+    workers = settings.ingestion_workers
+    if input_format == PARQUET:
+        metadata = open_parquet(file_path).metadata
+        row_groups = range(metadata.num_row_groups)
+        total_bytes = sum(metadata.row_group(index).total_byte_size for index in row_groups)
+        if workers > 1:
+            tasks = ((_parse_row_group, (file_path, index, checkpoint.rows)) for index in row_groups)
+            parsed = timings.timed_iter("parse", _iter_parallel(tasks, workers))
+            chunks = _pipeline(parsed, (), settings.ingestion_queue_depth)
+        else:
+            blocks = _iter_batch_blocks(file_path, row_groups, checkpoint.rows)
+            chunks = _pipelined_chunks(blocks, _parse_batch_block, timings)
+        return ChunkSource(chunks, total_bytes, metadata.num_rows)
+    if input_format == CSV and workers > 1:
+        # Shards are read and parsed together in the worker processes.
+        parsed = timings.timed_iter("parse", _iter_chunks_parallel(file_path, workers, checkpoint.offset))
+        return ChunkSource(_pipeline(parsed, (), settings.ingestion_queue_depth), file_path.stat().st_size)
+    # Compressed CSV cannot be split into byte ranges, so it is decompressed as a single stream;
+    # its offsets count decompressed bytes, whose total is unknown until the end.
+    chunks = _pipelined_chunks(_iter_blocks(file_path, input_format, checkpoint), _parse_block, timings)
+    return ChunkSource(chunks, file_path.stat().st_size if input_format == CSV else None)
+
+
+def _ingest_file(job_id: int, file_path: Path, loop: asyncio.AbstractEventLoop) -> None:
+    _run_ingestion(job_id, partial(_open_file_source, file_path), loop)
+
+
+def _open_stream_source(
+    pieces: Iterator[bytes],
+    input_format: str,
+    total_bytes: Optional[int],
+    timings: StageTimings,
+    checkpoint: Checkpoint,
+) -> ChunkSource:
+    # A new stream always starts from the beginning; interrupted streams are resumed from their tee file.
+    lines = _split_lines(decompress_pieces(pieces, input_format))
+    chunks = _pipelined_chunks(_iter_line_blocks(lines), _parse_block, timings)
+    return ChunkSource(chunks, total_bytes if input_format == CSV else None)
+
+
+def _ingest_stream(
+    job_id: int,
+    feed: StreamFeed,
+    input_format: str,
+    total_bytes: Optional[int],
+    tee_path: Optional[Path],
+    loop: asyncio.AbstractEventLoop,
+) -> None:
+    pieces: Iterator[bytes] = iter(feed)
+    if tee_path is not None:
+        pieces = _tee(pieces, tee_path)
+    try:
+        _run_ingestion(job_id, partial(_open_stream_source, pieces, input_format, total_bytes), loop)
+    finally:
+        feed.stop()
 
 
 async def ingest_file(job_id: int, file_path: Path) -> None:
     loop = asyncio.get_running_loop()
     bound_ingest = partial(_ingest_file, job_id, file_path, loop)
-    await loop.run_in_executor(None, bound_ingest)
+    _active_jobs.add(job_id)
+    try:
+        await loop.run_in_executor(None, bound_ingest)
+    finally:
+        _active_jobs.discard(job_id)
+
+
+class IngestionScheduler:
+    """Runs queued ``ingestion_jobs`` rows on a fixed number of worker slots.
+
+    The queue lives in the database (``status="queued"``), so it survives restarts;
+    jobs are claimed by priority, then by the time they were queued. The dispatcher
+    runs while there is queued work and is restarted by ``start`` when jobs arrive.
+    Streamed uploads cannot wait in the queue and take a free slot directly.
+    """
+
+    def __init__(self, workers: int, max_queued: int) -> None:
+        self.workers = workers
+        self.max_queued = max_queued
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._tasks: Set[asyncio.Task] = set()
+        # Set by ``start`` so a dispatcher whose claim found nothing checks again before exiting.
+        self._work_arrived = False
+
+    def start(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._slots = asyncio.Semaphore(self.workers)
+            self._dispatcher = None
+        self._work_arrived = True
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = loop.create_task(self._dispatch())
+
+    async def stop(self) -> None:
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            await asyncio.gather(self._dispatcher, return_exceptions=True)
+            self._dispatcher = None
 
+    @property
+    def running(self) -> int:
+        return len(_active_jobs)
 
-async def schedule_ingestion(file_path: Path) -> int:
-    with get_sync_session() as session:
-        job = create_ingestion_job(session, filename=file_path.name)
-        job_id = job.id
-    asyncio.create_task(ingest_file(job_id, file_path))
+    async def check_capacity(self) -> None:
+        queued = await asyncio.to_thread(_count_queued_jobs)
+        if queued >= self.max_queued:
+            raise QueueFullError(
+                f"The ingestion queue is full ({queued} jobs waiting)", settings.ingestion_retry_after_seconds
+            )
+
+    async def submit(
+        self,
+        file_path: Path,
+        grouping_mode: Optional[str] = None,
+        priority: int = 0,
+        clustering: Optional[str] = None,
+    ) -> int:
+        await self.check_capacity()
+        job_id = await asyncio.to_thread(_enqueue_job, file_path, grouping_mode, priority, clustering)
+        self.start()
+        return job_id
+
+    async def requeue(self, job_id: int) -> None:
+        await asyncio.to_thread(_requeue_job, job_id)
+        self.start()
+
+    async def acquire_slot(self) -> None:
+        """Take a worker slot immediately or raise ``QueueFullError``."""
+        if self._loop is not asyncio.get_running_loop():
+            self.start()
+        if self._slots.locked():
+            raise QueueFullError("All ingestion workers are busy", settings.ingestion_retry_after_seconds)
+        await self._slots.acquire()
+
+    def release_slot(self) -> None:
+        self._slots.release()
+
+    async def cancel(self, job_id: int) -> str:
+        """Cancel a queued job, or ask a running one to stop after its current chunk."""
+        # Running jobs are flagged in memory; their worker checks between chunks.
+        if job_id in _active_jobs:
+            _cancel_requested.add(job_id)
+            return "cancelling"
+        cancelled, status = await asyncio.to_thread(_cancel_queued_job, job_id)
+        if cancelled:
+            return "cancelled"
+        if job_id in _active_jobs:
+            _cancel_requested.add(job_id)
+            return "cancelling"
+        raise JobNotResumableError(f"Ingestion job {job_id} is {status} and cannot be cancelled")
+
+    async def stats(self) -> Dict[str, float]:
+        queued, oldest, waits = await asyncio.to_thread(_queue_waits)
+        return {
+            "workers": self.workers,
+            "running": self.running,
+            "queue_depth": queued,
+            "max_queued": self.max_queued,
+            "oldest_wait_seconds": (datetime.utcnow() - oldest).total_seconds() if oldest else 0.0,
+            "average_wait_seconds": sum(waits) / len(waits) if waits else 0.0,
+        }
+
+    async def _dispatch(self) -> None:
+        while True:
+            await self._slots.acquire()
+            self._work_arrived = False
+            claimed = await asyncio.to_thread(_claim_next_job)
+            if claimed is None:
+                self._slots.release()
+                # A job queued while the claim ran may have committed after its query.
+                if self._work_arrived:
+                    continue
+                return
+            _active_jobs.add(claimed[0])
+            task = asyncio.create_task(self._run(*claimed))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, job_id: int, source_path: Optional[str]) -> None:
+        try:
+            if not source_path or not Path(source_path).exists():
+                await asyncio.to_thread(_fail_job, job_id, f"The upload for ingestion job {job_id} is missing")
+                return
+            await ingest_file(job_id, Path(source_path))
+        except IngestionError:
+            pass  # Recorded on the job row.
+        finally:
+            _active_jobs.discard(job_id)
+            self._slots.release()
+
+
+# Blocking job queue queries, run in worker threads so they never stall the event loop.
+
+
+def _count_queued_jobs() -> int:
+    with get_queue_session() as session:
+        return count_queued_ingestion_jobs(session)
+
+
+def _queue_waits() -> Tuple[int, Optional[datetime], List[float]]:
+    with get_queue_session() as session:
+        return (count_queued_ingestion_jobs(session), *ingestion_queue_waits(session))
+
+
+def _enqueue_job(file_path: Path, grouping_mode: Optional[str], priority: int, clustering: Optional[str]) -> int:
+    with get_queue_session() as session:
+        return enqueue_ingestion_job(
+            session,
+            file_path.name,
+            str(file_path),
+            grouping_mode=grouping_mode,
+            priority=priority,
+            clustering=clustering,
+        ).id
+
+
+def _requeue_job(job_id: int) -> None:
+    with get_queue_session() as session:
+        requeue_ingestion_job(session, job_id)
+
+
+def _cancel_queued_job(job_id: int) -> Tuple[bool, str]:
+    """Cancel ``job_id`` if it is queued; returns whether it was and the status it had."""
+    with get_queue_session() as session:
+        job = session.get(IngestionJob, job_id)
+        if job is None:
+            raise LookupError(f"Ingestion job {job_id} not found")
+        status = job.status
+        return status == "queued" and cancel_queued_ingestion_job(session, job_id), status
+
+
+def _claim_next_job() -> Optional[Tuple[int, Optional[str]]]:
+    with get_queue_session() as session:
+        job = claim_next_ingestion_job(session)
+        return (job.id, job.source_path) if job else None
+
+
+def _fail_job(job_id: int, message: str) -> None:
+    with get_queue_session() as session:
+        update_ingestion_job(session, job_id, status="failed", message=message)
+
+
+def _job_status(job_id: int) -> Tuple[str, Optional[str]]:
+    with get_queue_session() as session:
+        job = session.get(IngestionJob, job_id)
+        if job is None:
+            raise LookupError(f"Ingestion job {job_id} not found")
+        return job.status, job.source_path
+
+
+def _orphaned_job_ids() -> List[int]:
+    with get_queue_session() as session:
+        return [job.id for job in list_resumable_jobs(session) if job.id not in _active_jobs]
+
+
+def _create_stream_job(
+    filename: str, grouping_mode: Optional[str], source_path: Optional[str], clustering: Optional[str]
+) -> int:
+    with get_queue_session() as session:
+        return create_ingestion_job(
+            session, filename=filename, grouping_mode=grouping_mode, source_path=source_path, clustering=clustering
+        ).id
+
+
+scheduler = IngestionScheduler(settings.ingestion_max_concurrent_jobs, settings.ingestion_max_queued_jobs)
+
+
+async def schedule_ingestion(
+    file_path: Path, grouping_mode: Optional[str] = None, priority: int = 0, clustering: Optional[str] = None
+) -> int:
+    """Queue ``file_path`` for ingestion; raises ``QueueFullError`` when the queue is full."""
+    return await scheduler.submit(file_path, grouping_mode=grouping_mode, priority=priority, clustering=clustering)
+
+
+async def resume_ingestion(job_id: int) -> None:
+    """Queue ``job_id`` again so it continues from its last committed checkpoint."""
+    status, source_path = await asyncio.to_thread(_job_status, job_id)
+    if job_id in _active_jobs or status == "queued":
+        raise JobNotResumableError(f"Ingestion job {job_id} is already {status}")
+    if status == "completed":
+        raise JobNotResumableError(f"Ingestion job {job_id} has already completed")
+    if not source_path or not Path(source_path).exists():
+        raise JobNotResumableError(f"The upload for ingestion job {job_id} is no longer on disk")
+    await scheduler.requeue(job_id)
+
+
+async def resume_orphaned_jobs() -> List[int]:
+    """Requeue jobs a previous process left ``pending`` or ``running``; fail those that cannot be resumed.
+
+    Assumes a single API process owns ingestion, since any unfinished job not running
+    here is treated as orphaned.
+    """
+    resumed = []
+    for job_id in await asyncio.to_thread(_orphaned_job_ids):
+        try:
+            await resume_ingestion(job_id)
+        except JobNotResumableError as exc:
+            await asyncio.to_thread(_fail_job, job_id, str(exc))
+        else:
+            resumed.append(job_id)
+    return resumed
+
+
+async def stream_ingestion(
+    body: AsyncIterator[bytes],
+    filename: str,
+    *,
+    total_bytes: Optional[int] = None,
+    tee_path: Optional[Path] = None,
+    grouping_mode: Optional[str] = None,
+    clustering: Optional[str] = None,
+) -> int:
+    """Ingest a CSV while it is still being received.
+
+    Body pieces are handed to the ingestion thread through a bounded ``StreamFeed``;
+    the coroutine returns once the body has been consumed, while the last chunks
+    may still be committing. ``tee_path`` keeps a copy of the raw upload for replay.
+    """
+    input_format = detect_format(filename) or CSV
+    if input_format == PARQUET:
+        raise ValueError("Parquet uploads need random access and cannot be streamed")
+    await scheduler.acquire_slot()
+    try:
+        job_id = await asyncio.to_thread(
+            _create_stream_job, filename, grouping_mode, str(tee_path) if tee_path else None, clustering
+        )
+    except BaseException:
+        scheduler.release_slot()
+        raise
+    loop = asyncio.get_running_loop()
+    feed = StreamFeed(settings.ingestion_stream_queue_size)
+    task = loop.run_in_executor(
+        None, partial(_ingest_stream, job_id, feed, input_format, total_bytes, tee_path, loop)
+    )
+    _active_jobs.add(job_id)
+    task.add_done_callback(lambda future: _active_jobs.discard(job_id))
+    task.add_done_callback(lambda future: scheduler.release_slot())
+    # Retrieve the failure so it is not reported as never retrieved; the job row records it.
+    task.add_done_callback(lambda future: future.cancelled() or future.exception())
+    try:
+        async for piece in body:
+            if piece:
+                await feed.put(piece)
+    except BaseException as exc:
+        await feed.abort(exc)
+        raise
+    await feed.close()
     return job_id
@@ -0,0 +1,197 @@
+from __future__ import annotations
+
+import csv
+import io
+import struct
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import Dict, Optional, Sequence, Tuple, Type
+
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+
+from .config import settings
+from .crud import bulk_insert_trips
+from .models import Trip
+
+TRIP_COLUMNS = (
+    "region",
+    "origin_lat",
+    "origin_lng",
+    "destination_lat",
+    "destination_lng",
+    "started_at",
+    "datasource",
+    "group_id",
+    "origin_cell",
+)
+
+TripRow = Tuple[str, float, float, float, float, datetime, str, int, int]
+
+_PG_EPOCH = datetime(2000, 1, 1)
+_PGCOPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+_PGCOPY_TRAILER = struct.pack(">h", -1)
+_PGCOPY_NULL = struct.pack(">i", -1)
+
+
+class _CsvNull(float):
+    """Written by ``csv`` as a bare empty field, which ``COPY ... (FORMAT csv)`` reads as NULL."""
+
+    def __str__(self) -> str:
+        return ""
+
+
+_CSV_NULL = _CsvNull()
+
+
+class TripLoader(ABC):
+    """Writes parsed trip rows (in ``TRIP_COLUMNS`` order) into the ``trips`` table."""
+
+    name = "base"
+
+    @abstractmethod
+    def load(self, session: Session, rows: Sequence[TripRow]) -> None:
+        ...
+
+
+class OrmLoader(TripLoader):
+    name = "orm"
+
+    def load(self, session: Session, rows: Sequence[TripRow]) -> None:
+        bulk_insert_trips(session, [Trip(**dict(zip(TRIP_COLUMNS, row))) for row in rows])
+
+
+class CoreInsertLoader(TripLoader):
+    name = "core"
+
+    def load(self, session: Session, rows: Sequence[TripRow]) -> None:
+        if not rows:
+            return
+        session.execute(insert(Trip.__table__), [dict(zip(TRIP_COLUMNS, row)) for row in rows])
+
+
+class CopyCsvLoader(TripLoader):
+    name = "copy_csv"
+
+    def load(self, session: Session, rows: Sequence[TripRow]) -> None:
+        if not rows:
+            return
+        buffer = io.StringIO(encode_copy_csv(rows))
+        _copy_expert(session, f"COPY trips ({', '.join(TRIP_COLUMNS)}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+class CopyBinaryLoader(TripLoader):
+    name = "copy_binary"
+
+    def load(self, session: Session, rows: Sequence[TripRow]) -> None:
+        if not rows:
+            return
+        buffer = io.BytesIO(encode_copy_binary(rows))
+        _copy_expert(session, f"COPY trips ({', '.join(TRIP_COLUMNS)}) FROM STDIN WITH (FORMAT binary)", buffer)
+
+
+def encode_copy_csv(rows: Sequence[TripRow]) -> str:
+    """``COPY ... (FORMAT csv)`` input for ``rows``.
+
+    Strings and timestamps are always quoted, since COPY reads a bare empty field as NULL; ``None`` is
+    written as one.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, quoting=csv.QUOTE_NONNUMERIC)
+    for row in rows:
+        if None in row:
+            row = tuple(_CSV_NULL if value is None else value for value in row)
+        # ``str`` of a datetime is its ISO format with a space, which COPY parses as a timestamp.
+        writer.writerow(row)
+    return buffer.getvalue()
+
+
+def encode_copy_binary(rows: Sequence[TripRow]) -> bytes:
+    """``COPY ... (FORMAT binary)`` input for ``rows``: big-endian fields, each prefixed by its length."""
+    buffer = io.BytesIO()
+    buffer.write(_PGCOPY_HEADER)
+    pack_row = struct.Struct(">hi").pack
+    pack_floats = struct.Struct(">idididid").pack
+    pack_timestamp = struct.Struct(">iq").pack
+    pack_int = struct.Struct(">ii").pack
+    pack_bigint = struct.Struct(">iq").pack
+    pack_length = struct.Struct(">i").pack
+    for row in rows:
+        if None in row:
+            buffer.write(_encode_binary_row_with_nulls(row))
+            continue
+        (
+            region,
+            origin_lat,
+            origin_lng,
+            destination_lat,
+            destination_lng,
+            started_at,
+            datasource,
+            group_id,
+            origin_cell,
+        ) = row
+        region_bytes = region.encode("utf-8")
+        datasource_bytes = datasource.encode("utf-8")
+        buffer.write(pack_row(len(TRIP_COLUMNS), len(region_bytes)))
+        buffer.write(region_bytes)
+        buffer.write(pack_floats(8, origin_lat, 8, origin_lng, 8, destination_lat, 8, destination_lng))
+        buffer.write(pack_timestamp(8, _pg_timestamp(started_at)))
+        buffer.write(pack_length(len(datasource_bytes)))
+        buffer.write(datasource_bytes)
+        buffer.write(pack_int(4, group_id))
+        buffer.write(pack_bigint(8, origin_cell))
+    buffer.write(_PGCOPY_TRAILER)
+    return buffer.getvalue()
+
+
+def _pg_timestamp(value: datetime) -> int:
+    """Microseconds since PostgreSQL's 2000-01-01 epoch."""
+    delta = value - _PG_EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1_000_000 + delta.microseconds
+
+
+def _encode_binary_row_with_nulls(row: Sequence[object]) -> bytes:
+    """One binary COPY row field by field, writing ``None`` as a NULL (length -1)."""
+    fields = [struct.pack(">h", len(TRIP_COLUMNS))]
+    for column, value in zip(TRIP_COLUMNS, row):
+        if value is None:
+            fields.append(_PGCOPY_NULL)
+        elif column in ("region", "datasource"):
+            encoded = value.encode("utf-8")
+            fields.append(struct.pack(">i", len(encoded)) + encoded)
+        elif column == "started_at":
+            fields.append(struct.pack(">iq", 8, _pg_timestamp(value)))
+        elif column == "group_id":
+            fields.append(struct.pack(">ii", 4, value))
+        elif column == "origin_cell":
+            fields.append(struct.pack(">iq", 8, value))
+        else:
+            fields.append(struct.pack(">id", 8, value))
+    return b"".join(fields)
+
+
+def _copy_expert(session: Session, sql: str, buffer: io.IOBase) -> None:
+    dbapi_connection = session.connection().connection.dbapi_connection
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.copy_expert(sql, buffer)
+    finally:
+        cursor.close()
+
+
+LOADERS: Dict[str, Type[TripLoader]] = {
+    loader.name: loader for loader in (OrmLoader, CoreInsertLoader, CopyCsvLoader, CopyBinaryLoader)
+}
+
+
+def get_loader(dialect: str, name: Optional[str] = None) -> TripLoader:
+    """Pick the loader for ``dialect``; COPY loaders fall back to Core inserts outside PostgreSQL."""
+    name = name or settings.ingestion_loader
+    if name == "auto":
+        name = "copy_csv" if dialect == "postgresql" else "core"
+    if name.startswith("copy_") and dialect != "postgresql":
+        name = "core"
+    if name not in LOADERS:
+        raise ValueError(f"Unknown ingestion loader: {name}")
+    return LOADERS[name]()
@@ -2,58 +2,191 @@ from __future__ import annotations
 
 import asyncio
 import shutil
+from datetime import datetime
 from pathlib import Path
-from typing import Optional
+from typing import List, Literal, Optional
 from uuid import uuid4
 
-from fastapi import FastAPI, File, HTTPException, UploadFile, WebSocket, WebSocketDisconnect
-from fastapi.responses import JSONResponse
+from fastapi import Depends, FastAPI, File, HTTPException, Query, Request, UploadFile, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, PlainTextResponse, Response
+from sqlalchemy.ext.asyncio import AsyncSession
 
+from . import metrics
+from .cache import analytics_cache, bbox_prefixes, cache_key, scope_tags
 from .config import settings
-from .crud import compute_weekly_average, list_trip_groups
-from .db import get_sync_session, sync_engine
-from .ingestion import schedule_ingestion
+from .clustering import from_epoch_seconds
+from .crud import (
+    add_missing_columns,
+    backfill_weekly_rollup,
+    compute_weekly_average,
+    create_trip_indexes,
+    drop_legacy_trip_indexes,
+    list_trip_group_rollups,
+    list_trip_groups,
+    sync_group_rollup_levels,
+)
+from .db import async_engine, get_async_session, get_sync_session, sync_engine
+from .formats import PARQUET, SUPPORTED_SUFFIXES, detect_format, ensure_available
+from .ingestion import (
+    JobNotResumableError,
+    QueueFullError,
+    resume_ingestion,
+    resume_orphaned_jobs,
+    schedule_ingestion,
+    scheduler,
+    stream_ingestion,
+)
 from .models import Base, IngestionJob
 from .notifications import manager
-from .schemas import TripGroupListResponse, WeeklyAverageResponse
+from .partitioning import create_trip_storage
+from .schemas import (
+    AnalyticsCacheStats,
+    IngestionJobRead,
+    IngestionQueueStats,
+    TripGroupListResponse,
+    TripGroupRead,
+    TripGroupRollupRead,
+    TripGroupRollupResponse,
+    WeeklyAverageResponse,
+)
 
 app = FastAPI(title=settings.app_name)
 
+MAX_TRIP_GROUP_PAGE = 500
+
 
 @app.on_event("startup")
 async def startup() -> None:
+    create_trip_storage(sync_engine)
     Base.metadata.create_all(bind=sync_engine)
+    with sync_engine.begin() as connection:
+        add_missing_columns(connection)
+        drop_legacy_trip_indexes(connection)
+        # A bulk load interrupted by a crash leaves ``trips`` without its indexes.
+        create_trip_indexes(connection)
+    with get_sync_session() as session:
+        # Trips ingested before the rollups existed, or before the rollup levels changed, are folded in.
+        backfill_weekly_rollup(session)
+        sync_group_rollup_levels(session)
+    if settings.resume_jobs_on_startup:
+        await resume_orphaned_jobs()
+    scheduler.start()
+
+
+@app.on_event("shutdown")
+async def shutdown() -> None:
+    await scheduler.stop()
+    await async_engine.dispose()
+
+
+@app.exception_handler(QueueFullError)
+async def queue_full_handler(request: Request, exc: QueueFullError) -> JSONResponse:
+    return JSONResponse(
+        status_code=429, content={"detail": str(exc)}, headers={"Retry-After": str(exc.retry_after)}
+    )
+
+
+def _check_upload_format(filename: str) -> str:
+    input_format = detect_format(filename)
+    if input_format is None:
+        raise HTTPException(status_code=400, detail=f"Supported uploads: {', '.join(SUPPORTED_SUFFIXES)}")
+    try:
+        ensure_available(input_format)
+    except RuntimeError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+    return input_format
 
 
 @app.post("/ingest")
-async def ingest_data(file: UploadFile = File(...)) -> JSONResponse:
-    if not file.filename.endswith(".csv"):
-        raise HTTPException(status_code=400, detail="Only CSV uploads are supported")
+async def ingest_data(
+    file: UploadFile = File(...),
+    grouping: Optional[Literal["cache", "staging"]] = None,
+    priority: int = 0,
+    clustering: Optional[Literal["exact", "neighbor"]] = None,
+) -> JSONResponse:
+    _check_upload_format(file.filename)
+    # Refuse before copying the upload to disk; schedule_ingestion checks again.
+    await scheduler.check_capacity()
     destination = settings.data_dir / f"{uuid4().hex}_{Path(file.filename).name}"
     destination.parent.mkdir(parents=True, exist_ok=True)
     with destination.open("wb") as buffer:
         await asyncio.to_thread(shutil.copyfileobj, file.file, buffer)
-    job_id = await schedule_ingestion(destination)
+    try:
+        job_id = await schedule_ingestion(
+            destination, grouping_mode=grouping, priority=priority, clustering=clustering
+        )
+    except QueueFullError:
+        destination.unlink(missing_ok=True)
+        raise
     return JSONResponse({"job_id": job_id, "message": "Ingestion scheduled", "filename": destination.name})
 
 
-@app.get("/jobs/{job_id}")
-async def get_job(job_id: int) -> JSONResponse:
-    with get_sync_session() as session:
-        job = session.get(IngestionJob, job_id)
-        if not job:
-            raise HTTPException(status_code=404, detail="Job not found")
-        payload = {
-            "id": job.id,
-            "filename": job.filename,
-            "status": job.status,
-            "created_at": job.created_at,
-            "updated_at": job.updated_at,
-            "total_rows": job.total_rows,
-            "processed_rows": job.processed_rows,
-            "message": job.message,
+@app.post("/ingest/stream")
+async def ingest_stream(
+    request: Request,
+    filename: str = "upload.csv",
+    tee: Optional[bool] = None,
+    grouping: Optional[Literal["cache", "staging"]] = None,
+    clustering: Optional[Literal["exact", "neighbor"]] = None,
+) -> JSONResponse:
+    """Ingest a raw CSV request body while it is being uploaded."""
+    if _check_upload_format(filename) == PARQUET:
+        raise HTTPException(status_code=400, detail="Parquet uploads cannot be streamed; use /ingest")
+    tee_path = None
+    if settings.ingestion_stream_tee if tee is None else tee:
+        tee_path = settings.data_dir / f"{uuid4().hex}_{Path(filename).name}"
+        tee_path.parent.mkdir(parents=True, exist_ok=True)
+    content_length = request.headers.get("content-length")
+    job_id = await stream_ingestion(
+        request.stream(),
+        Path(filename).name,
+        total_bytes=int(content_length) if content_length else None,
+        tee_path=tee_path,
+        grouping_mode=grouping,
+        clustering=clustering,
+    )
+    return JSONResponse(
+        {
+            "job_id": job_id,
+            "message": "Upload received; ingestion is finishing",
+            "filename": tee_path.name if tee_path else None,
         }
-    return JSONResponse(payload)
+    )
+
+
+@app.get("/jobs/queue", response_model=IngestionQueueStats)
+async def get_queue_stats() -> IngestionQueueStats:
+    return IngestionQueueStats(**await scheduler.stats())
+
+
+@app.get("/jobs/{job_id}", response_model=IngestionJobRead)
+async def get_job(job_id: int, session: AsyncSession = Depends(get_async_session)) -> IngestionJobRead:
+    job = await session.get(IngestionJob, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return IngestionJobRead.from_orm(job)
+
+
+@app.post("/jobs/{job_id}/resume")
+async def resume_job(job_id: int) -> JSONResponse:
+    try:
+        await resume_ingestion(job_id)
+    except LookupError as exc:
+        raise HTTPException(status_code=404, detail="Job not found") from exc
+    except JobNotResumableError as exc:
+        raise HTTPException(status_code=409, detail=str(exc)) from exc
+    return JSONResponse({"job_id": job_id, "message": "Ingestion resumed"})
+
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: int) -> JSONResponse:
+    try:
+        status = await scheduler.cancel(job_id)
+    except LookupError as exc:
+        raise HTTPException(status_code=404, detail="Job not found") from exc
+    except JobNotResumableError as exc:
+        raise HTTPException(status_code=409, detail=str(exc)) from exc
+    return JSONResponse({"job_id": job_id, "status": status})
 
 
 @app.websocket("/ws/ingestion/{job_id}")
@@ -66,51 +199,161 @@ async def websocket_endpoint(websocket: WebSocket, job_id: int) -> None:
         manager.disconnect(job_id, websocket)
 
 
+def _json_response(content: bytes) -> Response:
+    """Cached results are stored encoded, so they skip response model validation and serialisation."""
+    return Response(content=content, media_type="application/json")
+
+
+def _regions(region: Optional[str]) -> Optional[List[str]]:
+    return None if region is None else [region]
+
+
+def _prefixes(geohash_prefix: Optional[str]) -> Optional[List[str]]:
+    return None if geohash_prefix is None else [geohash_prefix]
+
+
 @app.get("/trip-groups", response_model=TripGroupListResponse)
-def get_trip_groups(limit: int = 50) -> TripGroupListResponse:
-    with get_sync_session() as session:
-        rows = list_trip_groups(session, limit=limit)
-    groups = [
-        {
-            "id": group.id,
-            "region": group.region,
-            "origin_geohash": group.origin_geohash,
-            "destination_geohash": group.destination_geohash,
-            "time_bucket_start": group.time_bucket_start,
-            "time_bucket_minutes": group.time_bucket_minutes,
-            "trip_count": count,
-        }
-        for group, count in rows
-    ]
-    return TripGroupListResponse(groups=groups)
+async def get_trip_groups(
+    limit: int = Query(50, ge=1, le=MAX_TRIP_GROUP_PAGE),
+    after_count: Optional[int] = None,
+    after_id: Optional[int] = None,
+    region: Optional[str] = None,
+    bucket_from: Optional[datetime] = None,
+    bucket_to: Optional[datetime] = None,
+    geohash_prefix: Optional[str] = Query(None, pattern="^[0-9b-hjkmnp-z]+$"),
+    session: AsyncSession = Depends(get_async_session),
+) -> Response:
+    if (after_count is None) != (after_id is None):
+        raise HTTPException(status_code=400, detail="after_count and after_id must be given together")
+    params = dict(
+        limit=limit,
+        after_count=after_count,
+        after_id=after_id,
+        region=region,
+        bucket_from=bucket_from,
+        bucket_to=bucket_to,
+        geohash_prefix=geohash_prefix,
+    )
+
+    async def compute() -> bytes:
+        groups = await session.run_sync(list_trip_groups, **params)
+        response = TripGroupListResponse(groups=[TripGroupRead.from_orm(group) for group in groups])
+        if len(groups) == limit:
+            response.next_after_count = groups[-1].trip_count
+            response.next_after_id = groups[-1].id
+        return response.json().encode()
+
+    tags = scope_tags(_regions(region), _prefixes(geohash_prefix))
+    key = cache_key("trip_groups", params)
+    return _json_response(await analytics_cache.get_or_compute("trip_groups", key, tags, compute))
+
+
+@app.get("/trip-groups/rollup", response_model=TripGroupRollupResponse)
+async def get_trip_group_rollup(
+    geohash_precision: int = Query(settings.geohash_precision, ge=1, le=12),
+    bucket_minutes: int = Query(settings.time_bucket_minutes, ge=1),
+    limit: int = Query(50, ge=1, le=MAX_TRIP_GROUP_PAGE),
+    region: Optional[str] = None,
+    bucket_from: Optional[datetime] = None,
+    bucket_to: Optional[datetime] = None,
+    geohash_prefix: Optional[str] = Query(None, pattern="^[0-9b-hjkmnp-z]+$"),
+    session: AsyncSession = Depends(get_async_session),
+) -> Response:
+    """Trip counts per origin/destination cell pair and time bucket at any resolution the rollup levels nest in."""
+    params = dict(
+        geohash_precision=geohash_precision,
+        bucket_minutes=bucket_minutes,
+        limit=limit,
+        region=region,
+        bucket_from=bucket_from,
+        bucket_to=bucket_to,
+        geohash_prefix=geohash_prefix,
+    )
+
+    async def compute() -> bytes:
+        try:
+            level, rows = await session.run_sync(list_trip_group_rollups, **params)
+        except ValueError as exc:
+            raise HTTPException(status_code=400, detail=str(exc)) from exc
+        bucket_starts = from_epoch_seconds([row.bucket_start for row in rows]).tolist()
+        response = TripGroupRollupResponse(
+            geohash_precision=geohash_precision,
+            bucket_minutes=bucket_minutes,
+            level_geohash_precision=level.geohash_precision,
+            level_bucket_minutes=level.bucket_minutes,
+            groups=[
+                TripGroupRollupRead(
+                    region=row.region,
+                    origin_geohash=row.origin_geohash,
+                    destination_geohash=row.destination_geohash,
+                    time_bucket_start=bucket_start,
+                    time_bucket_minutes=bucket_minutes,
+                    trip_count=row.trip_count,
+                )
+                for row, bucket_start in zip(rows, bucket_starts)
+            ],
+        )
+        return response.json().encode()
+
+    tags = scope_tags(_regions(region), _prefixes(geohash_prefix))
+    key = cache_key("trip_group_rollup", params)
+    return _json_response(await analytics_cache.get_or_compute("trip_group_rollup", key, tags, compute))
 
 
 @app.get("/analytics/weekly-average", response_model=WeeklyAverageResponse)
-def weekly_average(
+async def weekly_average(
     region: Optional[str] = None,
     min_lat: Optional[float] = None,
     max_lat: Optional[float] = None,
     min_lng: Optional[float] = None,
     max_lng: Optional[float] = None,
-) -> WeeklyAverageResponse:
+    session: AsyncSession = Depends(get_async_session),
+) -> Response:
     bbox = None
     if None not in (min_lat, max_lat, min_lng, max_lng):
         if min_lat > max_lat or min_lng > max_lng:
             raise HTTPException(status_code=400, detail="Invalid bounding box coordinates")
         bbox = (min_lat, min_lng, max_lat, max_lng)
-    with get_sync_session() as session:
-        weekly_avg, total_trips, week_count = compute_weekly_average(session, region=region, bbox=bbox)
-    if total_trips == 0:
-        raise HTTPException(status_code=404, detail="No trips found for the specified filters")
-    area_description = region or f"BBox({min_lat},{min_lng})-({max_lat},{max_lng})"
-    return WeeklyAverageResponse(
-        area_description=area_description,
-        weekly_average=weekly_avg,
-        total_trips=total_trips,
-        week_count=week_count,
+
+    async def compute() -> bytes:
+        weekly_avg, total_trips, week_count = await session.run_sync(compute_weekly_average, region=region, bbox=bbox)
+        if total_trips == 0:
+            raise HTTPException(status_code=404, detail="No trips found for the specified filters")
+        area_description = region or f"BBox({min_lat},{min_lng})-({max_lat},{max_lng})"
+        return WeeklyAverageResponse(
+            area_description=area_description,
+            weekly_average=weekly_avg,
+            total_trips=total_trips,
+            week_count=week_count,
+        ).json().encode()
+
+    tags = scope_tags(_regions(region), bbox_prefixes(*bbox) if bbox else None)
+    params = dict(region=region, min_lat=min_lat, max_lat=max_lat, min_lng=min_lng, max_lng=max_lng)
+    key = cache_key("weekly_average", params)
+    return _json_response(await analytics_cache.get_or_compute("weekly_average", key, tags, compute))
+
+
+@app.get("/cache/stats", response_model=AnalyticsCacheStats)
+async def get_cache_stats() -> AnalyticsCacheStats:
+    """Hit ratio and memory use of the analytics result cache since startup."""
+    stats = analytics_cache.stats()
+    return AnalyticsCacheStats(
+        backend=analytics_cache.backend.name,
+        max_entries=analytics_cache.maxsize,
+        ttl_seconds=analytics_cache.ttl_seconds,
+        hit_ratio=stats.hit_ratio,
+        **stats._asdict(),
     )
 
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint() -> PlainTextResponse:
+    """Ingestion and query metrics in the Prometheus text format."""
+    if not settings.metrics_enabled:
+        raise HTTPException(status_code=404, detail="Metrics are disabled")
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
 @app.get("/health")
 def health() -> dict[str, str]:
     return {"status": "ok"}
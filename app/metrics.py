@@ -0,0 +1,254 @@
+from __future__ import annotations
+
+import math
+import threading
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, Dict, Iterator, List, Optional, Protocol, Sequence, Tuple, TypeVar
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from .config import settings
+
+F = TypeVar("F", bound=Callable)
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+ROUND_TRIP_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+Sample = Tuple[str, Dict[str, str], float]
+
+
+class _Metric(ABC):
+    """A metric family rendered in the Prometheus text format."""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: Dict[str, object]) -> Tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key: Tuple[str, ...]) -> Dict[str, str]:
+        return dict(zip(self.labelnames, key))
+
+    @abstractmethod
+    def samples(self) -> List[Sample]:
+        ...
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: object) -> None:
+        if not settings.metrics_enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def samples(self) -> List[Sample]:
+        with self._lock:
+            return [("", self._labels(key), value) for key, value in sorted(self._values.items())]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels: object) -> None:
+        if not settings.metrics_enabled:
+            return
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        # Per label set: the count in each bucket (the last one is +Inf), then the sum of observations.
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: object) -> None:
+        if not settings.metrics_enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[bisect_left(self.buckets, value)] += 1
+            total[0] += value
+
+    def samples(self) -> List[Sample]:
+        with self._lock:
+            values = [(key, list(counts), total[0]) for key, (counts, total) in sorted(self._values.items())]
+        samples: List[Sample] = []
+        for key, counts, total in values:
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, count in zip((*self.buckets, math.inf), counts):
+                cumulative += count
+                samples.append(("_bucket", {**labels, "le": _format_value(bound)}, cumulative))
+            samples.append(("_sum", labels, total))
+            samples.append(("_count", labels, cumulative))
+        return samples
+
+
+REGISTRY: List[_Metric] = []
+
+
+def render() -> str:
+    """Every registered metric in the Prometheus text exposition format."""
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+STAGE_SECONDS = Histogram(
+    "ingestion_stage_seconds",
+    "Seconds spent per chunk in each ingestion stage; write includes group_lookup, insert, rollup and commit",
+    ["stage"],
+)
+INGESTED_ROWS = Counter("ingestion_rows_total", "Trip rows committed by ingestion jobs")
+INGESTED_CHUNKS = Counter("ingestion_chunks_total", "Chunks committed by ingestion jobs")
+JOBS = Counter("ingestion_jobs_total", "Ingestion jobs finished, by final status", ["status"])
+ROWS_PER_SECOND = Gauge("ingestion_rows_per_second", "Throughput of the most recently finished ingestion job")
+GROUP_CACHE = Counter("ingestion_group_cache_lookups_total", "Trip group cache lookups, by result", ["result"])
+CHUNK_ROUND_TRIPS = Histogram(
+    "ingestion_chunk_db_round_trips", "Database statements executed per committed chunk", buckets=ROUND_TRIP_BUCKETS
+)
+QUERY_SECONDS = Histogram("analytics_query_seconds", "Seconds spent answering an analytics query", ["query"])
+CACHE_REQUESTS = Counter(
+    "analytics_cache_requests_total",
+    "Analytics result cache lookups, by endpoint and result: hit, miss or coalesced",
+    ["endpoint", "result"],
+)
+CACHE_ENTRIES = Gauge("analytics_cache_entries", "Results held by the in-process analytics cache")
+CACHE_BYTES = Gauge("analytics_cache_bytes", "Encoded bytes of the results held by the in-process analytics cache")
+CACHE_EVICTIONS = Counter(
+    "analytics_cache_evictions_total", "Analytics results dropped, by reason: lru, expired or invalidated", ["reason"]
+)
+
+
+class StageCollector(Protocol):
+    def record(self, stage: str, seconds: float) -> None:
+        ...
+
+
+_local = threading.local()
+
+
+@contextmanager
+def collecting(collector: StageCollector) -> Iterator[None]:
+    """Also attribute stages timed on this thread to ``collector``, e.g. one job's totals."""
+    previous = getattr(_local, "collector", None)
+    _local.collector = collector
+    try:
+        yield
+    finally:
+        _local.collector = previous
+
+
+def observe_stage(stage: str, seconds: float) -> None:
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    collector: Optional[StageCollector] = getattr(_local, "collector", None)
+    if collector is not None:
+        collector.record(stage, seconds)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    if not settings.metrics_enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - start)
+
+
+def timed_stage(name: str) -> Callable[[F], F]:
+    """Decorator observing every call of the function as ingestion stage ``name``."""
+
+    def decorator(func: F) -> F:
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not settings.metrics_enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observe_stage(name, time.perf_counter() - start)
+
+        return wrapper  # type: ignore[return-value]
+
+    return decorator
+
+
+def timed_query(name: str) -> Callable[[F], F]:
+    """Decorator observing every call of the function in ``analytics_query_seconds``."""
+
+    def decorator(func: F) -> F:
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not settings.metrics_enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                QUERY_SECONDS.observe(time.perf_counter() - start, query=name)
+
+        return wrapper  # type: ignore[return-value]
+
+    return decorator
+
+
+def count_round_trips(engine: Engine) -> None:
+    """Count the statements each thread executes on ``engine``; see :func:`round_trips`."""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _count(connection, cursor, statement, parameters, context, executemany) -> None:
+        _local.round_trips = getattr(_local, "round_trips", 0) + 1
+
+
+def round_trips() -> int:
+    """Statements executed so far on this thread by engines passed to :func:`count_round_trips`."""
+    return getattr(_local, "round_trips", 0)
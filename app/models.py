@@ -2,11 +2,27 @@ from __future__ import annotations
 
 from datetime import datetime
 
-from sqlalchemy import Column, DateTime, Float, ForeignKey, Integer, String, UniqueConstraint
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    DateTime,
+    Float,
+    ForeignKey,
+    Index,
+    Integer,
+    JSON,
+    MetaData,
+    String,
+    Table,
+    UniqueConstraint,
+)
 from sqlalchemy.orm import declarative_base, relationship
 
 Base = declarative_base()
 
+# Tables created on demand per connection rather than by ``Base.metadata.create_all``.
+staging_metadata = MetaData()
+
 
 class TripGroup(Base):
     __tablename__ = "trip_groups"
@@ -16,6 +32,14 @@ class TripGroup(Base):
     destination_geohash = Column(String, index=True, nullable=False)
     time_bucket_start = Column(DateTime, index=True, nullable=False)
     time_bucket_minutes = Column(Integer, nullable=False)
+    # Denormalised count maintained by ingestion so listings need not aggregate ``trips``.
+    trip_count = Column(Integer, nullable=False, default=0, server_default="0")
+    # Founding trip of groups created by the ``neighbor`` clustering strategy; null for ``exact`` groups.
+    anchor_origin_lat = Column(Float, nullable=True)
+    anchor_origin_lng = Column(Float, nullable=True)
+    anchor_destination_lat = Column(Float, nullable=True)
+    anchor_destination_lng = Column(Float, nullable=True)
+    anchor_started_at = Column(DateTime, nullable=True)
 
     trips = relationship("Trip", back_populates="group")
 
@@ -27,31 +51,146 @@ class TripGroup(Base):
             "time_bucket_start",
             name="uq_trip_group",
         ),
+        Index("ix_trip_groups_trip_count", "trip_count", "id"),
     )
 
 
 class Trip(Base):
     __tablename__ = "trips"
-    id = Column(Integer, primary_key=True, index=True)
-    region = Column(String, index=True, nullable=False)
-    origin_lat = Column(Float, index=True, nullable=False)
-    origin_lng = Column(Float, index=True, nullable=False)
-    destination_lat = Column(Float, index=True, nullable=False)
-    destination_lng = Column(Float, index=True, nullable=False)
-    started_at = Column(DateTime, index=True, nullable=False)
-    datasource = Column(String, index=True, nullable=False)
-    group_id = Column(Integer, ForeignKey("trip_groups.id"), nullable=False)
+    # Each index costs a B-tree update per inserted row; scripts/index_report.py shows which query uses each one.
+    id = Column(Integer, primary_key=True)
+    region = Column(String, nullable=False)
+    # Bounding-box queries range-scan origin cells, with or without a region, rather than per-axis indexes.
+    origin_lat = Column(Float, nullable=False)
+    origin_lng = Column(Float, nullable=False)
+    destination_lat = Column(Float, nullable=False)
+    destination_lng = Column(Float, nullable=False)
+    started_at = Column(DateTime, nullable=False)
+    datasource = Column(String, nullable=False)
+    group_id = Column(Integer, ForeignKey("trip_groups.id"), index=True, nullable=False)
+    # Integer geohash of the origin (ORIGIN_CELL_PRECISION characters) for bounding-box range scans.
+    origin_cell = Column(BigInteger, nullable=False)
 
     group = relationship("TripGroup", back_populates="trips")
 
+    __table_args__ = (
+        Index("ix_trips_region_started_at", "region", "started_at"),
+        Index("ix_trips_datasource_region", "datasource", "region"),
+        Index("ix_trips_region_origin_cell_started_at", "region", "origin_cell", "started_at"),
+        Index("ix_trips_origin_cell_started_at", "origin_cell", "started_at"),
+    )
+
+
+class TripPartition(Base):
+    """A region and week slice of trips: a native partition on PostgreSQL or a shard table."""
+
+    __tablename__ = "trip_partitions"
+    region = Column(String, primary_key=True)
+    week_start = Column(DateTime, primary_key=True)
+    table_name = Column(String, nullable=False, unique=True)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+
+class TripWeeklyRollup(Base):
+    """Trip counts per region, origin geohash cell and ISO week."""
+
+    __tablename__ = "trip_weekly_rollup"
+    region = Column(String, primary_key=True)
+    origin_cell = Column(BigInteger, primary_key=True)
+    week_start = Column(DateTime, primary_key=True)
+    cell_lat_index = Column(Integer, nullable=False)
+    cell_lng_index = Column(Integer, nullable=False)
+    trip_count = Column(Integer, nullable=False)
+    min_started_at = Column(DateTime, nullable=False)
+    max_started_at = Column(DateTime, nullable=False)
+
+    __table_args__ = (Index("ix_trip_weekly_rollup_cell", "cell_lat_index", "cell_lng_index"),)
+
+
+class TripGroupRollup(Base):
+    """Trip counts per origin/destination geohash cell pair and time bucket, at every configured level."""
+
+    __tablename__ = "trip_group_rollups"
+    geohash_precision = Column(Integer, primary_key=True)
+    bucket_minutes = Column(Integer, primary_key=True)
+    region = Column(String, primary_key=True)
+    # Epoch seconds, so coarser buckets can be computed in SQL on every dialect.
+    bucket_start = Column(BigInteger, primary_key=True)
+    origin_geohash = Column(String, primary_key=True)
+    destination_geohash = Column(String, primary_key=True)
+    trip_count = Column(Integer, nullable=False)
+
+    __table_args__ = (
+        Index("ix_trip_group_rollups_level_count", "geohash_precision", "bucket_minutes", "trip_count"),
+    )
+
+
+trip_staging = Table(
+    "trip_staging",
+    staging_metadata,
+    Column("region", String, nullable=False),
+    Column("origin_lat", Float, nullable=False),
+    Column("origin_lng", Float, nullable=False),
+    Column("destination_lat", Float, nullable=False),
+    Column("destination_lng", Float, nullable=False),
+    Column("started_at", DateTime, nullable=False),
+    Column("datasource", String, nullable=False),
+    Column("origin_cell", BigInteger, nullable=False),
+    Column("origin_geohash", String, nullable=False),
+    Column("destination_geohash", String, nullable=False),
+    Column("time_bucket_start", DateTime, nullable=False),
+    prefixes=["TEMPORARY"],
+)
+
+
+# A chunk's trip counts at the finest trip group rollup level, merged into every level with set-based SQL.
+group_rollup_staging = Table(
+    "group_rollup_staging",
+    staging_metadata,
+    Column("region", String, nullable=False),
+    Column("bucket_start", BigInteger, nullable=False),
+    Column("origin_geohash", String, nullable=False),
+    Column("destination_geohash", String, nullable=False),
+    Column("trip_count", Integer, nullable=False),
+    prefixes=["TEMPORARY"],
+)
+
 
 class IngestionJob(Base):
     __tablename__ = "ingestion_jobs"
     id = Column(Integer, primary_key=True, index=True)
     filename = Column(String, nullable=False)
+    source_path = Column(String, nullable=True)
+    # Server defaults let startup add these columns to tables created before them (``crud.add_missing_columns``).
+    grouping_mode = Column(String, nullable=False, default="cache", server_default="cache")
+    clustering = Column(String, nullable=False, default="exact", server_default="exact")
     status = Column(String, index=True, nullable=False, default="pending")
+    priority = Column(Integer, nullable=False, default=0, server_default="0")
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    queued_at = Column(DateTime, nullable=True)
+    started_at = Column(DateTime, nullable=True)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
     total_rows = Column(Integer, nullable=True)
     processed_rows = Column(Integer, nullable=True)
+    total_bytes = Column(BigInteger, nullable=True)
+    processed_bytes = Column(BigInteger, nullable=True)
     message = Column(String, nullable=True)
+    group_cache_hits = Column(Integer, nullable=False, default=0, server_default="0")
+    group_cache_misses = Column(Integer, nullable=False, default=0, server_default="0")
+    read_seconds = Column(Float, nullable=False, default=0.0, server_default="0")
+    parse_seconds = Column(Float, nullable=False, default=0.0, server_default="0")
+    write_seconds = Column(Float, nullable=False, default=0.0, server_default="0")
+    # Per-job summary of the ingestion metrics: rows/s, stage seconds, cache hit rate, round trips.
+    metrics = Column(JSON, nullable=True)
+
+    __table_args__ = (Index("ix_ingestion_jobs_queue", "status", "priority", "queued_at"),)
+
+
+class IngestionChunk(Base):
+    """Ledger of chunks committed by a job, written in the same transaction as their trips."""
+
+    __tablename__ = "ingestion_chunks"
+    job_id = Column(Integer, ForeignKey("ingestion_jobs.id", ondelete="CASCADE"), primary_key=True)
+    start_offset = Column(BigInteger, primary_key=True)
+    end_offset = Column(BigInteger, nullable=False)
+    row_count = Column(Integer, nullable=False)
@@ -1,16 +1,118 @@
 from __future__ import annotations
 
-from typing import Dict, List
+import asyncio
+import json
+import math
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, List, Optional, Type
 
 from fastapi import WebSocket
 
+from .config import settings
+
+TERMINAL_STATUSES = ("completed", "failed", "cancelled")
+
+ProgressCallback = Callable[[int, dict], None]
+
+
+class ProgressBroker(ABC):
+    """Pub/sub backend relaying job progress to every subscribed ``WebSocketManager``."""
+
+    name = "base"
+
+    @abstractmethod
+    def subscribe(self, callback: ProgressCallback) -> None:
+        ...
+
+    @abstractmethod
+    def publish(self, job_id: int, message: dict) -> None:
+        ...
+
+
+class InProcessBroker(ProgressBroker):
+    name = "memory"
 
-class WebSocketManager:
     def __init__(self) -> None:
+        self._callbacks: List[ProgressCallback] = []
+
+    def subscribe(self, callback: ProgressCallback) -> None:
+        self._callbacks.append(callback)
+
+    def publish(self, job_id: int, message: dict) -> None:
+        for callback in list(self._callbacks):
+            callback(job_id, message)
+
+
+class LocalBroker(ProgressBroker):
+    """Stand-in for a Redis-style broker.
+
+    Messages travel as JSON on a named channel shared by every instance in the process,
+    so several managers on one channel behave like API replicas behind a real broker.
+    """
+
+    name = "local"
+    _channels: Dict[str, List[ProgressCallback]] = {}
+
+    def __init__(self, channel: str = "ingestion-progress") -> None:
+        self.channel = channel
+
+    def subscribe(self, callback: ProgressCallback) -> None:
+        self._channels.setdefault(self.channel, []).append(callback)
+
+    def publish(self, job_id: int, message: dict) -> None:
+        payload = json.dumps({"job_id": job_id, "message": message})
+        for callback in list(self._channels.get(self.channel, [])):
+            received = json.loads(payload)
+            callback(received["job_id"], received["message"])
+
+
+BROKERS: Dict[str, Type[ProgressBroker]] = {broker.name: broker for broker in (InProcessBroker, LocalBroker)}
+
+
+def get_broker(name: Optional[str] = None) -> ProgressBroker:
+    name = name or settings.progress_broker
+    if name not in BROKERS:
+        raise ValueError(f"Unknown progress broker: {name}")
+    return BROKERS[name]()
+
+
+class _Subscriber:
+    """One socket's bounded outbox, drained by its own sender task."""
+
+    def __init__(self, websocket: WebSocket, buffer_size: int) -> None:
+        self.websocket = websocket
+        self.loop = asyncio.get_running_loop()
+        self.outbox: asyncio.Queue = asyncio.Queue(maxsize=max(buffer_size, 1))
+        self.dropped = 0
+        self.task: Optional[asyncio.Task] = None
+
+    def offer(self, message: dict) -> None:
+        if self.outbox.full():
+            # Progress messages are snapshots, so the newest state supersedes the oldest queued one.
+            self.outbox.get_nowait()
+            self.dropped += 1
+        self.outbox.put_nowait(message)
+
+
+class WebSocketManager:
+    def __init__(
+        self,
+        broker: Optional[ProgressBroker] = None,
+        buffer_size: Optional[int] = None,
+        send_timeout: Optional[float] = None,
+    ) -> None:
         self.active_connections: Dict[int, List[WebSocket]] = {}
+        self.buffer_size = buffer_size or settings.websocket_buffer_size
+        self.send_timeout = send_timeout or settings.websocket_send_timeout_seconds
+        self._subscribers: Dict[WebSocket, _Subscriber] = {}
+        if broker is not None:
+            broker.subscribe(self._receive)
 
     async def connect(self, job_id: int, websocket: WebSocket) -> None:
         await websocket.accept()
+        subscriber = _Subscriber(websocket, self.buffer_size)
+        subscriber.task = asyncio.create_task(self._send_loop(job_id, subscriber))
+        self._subscribers[websocket] = subscriber
         self.active_connections.setdefault(job_id, []).append(websocket)
 
     def disconnect(self, job_id: int, websocket: WebSocket) -> None:
@@ -19,17 +121,99 @@ class WebSocketManager:
             connections.remove(websocket)
             if not connections:
                 self.active_connections.pop(job_id, None)
+        subscriber = self._subscribers.pop(websocket, None)
+        if subscriber is not None and subscriber.task is not None and subscriber.task is not _current_task():
+            subscriber.task.cancel()
+
+    def send_update(self, job_id: int, message: dict) -> None:
+        """Queue ``message`` for every local socket watching ``job_id`` without waiting on any of them."""
+        for websocket in list(self.active_connections.get(job_id, [])):
+            subscriber = self._subscribers.get(websocket)
+            if subscriber is None or subscriber.loop.is_closed():
+                continue
+            if _running_loop() is subscriber.loop:
+                subscriber.offer(message)
+            else:
+                subscriber.loop.call_soon_threadsafe(subscriber.offer, message)
+
+    def _receive(self, job_id: int, message: dict) -> None:
+        self.send_update(job_id, message)
+
+    async def _send_loop(self, job_id: int, subscriber: _Subscriber) -> None:
+        try:
+            while True:
+                message = await subscriber.outbox.get()
+                await asyncio.wait_for(subscriber.websocket.send_json(message), self.send_timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception:  # noqa: BLE001
+            # A socket that errors or cannot keep up within the timeout is dropped.
+            self.disconnect(job_id, subscriber.websocket)
+
+
+class ProgressThrottle:
+    """Coalesces progress per job: the latest state wins and at most ``max_per_second`` are published.
+
+    Terminal updates are always published immediately.
+    """
+
+    def __init__(self, broker: ProgressBroker, max_per_second: float) -> None:
+        self.broker = broker
+        self.interval = 1.0 / max_per_second if max_per_second > 0 else 0.0
+        self._latest: Dict[int, dict] = {}
+        self._last_sent: Dict[int, float] = {}
+        self._timers: Dict[int, asyncio.TimerHandle] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def publish_threadsafe(self, loop: asyncio.AbstractEventLoop, job_id: int, message: dict) -> None:
+        try:
+            loop.call_soon_threadsafe(self.offer, job_id, message)
+        except RuntimeError:
+            # The loop closed under a worker thread; nobody is left to notify.
+            pass
+
+    def offer(self, job_id: int, message: dict) -> None:
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # Timers scheduled on a previous (now closed) loop will never fire.
+            self._loop = loop
+            self._timers.clear()
+        self._latest[job_id] = message
+        if message.get("status") in TERMINAL_STATUSES:
+            timer = self._timers.pop(job_id, None)
+            if timer is not None:
+                timer.cancel()
+            self._flush(job_id)
+            self._last_sent.pop(job_id, None)
+            return
+        if job_id in self._timers:
+            return
+        delay = self._last_sent.get(job_id, -math.inf) + self.interval - loop.time()
+        if delay <= 0:
+            self._flush(job_id)
+        else:
+            self._timers[job_id] = loop.call_later(delay, self._flush, job_id)
+
+    def _flush(self, job_id: int) -> None:
+        self._timers.pop(job_id, None)
+        message = self._latest.pop(job_id, None)
+        if message is None:
+            return
+        self._last_sent[job_id] = asyncio.get_running_loop().time()
+        self.broker.publish(job_id, message)
+
+
+def _running_loop() -> Optional[asyncio.AbstractEventLoop]:
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
 
-    async def send_update(self, job_id: int, message: dict) -> None:
-        connections = self.active_connections.get(job_id, [])
-        stale: List[WebSocket] = []
-        for websocket in connections:
-            try:
-                await websocket.send_json(message)
-            except Exception:
-                stale.append(websocket)
-        for websocket in stale:
-            self.disconnect(job_id, websocket)
+def _current_task() -> Optional[asyncio.Task]:
+    return asyncio.current_task() if _running_loop() is not None else None
 
 
-manager = WebSocketManager()
+broker = get_broker()
+manager = WebSocketManager(broker)
+progress = ProgressThrottle(broker, settings.progress_updates_per_second)
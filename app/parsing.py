@@ -0,0 +1,257 @@
+from __future__ import annotations
+
+import csv
+import io
+import warnings
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Mapping, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .clustering import from_epoch_micros, parse_point
+from .config import settings
+
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+REQUIRED_COLUMNS = ("region", "origin_coord", "destination_coord", "datetime", "datasource")
+
+
+class MalformedRowError(ValueError):
+    """Raised when a CSV row cannot be parsed; the message names the offending row."""
+
+
+class TripColumns(NamedTuple):
+    """Typed column arrays for a chunk of trips.
+
+    Regions and datasources are categorical codes into ``regions``/``datasources``;
+    ``started_at`` holds epoch microseconds.
+    """
+
+    region_codes: np.ndarray
+    regions: List[str]
+    origin_lat: np.ndarray
+    origin_lng: np.ndarray
+    destination_lat: np.ndarray
+    destination_lng: np.ndarray
+    started_at: np.ndarray
+    datasource_codes: np.ndarray
+    datasources: List[str]
+
+    @property
+    def row_count(self) -> int:
+        return len(self.region_codes)
+
+    def region_values(self) -> List[str]:
+        return np.asarray(self.regions, dtype=object)[self.region_codes].tolist()
+
+    def datasource_values(self) -> List[str]:
+        return np.asarray(self.datasources, dtype=object)[self.datasource_codes].tolist()
+
+    def started_at_seconds(self) -> np.ndarray:
+        return self.started_at // 1_000_000
+
+    def started_at_datetimes(self) -> List[datetime]:
+        return from_epoch_micros(self.started_at).tolist()
+
+
+def parse_datetime(value: str) -> datetime:
+    return datetime.fromisoformat(value.strip())
+
+
+def _row_label(index: int, first_row: Optional[int], start_offset: int) -> str:
+    if first_row is not None:
+        return f"Row {first_row + index}"
+    return f"Row {index + 1} of the block at byte {start_offset}"
+
+
+def _parse_row(record: Mapping[str, Any]) -> Tuple[str, float, float, float, float, datetime, str]:
+    missing = [column for column in REQUIRED_COLUMNS if not record.get(column)]
+    if missing:
+        raise ValueError(f"Missing value for {', '.join(missing)}")
+    origin_lat, origin_lng = parse_point(record["origin_coord"])
+    destination_lat, destination_lng = parse_point(record["destination_coord"])
+    started_at = record["datetime"]
+    if not isinstance(started_at, datetime):
+        started_at = parse_datetime(started_at)
+    return record["region"], origin_lat, origin_lng, destination_lat, destination_lng, started_at, record["datasource"]
+
+
+def _check_header(fieldnames: Sequence[str]) -> None:
+    missing = [column for column in REQUIRED_COLUMNS if column not in fieldnames]
+    if missing:
+        raise MalformedRowError(f"CSV header is missing required columns: {', '.join(missing)}")
+
+
+def _factorize(values: Sequence[str]) -> Tuple[np.ndarray, List[str]]:
+    categories: Dict[str, int] = {}
+    codes = np.fromiter((categories.setdefault(value, len(categories)) for value in values), dtype=np.int32)
+    return codes, list(categories)
+
+
+def _parse_python(data: bytes, fieldnames: Sequence[str], first_row: Optional[int], start_offset: int) -> TripColumns:
+    reader = csv.DictReader(io.StringIO(data.decode("utf-8")), fieldnames=list(fieldnames))
+    return _parse_records(reader, first_row, start_offset)
+
+
+def _parse_records(records: Iterable[Mapping[str, Any]], first_row: Optional[int], start_offset: int) -> TripColumns:
+    rows = []
+    for index, record in enumerate(records):
+        try:
+            rows.append(_parse_row(record))
+        except ValueError as exc:
+            raise MalformedRowError(f"{_row_label(index, first_row, start_offset)}: {exc}") from exc
+    if not rows:
+        return _empty_columns()
+    regions, origin_lat, origin_lng, destination_lat, destination_lng, started_at, datasources = zip(*rows)
+    region_codes, region_categories = _factorize(regions)
+    datasource_codes, datasource_categories = _factorize(datasources)
+    return TripColumns(
+        region_codes,
+        region_categories,
+        np.array(origin_lat, dtype=np.float64),
+        np.array(origin_lng, dtype=np.float64),
+        np.array(destination_lat, dtype=np.float64),
+        np.array(destination_lng, dtype=np.float64),
+        np.array(started_at, dtype="datetime64[us]").astype(np.int64),
+        datasource_codes,
+        datasource_categories,
+    )
+
+
+def _parse_points(values: List[str]) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """Parse ``POINT (lng lat)`` strings in one pass; ``None`` if any value is malformed."""
+    count = len(values)
+    joined = " nan ".join(values)
+    if not (joined.count("POINT") == joined.count("(") == joined.count(")") == count):
+        return None
+    joined = joined.replace("POINT", " ").replace("(", " ").replace(")", " ")
+    try:
+        with warnings.catch_warnings():
+            # NumPy stops at the first unparsable token, warning or raising depending on version.
+            warnings.simplefilter("ignore", DeprecationWarning)
+            numbers = np.fromstring(joined + " nan", sep=" ")
+    except ValueError:
+        return None
+    # Each value contributes exactly two numbers followed by the NaN separator,
+    # so a value with too many or too few numbers shifts the separators.
+    if numbers.shape != (3 * count,):
+        return None
+    numbers = numbers.reshape(count, 3)
+    if not np.isnan(numbers[:, 2]).all() or np.isnan(numbers[:, :2]).any():
+        return None
+    return numbers[:, 1].copy(), numbers[:, 0].copy()
+
+
+def _parse_pandas(data: bytes, fieldnames: Sequence[str], first_row: Optional[int], start_offset: int) -> TripColumns:
+    frame = pd.read_csv(
+        io.BytesIO(data),
+        header=None,
+        names=list(fieldnames),
+        usecols=list(REQUIRED_COLUMNS),
+        index_col=False,
+        dtype={
+            "region": "category",
+            "datasource": "category",
+            "origin_coord": str,
+            "destination_coord": str,
+            "datetime": str,
+        },
+        na_filter=False,
+    )
+    return _columns_from_frame(frame) or _parse_python(data, fieldnames, first_row, start_offset)
+
+
+def _columns_from_frame(frame: "pd.DataFrame") -> Optional[TripColumns]:
+    """Vectorised conversion of a frame of raw columns; ``None`` if any value is malformed.
+
+    Callers then re-parse row by row to report the first malformed row exactly as the
+    scalar path would.
+    """
+    if frame.empty:
+        return _empty_columns()
+    if frame[list(REQUIRED_COLUMNS)].isna().any().any():
+        return None
+    origins = _parse_points(frame["origin_coord"].tolist())
+    destinations = _parse_points(frame["destination_coord"].tolist())
+    raw_started_at = frame["datetime"]
+    if pd.api.types.is_datetime64_any_dtype(raw_started_at):
+        started_at = raw_started_at
+        if started_at.dt.tz is not None:
+            started_at = started_at.dt.tz_convert("UTC").dt.tz_localize(None)
+    else:
+        started_at = pd.to_datetime(raw_started_at, format="ISO8601", errors="coerce")
+        if started_at.isna().any():
+            started_at = pd.to_datetime(raw_started_at.str.strip(), format="ISO8601", errors="coerce")
+    regions = frame["region"].astype("category")
+    datasources = frame["datasource"].astype("category")
+    region_categories = regions.cat.categories.tolist()
+    datasource_categories = datasources.cat.categories.tolist()
+    if (
+        origins is None
+        or destinations is None
+        or started_at.isna().any()
+        or "" in region_categories
+        or "" in datasource_categories
+    ):
+        return None
+    return TripColumns(
+        regions.cat.codes.to_numpy(dtype=np.int32),
+        region_categories,
+        origins[0],
+        origins[1],
+        destinations[0],
+        destinations[1],
+        started_at.to_numpy(dtype="datetime64[us]").astype(np.int64),
+        datasources.cat.codes.to_numpy(dtype=np.int32),
+        datasource_categories,
+    )
+
+
+def _empty_columns() -> TripColumns:
+    empty_float = np.empty(0, dtype=np.float64)
+    empty_code = np.empty(0, dtype=np.int32)
+    return TripColumns(
+        empty_code, [], empty_float, empty_float, empty_float, empty_float, np.empty(0, dtype=np.int64), empty_code, []
+    )
+
+
+def parse_csv_block(
+    data: bytes,
+    fieldnames: Sequence[str],
+    *,
+    first_row: Optional[int] = None,
+    start_offset: int = 0,
+    parser: Optional[str] = None,
+) -> TripColumns:
+    """Parse a headerless block of CSV lines into typed columns.
+
+    ``first_row`` is the file line number of the block's first line and is used in
+    error messages; without it rows are reported relative to ``start_offset``.
+    """
+    _check_header(fieldnames)
+    parser = parser or settings.csv_parser
+    if parser == "auto":
+        parser = "pandas" if pd is not None else "python"
+    if parser == "pandas":
+        if pd is None:
+            raise RuntimeError("The pandas CSV parser requires pandas to be installed")
+        return _parse_pandas(data, fieldnames, first_row, start_offset)
+    if parser == "python":
+        return _parse_python(data, fieldnames, first_row, start_offset)
+    raise ValueError(f"Unknown CSV parser: {parser}")
+
+
+def parse_record_batch(batch: Any, *, first_row: Optional[int] = None, start_offset: int = 0) -> TripColumns:
+    """Parse an Arrow record batch (e.g. one Parquet row-group slice) into typed columns.
+
+    String and timestamp ``datetime`` columns are both accepted.
+    """
+    _check_header(batch.schema.names)
+    if pd is not None:
+        columns = _columns_from_frame(batch.select(list(REQUIRED_COLUMNS)).to_pandas())
+        if columns is not None:
+            return columns
+    return _parse_records(batch.to_pylist(), first_row, start_offset)
@@ -0,0 +1,325 @@
+from __future__ import annotations
+
+import hashlib
+import re
+import threading
+from datetime import datetime, time, timedelta
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+from sqlalchemy import (
+    Column,
+    Index,
+    MetaData,
+    String,
+    Table,
+    bindparam,
+    delete,
+    event,
+    insert,
+    inspect,
+    select,
+    text,
+    union_all,
+    update,
+)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Connection, Dialect, Engine
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import CreateColumn, CreateIndex
+from sqlalchemy.sql import FromClause
+
+from .cache import analytics_cache, cell_precision, touched_tags
+from .clustering import from_epoch_seconds, geohash_from_cells, to_epoch_seconds, week_start_batch
+from .config import settings
+from .models import Trip, TripGroup, TripGroupRollup, TripPartition, TripWeeklyRollup
+from .parsing import TripColumns
+
+WEEK = timedelta(days=7)
+
+PartitionKey = Tuple[str, datetime]
+
+# SQLite refuses compound selects with more arms than this (SQLITE_MAX_COMPOUND_SELECT).
+_MAX_UNION_ARMS = 400
+
+# Shard tables are created on demand, so they live outside ``Base.metadata``.
+shard_metadata = MetaData()
+_shard_lock = threading.Lock()
+_known: Set[PartitionKey] = set()
+
+
+def partition_mode(dialect: str) -> str:
+    """The configured ``TRIP_PARTITIONING`` mode, checked against the database dialect."""
+    mode = settings.trip_partitioning
+    if mode == "native" and dialect != "postgresql":
+        raise ValueError("Native trip partitioning needs PostgreSQL; use TRIP_PARTITIONING=sharded instead")
+    return mode
+
+
+def week_start(moment: datetime) -> datetime:
+    day = moment.date()
+    return datetime.combine(day - timedelta(days=day.weekday()), time())
+
+
+@lru_cache(maxsize=1024)
+def region_table_name(region: str) -> str:
+    # A digest keeps names unique when different regions slugify alike.
+    slug = re.sub(r"[^a-z0-9]+", "_", region.lower()).strip("_")[:24]
+    digest = hashlib.sha1(region.encode("utf-8")).hexdigest()[:6]
+    return f"trips_{slug}_{digest}" if slug else f"trips_{digest}"
+
+
+def partition_table_name(region: str, week: datetime) -> str:
+    return f"{region_table_name(region)}_{week:%Y%m%d}"
+
+
+def chunk_partitions(columns: TripColumns) -> List[PartitionKey]:
+    """Distinct (region, week start) pairs of a parsed chunk."""
+    if columns.row_count == 0:
+        return []
+    weeks = week_start_batch(columns.started_at_seconds())
+    pairs = np.unique(np.stack([np.asarray(columns.region_codes, dtype=np.int64), weeks], axis=1), axis=0)
+    return [
+        (columns.regions[code], week)
+        for code, week in zip(pairs[:, 0].tolist(), from_epoch_seconds(pairs[:, 1]).tolist())
+    ]
+
+
+def partitioned_trips_ddl(dialect: Dialect) -> List[str]:
+    """Statements creating ``trips`` as a PostgreSQL table partitioned by region, then by week."""
+    table = Trip.__table__
+    columns = ", ".join(str(CreateColumn(column).compile(dialect=dialect)) for column in table.columns)
+    # A partitioned table's primary key must contain the partition keys.
+    statements = [
+        f"CREATE TABLE IF NOT EXISTS trips ({columns}, PRIMARY KEY (id, region, started_at), "
+        "FOREIGN KEY (group_id) REFERENCES trip_groups (id)) PARTITION BY LIST (region)"
+    ]
+    statements.extend(str(CreateIndex(index, if_not_exists=True).compile(dialect=dialect)) for index in table.indexes)
+    return statements
+
+
+def native_partition_ddl(dialect: Dialect, region: str, week: datetime) -> List[str]:
+    quote = String().literal_processor(dialect=dialect)
+    region_table = region_table_name(region)
+    return [
+        f"CREATE TABLE IF NOT EXISTS {region_table} PARTITION OF trips "
+        f"FOR VALUES IN ({quote(region)}) PARTITION BY RANGE (started_at)",
+        f"CREATE TABLE IF NOT EXISTS {partition_table_name(region, week)} PARTITION OF {region_table} "
+        f"FOR VALUES FROM ('{week:%Y-%m-%d %H:%M:%S}') TO ('{week + WEEK:%Y-%m-%d %H:%M:%S}')",
+    ]
+
+
+def shard_table(name: str) -> Table:
+    """A shard of ``trips`` with the same columns and indexes, for ``TRIP_PARTITIONING=sharded``."""
+    with _shard_lock:
+        if name in shard_metadata.tables:
+            return shard_metadata.tables[name]
+        source = Trip.__table__
+        table = Table(
+            name,
+            shard_metadata,
+            *(
+                Column(column.name, column.type, primary_key=column.primary_key, nullable=column.nullable)
+                for column in source.columns
+            ),
+        )
+        for index in source.indexes:
+            Index(f"{name}__{index.name}", *(table.c[column.name] for column in index.columns))
+        return table
+
+
+def create_trip_storage(engine: Engine) -> None:
+    """Create the partitioned ``trips`` parent on PostgreSQL; ``Base.metadata.create_all`` then skips it."""
+    if partition_mode(engine.dialect.name) != "native":
+        return
+    with engine.begin() as connection:
+        if inspect(connection).has_table("trips"):
+            return
+        TripGroup.__table__.create(connection, checkfirst=True)
+        for statement in partitioned_trips_ddl(connection.dialect):
+            connection.exec_driver_sql(statement)
+
+
+def ensure_partitions(engine: Engine, keys: Iterable[PartitionKey]) -> None:
+    """Create any missing partitions (or shard tables) for ``keys``.
+
+    Runs in its own short transaction before a chunk is written, so the DDL locks are
+    never held while trips are inserted.
+    """
+    mode = partition_mode(engine.dialect.name)
+    if mode == "none":
+        return
+    missing = [key for key in dict.fromkeys(keys) if key not in _known]
+    if not missing:
+        return
+    for attempt in range(2):
+        try:
+            with engine.begin() as connection:
+                _create_partitions(connection, mode, missing)
+            break
+        except DBAPIError:
+            # Another process created the same partition concurrently; IF NOT EXISTS now sees it.
+            if attempt:
+                raise
+    _known.update(missing)
+
+
+def _create_partitions(connection: Connection, mode: str, keys: Sequence[PartitionKey]) -> None:
+    for region, week in keys:
+        if mode == "native":
+            for statement in native_partition_ddl(connection.dialect, region, week):
+                connection.exec_driver_sql(statement)
+        else:
+            shard_table(partition_table_name(region, week)).create(connection, checkfirst=True)
+    dialect_insert = postgresql.insert if connection.dialect.name == "postgresql" else sqlite.insert
+    connection.execute(
+        dialect_insert(TripPartition.__table__).on_conflict_do_nothing(),
+        [
+            {"region": region, "week_start": week, "table_name": partition_table_name(region, week)}
+            for region, week in keys
+        ],
+    )
+
+
+def insert_sharded_trips(session: Session, rows: Sequence[dict]) -> None:
+    """Insert trip rows into the shard table of their region and week."""
+    by_shard: Dict[str, List[dict]] = {}
+    for row in rows:
+        by_shard.setdefault(partition_table_name(row["region"], week_start(row["started_at"])), []).append(row)
+    for name, shard_rows in by_shard.items():
+        session.execute(insert(shard_table(name)), shard_rows)
+
+
+def trip_source(
+    session: Session,
+    region: Optional[str] = None,
+    started_from: Optional[datetime] = None,
+    started_to: Optional[datetime] = None,
+) -> FromClause:
+    """The table to read trips from, pruned to the shards matching the filters.
+
+    Native partitions are pruned by PostgreSQL itself, so outside sharded mode this is
+    simply ``trips``. In sharded mode the matching shards are combined with
+    ``UNION ALL`` alongside ``trips``, which keeps rows ingested before sharding.
+    """
+    if partition_mode(session.get_bind().dialect.name) != "sharded":
+        return Trip.__table__
+    query = select(TripPartition.table_name)
+    if region is not None:
+        query = query.where(TripPartition.region == region)
+    if started_from is not None:
+        query = query.where(TripPartition.week_start > started_from - WEEK)
+    if started_to is not None:
+        query = query.where(TripPartition.week_start <= started_to)
+    names = session.execute(query.order_by(TripPartition.table_name)).scalars().all()
+    if not names:
+        return Trip.__table__
+    column_names = [column.name for column in Trip.__table__.columns]
+    arms = [select(*(table.c[name] for name in column_names)) for table in [Trip.__table__, *map(shard_table, names)]]
+    while len(arms) > _MAX_UNION_ARMS:
+        arms = [
+            select(union_all(*arms[offset : offset + _MAX_UNION_ARMS]).subquery())
+            for offset in range(0, len(arms), _MAX_UNION_ARMS)
+        ]
+    return union_all(*arms).subquery("trips")
+
+
+def detach_partitions(session: Session, before: datetime, *, drop: bool = False) -> List[str]:
+    """Detach every partition whose whole week lies before ``before``, one statement per partition.
+
+    Their trips also leave the weekly rollup, the trip group rollups and the trip group counts, and
+    cached analytics results reading their cells are invalidated when the session commits. Detached
+    tables are renamed with a ``_d<timestamp>`` suffix for archiving, or dropped with ``drop``.
+    Returns the resulting table names.
+    """
+    mode = partition_mode(session.get_bind().dialect.name)
+    if mode == "none":
+        raise ValueError("Trip partitioning is disabled (TRIP_PARTITIONING=none)")
+    partitions = (
+        session.execute(select(TripPartition).where(TripPartition.week_start <= before - WEEK)).scalars().all()
+    )
+    suffix = datetime.utcnow().strftime("_d%Y%m%d%H%M%S")
+    detached = []
+    removed: Dict[int, int] = {}
+    touched: Optional[Dict[str, Set[str]]] = {}
+    for partition in partitions:
+        name = partition.table_name
+        counts, cells = _partition_contents(session, name)
+        for group_id, count in counts.items():
+            removed[group_id] = removed.get(group_id, 0) + count
+        if cells is None or touched is None:
+            touched = None
+        else:
+            touched.setdefault(partition.region, set()).update(cells)
+        if mode == "native":
+            session.execute(text(f"ALTER TABLE {region_table_name(partition.region)} DETACH PARTITION {name}"))
+        if drop:
+            session.execute(text(f"DROP TABLE {name}"))
+            detached.append(name)
+        else:
+            session.execute(text(f"ALTER TABLE {name} RENAME TO {name}{suffix}"))
+            detached.append(f"{name}{suffix}")
+        with _shard_lock:
+            if name in shard_metadata.tables:
+                shard_metadata.remove(shard_metadata.tables[name])
+        session.execute(
+            delete(TripWeeklyRollup).where(
+                TripWeeklyRollup.region == partition.region, TripWeeklyRollup.week_start == partition.week_start
+            )
+        )
+        # Rollup buckets divide a day, so each lies wholly inside one week.
+        week_seconds = to_epoch_seconds([partition.week_start, partition.week_start + WEEK])
+        session.execute(
+            delete(TripGroupRollup).where(
+                TripGroupRollup.region == partition.region,
+                TripGroupRollup.bucket_start >= int(week_seconds[0]),
+                TripGroupRollup.bucket_start < int(week_seconds[1]),
+            )
+        )
+        session.delete(partition)
+        _known.discard((partition.region, partition.week_start))
+    if not detached:
+        return detached
+    table = TripGroup.__table__
+    statement = (
+        update(table)
+        .where(table.c.id == bindparam("group_id"))
+        .values(trip_count=table.c.trip_count - bindparam("removed"))
+    )
+    if removed:
+        # Updating in id order keeps concurrent jobs from deadlocking on shared groups.
+        parameters = [{"group_id": group_id, "removed": removed[group_id]} for group_id in sorted(removed)]
+        session.execute(statement, parameters)
+    # Cached results are dropped once the removal is visible, as ingestion does after each chunk commits.
+    tags = touched_tags(touched) if touched is not None else None
+    event.listen(session, "after_commit", lambda _: analytics_cache.invalidate(tags), once=True)
+    return detached
+
+
+def _partition_contents(session: Session, name: str) -> Tuple[Dict[int, int], Optional[Set[str]]]:
+    """Trips per group in a partition, and the origin cells (at the cache's tag precision) of them and their groups.
+
+    Neighbour clustering can put a trip in a group of an adjacent cell or of the next week, so counts are
+    subtracted per group rather than cleared per week. The cells are ``None`` when ``trips.origin_cell`` is
+    coarser than the cache tags.
+    """
+    counts: Dict[int, int] = {}
+    precision = cell_precision()
+    cells: Set[str] = set()
+    rows = session.execute(
+        text(
+            f"SELECT t.group_id, g.origin_geohash, COUNT(*) FROM {name} t "
+            "JOIN trip_groups g ON g.id = t.group_id GROUP BY t.group_id, g.origin_geohash"
+        )
+    )
+    for group_id, origin_geohash, count in rows:
+        counts[group_id] = count
+        cells.add(origin_geohash[:precision])
+    if settings.origin_cell_precision < precision:
+        return counts, None
+    divisor = 1 << 5 * (settings.origin_cell_precision - precision)
+    prefixes = session.execute(text(f"SELECT DISTINCT origin_cell / {divisor} FROM {name}")).scalars().all()
+    cells.update(geohash_from_cells(np.array(prefixes, dtype=np.int64), precision).tolist())
+    return counts, cells
@@ -1,7 +1,7 @@
 from __future__ import annotations
 
 from datetime import datetime
-from typing import List, Optional
+from typing import Any, Dict, List, Optional
 
 from pydantic import BaseModel, Field
 
@@ -44,6 +44,18 @@ class TripGroupRead(TripGroupBase):
         orm_mode = True
 
 
+class TripGroupRollupRead(TripGroupBase):
+    trip_count: int = Field(..., description="Number of trips in the cell pair and bucket")
+
+
+class TripGroupRollupResponse(BaseModel):
+    geohash_precision: int
+    bucket_minutes: int
+    level_geohash_precision: int = Field(..., description="Geohash precision of the rollup level that answered")
+    level_bucket_minutes: int = Field(..., description="Bucket minutes of the rollup level that answered")
+    groups: List[TripGroupRollupRead]
+
+
 class IngestionRequest(BaseModel):
     filename: str
 
@@ -51,12 +63,25 @@ class IngestionRequest(BaseModel):
 class IngestionJobRead(BaseModel):
     id: int
     filename: str
+    grouping_mode: str = "cache"
+    clustering: str = "exact"
+    priority: int = 0
     status: str
     created_at: datetime
     updated_at: datetime
+    queued_at: Optional[datetime] = None
+    started_at: Optional[datetime] = None
     total_rows: Optional[int]
     processed_rows: Optional[int]
+    total_bytes: Optional[int] = None
+    processed_bytes: Optional[int] = None
     message: Optional[str]
+    group_cache_hits: int = 0
+    group_cache_misses: int = 0
+    read_seconds: float = 0.0
+    parse_seconds: float = 0.0
+    write_seconds: float = 0.0
+    metrics: Optional[Dict[str, Any]] = None
 
     class Config:
         orm_mode = True
@@ -79,3 +104,29 @@ class WeeklyAverageResponse(BaseModel):
 
 class TripGroupListResponse(BaseModel):
     groups: List[TripGroupRead]
+    next_after_count: Optional[int] = Field(None, description="Pass as after_count to fetch the next page")
+    next_after_id: Optional[int] = Field(None, description="Pass as after_id to fetch the next page")
+
+
+class AnalyticsCacheStats(BaseModel):
+    backend: str
+    hits: int
+    misses: int
+    coalesced: int = Field(..., description="Requests that waited on an identical request already running")
+    hit_ratio: float
+    entries: int
+    max_entries: int
+    bytes: int
+    ttl_seconds: float
+    evictions: int
+    expirations: int
+    invalidations: int = Field(..., description="Entries dropped because ingestion touched their regions or cells")
+
+
+class IngestionQueueStats(BaseModel):
+    workers: int
+    running: int
+    queue_depth: int
+    max_queued: int
+    oldest_wait_seconds: float
+    average_wait_seconds: float
@@ -0,0 +1 @@
+"""Micro, ingestion and endpoint benchmarks with baseline regression checks; run ``python -m benchmarks run``."""
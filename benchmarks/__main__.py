@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+from pathlib import Path
+from typing import Dict, List
+
+from .results import Result, compare, environment, format_result, load_results, write_results
+
+SUITES = ("micro", "ingest", "endpoints")
+DEFAULT_BASELINE = Path(__file__).resolve().parent / "baseline.json"
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Run benchmarks and check regressions")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="Run benchmark suites and compare them with the baseline")
+    run.add_argument("--suite", nargs="+", choices=SUITES, default=list(SUITES), help="Suites to run")
+    run.add_argument("--ingest-sizes", type=int, nargs="+", default=[10_000, 50_000], help="Rows per ingestion run")
+    run.add_argument("--chunk-sizes", type=int, nargs="+", default=[500, 1000, 5000], help="Ingestion chunk sizes")
+    run.add_argument(
+        "--table-sizes", type=int, nargs="+", default=[10_000, 100_000], help="Trips loaded before timing endpoints"
+    )
+    run.add_argument("--requests", type=int, default=50, help="Requests per endpoint and table size")
+    run.add_argument("--repeat", type=int, default=5, help="Timings per micro benchmark; the best one counts")
+    run.add_argument("--seed", type=int, default=42, help="Seed for the synthetic trips")
+    run.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Processes generating synthetic trips")
+    run.add_argument(
+        "--use-configured-database",
+        action="store_true",
+        help="Benchmark DATABASE_URL/SYNC_DATABASE_URL (their tables are dropped) instead of a scratch SQLite file",
+    )
+    run.add_argument("--output", type=Path, help="Write the results as JSON")
+    add_comparison_args(run)
+    run.add_argument("--save-baseline", action="store_true", help="Store the results as the new baseline")
+
+    check = commands.add_parser("compare", help="Compare a results file with the baseline")
+    check.add_argument("results", type=Path, help="JSON results written by 'run --output'")
+    add_comparison_args(check)
+    return parser.parse_args()
+
+
+def add_comparison_args(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE, help="Baseline results to compare with")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2, help="Allowed slowdown before a result counts as a regression"
+    )
+
+
+def run_suites(args: argparse.Namespace, directory: Path) -> List[Result]:
+    if not args.use_configured_database:
+        # Settings are read on import, so the scratch database has to be configured first.
+        os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{directory / 'benchmark.db'}"
+        os.environ["SYNC_DATABASE_URL"] = f"sqlite:///{directory / 'benchmark.db'}"
+    results: List[Result] = []
+    if "micro" in args.suite:
+        from . import micro
+
+        results += micro.run(args.repeat, args.seed)
+    if "ingest" in args.suite:
+        from . import ingest
+
+        results += ingest.run(args.ingest_sizes, args.chunk_sizes, directory, args.seed, args.workers)
+    if "endpoints" in args.suite:
+        from . import endpoints
+
+        results += asyncio.run(endpoints.run(args.table_sizes, args.requests, directory, args.seed, args.workers))
+    return results
+
+
+def report(results: List[Result], baseline_path: Path, tolerance: float) -> int:
+    baseline: Dict[str, Result] = load_results(baseline_path) if baseline_path.exists() else {}
+    for result in results:
+        print(format_result(result, baseline.get(result.name)))
+    if not baseline:
+        print(f"\nNo baseline at {baseline_path}; nothing to compare")
+        return 0
+    regressions = compare(results, baseline, tolerance)
+    if not regressions:
+        print(f"\nNo regressions beyond {tolerance:.0%} against {baseline_path}")
+        return 0
+    print(f"\n{len(regressions)} regression(s) beyond {tolerance:.0%} against {baseline_path}:")
+    for regression in regressions:
+        print(
+            f"  {regression.name}: {regression.baseline:,.2f} -> {regression.current:,.2f} {regression.unit} "
+            f"({regression.change:.1%} worse)"
+        )
+    return 1
+
+
+def main() -> int:
+    args = parse_args()
+    if args.command == "compare":
+        return report(list(load_results(args.results).values()), args.baseline, args.tolerance)
+    with tempfile.TemporaryDirectory() as directory:
+        results = run_suites(args, Path(directory))
+    meta = {**environment(), "suites": args.suite, "seed": args.seed}
+    if args.output:
+        write_results(args.output, results, meta)
+    status = report(results, args.baseline, args.tolerance)
+    if args.save_baseline:
+        write_results(args.baseline, results, meta)
+        print(f"Saved baseline to {args.baseline}")
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,67 @@
+from __future__ import annotations
+
+import time
+from pathlib import Path
+from typing import Dict, List, Sequence
+
+import httpx
+
+from app.cache import analytics_cache
+from app.config import settings
+from app.db import async_engine
+from app.main import app
+
+from .generator import generate_csv
+from .ingest import ingest, reset_database
+from .results import Result, percentile
+
+# Label and path of each endpoint query; the bounding box is around the generator's Prague trips.
+ENDPOINTS: Dict[str, str] = {
+    "trip_groups": "/trip-groups?limit=50",
+    "trip_groups_region": "/trip-groups?limit=50&region=Prague",
+    "trip_group_rollup_daily": "/trip-groups/rollup?geohash_precision=3&bucket_minutes=1440&limit=50",
+    "weekly_average_region": "/analytics/weekly-average?region=Prague",
+    "weekly_average_bbox": "/analytics/weekly-average?min_lat=50.0&max_lat=50.15&min_lng=14.3&max_lng=14.55",
+}
+
+
+async def measure(client: httpx.AsyncClient, path: str, requests: int) -> List[float]:
+    latencies: List[float] = []
+    for _ in range(requests):
+        # Time the query rather than the analytics result cache.
+        analytics_cache.invalidate()
+        start = time.perf_counter()
+        response = await client.get(path)
+        latencies.append(time.perf_counter() - start)
+        response.raise_for_status()
+    return latencies
+
+
+async def run(
+    table_sizes: Sequence[int], requests: int, directory: Path, seed: int = 42, workers: int = 1
+) -> List[Result]:
+    """Grow the trips table to each size in turn and time every endpoint against it."""
+    results: List[Result] = []
+    reset_database()
+    loaded = 0
+    transport = httpx.ASGITransport(app=app)
+    try:
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+            for step, size in enumerate(sorted(table_sizes)):
+                if size > loaded:
+                    # Each step appends new trips, from its own seed, instead of reloading the table.
+                    csv_path = generate_csv(directory / f"endpoints_{size}.csv", size - loaded, seed + step, workers)
+                    loaded += await ingest(csv_path)
+                    csv_path.unlink()
+                for label, path in ENDPOINTS.items():
+                    if path.startswith("/trip-groups/rollup") and not settings.group_rollup_precisions:
+                        # Rollup levels are opt-in; without them the endpoint answers 400.
+                        continue
+                    latencies = await measure(client, path, requests)
+                    for statistic, fraction in (("p50", 0.50), ("p99", 0.99)):
+                        name = f"endpoint.{label}.rows_{size}.{statistic}_ms"
+                        value = percentile(latencies, fraction) * 1000
+                        results.append(Result(name, value, "ms", higher_is_better=False, gated=fraction == 0.50))
+    finally:
+        await async_engine.dispose()
+    return results
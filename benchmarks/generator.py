@@ -0,0 +1,145 @@
+from __future__ import annotations
+
+import multiprocessing
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from itertools import islice
+from pathlib import Path
+from typing import BinaryIO, Deque, Iterator, Tuple
+
+import numpy as np
+
+# Region name and the (lat, lng) centre its synthetic trips are scattered around.
+REGIONS = [
+    ("Prague", 50.08, 14.43),
+    ("Turin", 45.07, 7.69),
+    ("Hamburg", 53.55, 9.99),
+    ("Berlin", 52.52, 13.40),
+    ("Madrid", 40.42, -3.70),
+]
+DATASOURCES = ["cheap_mobile", "funny_car", "pt_search_app", "baba_car", "bad_diesel_vehicles"]
+FIELDNAMES = ["region", "origin_coord", "destination_coord", "datetime", "datasource"]
+
+BLOCK_ROWS = 50_000
+# Trips start during 2018.
+START_EPOCH_SECONDS = 1_514_764_800
+SPAN_SECONDS = 365 * 24 * 3600
+# Recurring trips: fixed routes driven at their usual time of day, with GPS and timing jitter.
+ROUTES = 2_000
+ROUTE_JITTER_DEGREES = 0.0004
+ROUTE_JITTER_SECONDS = 300
+
+
+def _routes(seed: int) -> tuple:
+    # A spawn key keeps the route stream apart from every block stream.
+    rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(1,)))
+    region_index = rng.integers(0, len(REGIONS), ROUTES)
+    centres = np.array([(lat, lng) for _, lat, lng in REGIONS])[region_index]
+    origin_lat = centres[:, 0] + rng.normal(0.0, 0.1, ROUTES)
+    origin_lng = centres[:, 1] + rng.normal(0.0, 0.15, ROUTES)
+    destination_lat = origin_lat + rng.normal(0.0, 0.05, ROUTES)
+    destination_lng = origin_lng + rng.normal(0.0, 0.08, ROUTES)
+    # Morning and evening rush hours.
+    departure = rng.choice([7, 8, 17, 18], ROUTES) * 3600 + rng.integers(0, 3600, ROUTES)
+    return region_index, origin_lat, origin_lng, destination_lat, destination_lng, departure
+
+
+def generate_block(seed: int, index: int, rows: int, route_share: float = 0.0) -> bytes:
+    """CSV lines for block ``index``; the same seed and index always give the same bytes.
+
+    ``route_share`` of the trips repeat one of ``ROUTES`` recurring routes, so they form trip groups.
+    """
+    rng = np.random.default_rng([seed, index])
+    region_index = rng.integers(0, len(REGIONS), rows)
+    centres = np.array([(lat, lng) for _, lat, lng in REGIONS])[region_index]
+    origin_lat = centres[:, 0] + rng.normal(0.0, 0.1, rows)
+    origin_lng = centres[:, 1] + rng.normal(0.0, 0.15, rows)
+    destination_lat = origin_lat + rng.normal(0.0, 0.05, rows)
+    destination_lng = origin_lng + rng.normal(0.0, 0.08, rows)
+    started = START_EPOCH_SECONDS + rng.integers(0, SPAN_SECONDS, rows)
+    datasource_index = rng.integers(0, len(DATASOURCES), rows)
+    if route_share > 0:
+        on_route = rng.random(rows) < route_share
+        count = int(on_route.sum())
+        route = rng.integers(0, ROUTES, count)
+        routes = [column[route] for column in _routes(seed)]
+        region_index[on_route] = routes[0]
+        for column, value in zip((origin_lat, origin_lng, destination_lat, destination_lng), routes[1:5]):
+            column[on_route] = value + rng.normal(0.0, ROUTE_JITTER_DEGREES, count)
+        day = rng.integers(0, SPAN_SECONDS // 86400, count) * 86400
+        jitter = rng.integers(-ROUTE_JITTER_SECONDS, ROUTE_JITTER_SECONDS + 1, count)
+        started[on_route] = START_EPOCH_SECONDS + day + routes[5] + jitter
+    started_at = np.datetime_as_string(started.astype("datetime64[s]"), unit="s")
+    lines = [
+        f"{REGIONS[region][0]},POINT ({lng:.6f} {lat:.6f}),POINT ({dest_lng:.6f} {dest_lat:.6f}),"
+        f"{started[:10]} {started[11:]},{DATASOURCES[datasource]}\n"
+        for region, lat, lng, dest_lat, dest_lng, started, datasource in zip(
+            region_index.tolist(),
+            origin_lat.tolist(),
+            origin_lng.tolist(),
+            destination_lat.tolist(),
+            destination_lng.tolist(),
+            started_at.tolist(),
+            datasource_index.tolist(),
+        )
+    ]
+    return "".join(lines).encode("utf-8")
+
+
+def _blocks(rows: int, block_rows: int) -> Iterator[Tuple[int, int]]:
+    for index, start in enumerate(range(0, rows, block_rows)):
+        yield index, min(block_rows, rows - start)
+
+
+def iter_blocks(
+    rows: int, seed: int = 42, workers: int = 1, block_rows: int = BLOCK_ROWS, route_share: float = 0.0
+) -> Iterator[bytes]:
+    """Yield the CSV body in order, generating blocks in ``workers`` processes.
+
+    At most two blocks per worker are held in memory, so the row count is not bounded by memory.
+    """
+    if workers <= 1:
+        for index, count in _blocks(rows, block_rows):
+            yield generate_block(seed, index, count, route_share)
+        return
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    try:
+        blocks = _blocks(rows, block_rows)
+        pending: Deque[Future] = deque(
+            executor.submit(generate_block, seed, index, count, route_share)
+            for index, count in islice(blocks, 2 * workers)
+        )
+        while pending:
+            body = pending.popleft().result()
+            for index, count in islice(blocks, 1):
+                pending.append(executor.submit(generate_block, seed, index, count, route_share))
+            yield body
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def write_trips(
+    sink: BinaryIO,
+    rows: int,
+    seed: int = 42,
+    workers: int = 1,
+    block_rows: int = BLOCK_ROWS,
+    route_share: float = 0.0,
+) -> None:
+    sink.write((",".join(FIELDNAMES) + "\n").encode("utf-8"))
+    for body in iter_blocks(rows, seed, workers, block_rows, route_share):
+        sink.write(body)
+
+
+def generate_csv(
+    path: Path,
+    rows: int,
+    seed: int = 42,
+    workers: int = 1,
+    block_rows: int = BLOCK_ROWS,
+    route_share: float = 0.0,
+) -> Path:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open("wb") as sink:
+        write_trips(sink, rows, seed, workers, block_rows, route_share)
+    return path
@@ -0,0 +1,56 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from pathlib import Path
+from typing import List, Sequence
+
+from app.cache import analytics_cache
+from app.config import settings
+from app.crud import create_ingestion_job
+from app.db import get_sync_session, sync_engine
+from app.ingestion import ingest_file
+from app.models import Base, IngestionJob
+from app.partitioning import create_trip_storage
+
+from .generator import generate_csv
+from .results import Result
+
+
+def reset_database() -> None:
+    Base.metadata.drop_all(bind=sync_engine)
+    create_trip_storage(sync_engine)
+    Base.metadata.create_all(bind=sync_engine)
+    analytics_cache.invalidate()
+
+
+async def ingest(csv_path: Path) -> int:
+    """Ingest ``csv_path`` as one job and return the rows it committed."""
+    with get_sync_session() as session:
+        job_id = create_ingestion_job(session, filename=csv_path.name).id
+    await ingest_file(job_id, csv_path)
+    with get_sync_session() as session:
+        job = session.get(IngestionJob, job_id)
+        if job is None or job.status != "completed":
+            raise RuntimeError(f"Benchmark ingestion of {csv_path.name} did not complete: {job and job.message}")
+        return job.processed_rows
+
+
+def run(
+    sizes: Sequence[int], chunk_sizes: Sequence[int], directory: Path, seed: int = 42, workers: int = 1
+) -> List[Result]:
+    results: List[Result] = []
+    default_chunk_size = settings.ingestion_chunk_size
+    try:
+        for size in sizes:
+            csv_path = generate_csv(directory / f"ingest_{size}.csv", size, seed, workers)
+            for chunk_size in chunk_sizes:
+                settings.ingestion_chunk_size = chunk_size
+                reset_database()
+                start = time.perf_counter()
+                rows = asyncio.run(ingest(csv_path))
+                elapsed = time.perf_counter() - start
+                results.append(Result(f"ingest.rows_{size}.chunk_{chunk_size}", rows / elapsed, "rows/s"))
+    finally:
+        settings.ingestion_chunk_size = default_chunk_size
+    return results
@@ -0,0 +1,52 @@
+from __future__ import annotations
+
+import time
+from datetime import datetime
+from typing import Callable, List
+
+import numpy as np
+
+from app.clustering import encode_geohash, encode_geohash_batch, parse_point, time_bucket
+from app.parsing import parse_csv_block, pd
+
+from .generator import FIELDNAMES, generate_block
+from .results import Result
+
+
+def best_rate(func: Callable[[], object], number: int, repeat: int, items: int = 1) -> float:
+    """Items per second of the fastest of ``repeat`` timings of ``number`` calls."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        best = min(best, time.perf_counter() - start)
+    return number * items / best
+
+
+def run(repeat: int = 5, seed: int = 42) -> List[Result]:
+    block_rows = 10_000
+    block = generate_block(seed, 0, block_rows)
+    rng = np.random.default_rng(seed)
+    lats, lngs = rng.uniform(40.0, 55.0, block_rows), rng.uniform(-5.0, 15.0, block_rows)
+    started_at = datetime(2018, 5, 28, 9, 3, 40)
+
+    results = [
+        Result("micro.encode_geohash", best_rate(lambda: encode_geohash(50.08, 14.43), 20_000, repeat), "calls/s"),
+        Result(
+            "micro.encode_geohash_batch",
+            best_rate(lambda: encode_geohash_batch(lats, lngs), 20, repeat, block_rows),
+            "points/s",
+        ),
+        Result(
+            "micro.parse_point",
+            best_rate(lambda: parse_point("POINT (14.4973794438195 50.00136875782316)"), 100_000, repeat),
+            "calls/s",
+        ),
+        Result("micro.time_bucket", best_rate(lambda: time_bucket(started_at), 100_000, repeat), "calls/s"),
+    ]
+    parsers = ["python", "pandas"] if pd is not None else ["python"]
+    for parser in parsers:
+        rate = best_rate(lambda: parse_csv_block(block, FIELDNAMES, parser=parser), 3, repeat, block_rows)
+        results.append(Result(f"micro.parse_csv_block.{parser}", rate, "rows/s"))
+    return results
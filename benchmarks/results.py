@@ -0,0 +1,88 @@
+from __future__ import annotations
+
+import json
+import os
+import platform
+import subprocess
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Sequence
+
+
+class Result(NamedTuple):
+    name: str
+    value: float
+    unit: str
+    higher_is_better: bool = True
+    # Tail latencies over a few dozen requests are reported but too noisy to fail a run on.
+    gated: bool = True
+
+
+class Regression(NamedTuple):
+    name: str
+    baseline: float
+    current: float
+    unit: str
+    # Relative change in the bad direction, e.g. 0.25 for 25% slower.
+    change: float
+
+
+def percentile(samples: Sequence[float], fraction: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        completed = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True, timeout=10
+        )
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return completed.stdout.strip() or None
+
+
+def environment() -> Dict[str, Any]:
+    """Where the results were measured; numbers are only comparable on similar machines."""
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def write_results(path: Path, results: Iterable[Result], meta: Dict[str, Any]) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    payload = {"meta": meta, "results": [result._asdict() for result in results]}
+    path.write_text(json.dumps(payload, indent=2) + "\n")
+
+
+def load_results(path: Path) -> Dict[str, Result]:
+    payload = json.loads(path.read_text())
+    return {entry["name"]: Result(**entry) for entry in payload["results"]}
+
+
+def compare(current: Iterable[Result], baseline: Dict[str, Result], tolerance: float) -> List[Regression]:
+    """Gated results worse than their baseline by more than ``tolerance`` (a fraction); new results are skipped."""
+    regressions: List[Regression] = []
+    for result in current:
+        reference = baseline.get(result.name)
+        if not result.gated or reference is None or reference.value <= 0:
+            continue
+        if result.higher_is_better:
+            change = (reference.value - result.value) / reference.value
+        else:
+            change = (result.value - reference.value) / reference.value
+        if change > tolerance:
+            regressions.append(Regression(result.name, reference.value, result.value, result.unit, change))
+    return regressions
+
+
+def format_result(result: Result, reference: Optional[Result] = None) -> str:
+    line = f"{result.name}: {result.value:,.2f} {result.unit}"
+    if reference is not None and reference.value:
+        line += f" ({(result.value - reference.value) / reference.value:+.1%} vs baseline)"
+    return line
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import argparse
+import statistics
+import time
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import func, insert, select
+
+from app.clustering import from_epoch_seconds, origin_cells
+from app.config import settings
+from app.crud import (
+    _origin_cell_filter,
+    _trip_filters,
+    _weekly_average,
+    compute_weekly_average,
+    compute_weekly_average_from_trips,
+    rebuild_weekly_rollup,
+)
+from app.db import get_sync_session, sync_engine
+from app.models import Base, Trip, TripGroup
+
+# Region name and the (lat, lng) centre its synthetic trips are scattered around.
+REGIONS = [("Prague", 50.08, 14.43), ("Turin", 45.07, 7.69), ("Hamburg", 53.55, 9.99), ("Berlin", 52.52, 13.40)]
+
+BBox = Tuple[float, float, float, float]
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Compare bounding-box trip queries with and without origin cell ranges"
+    )
+    parser.add_argument("--rows", type=int, default=10_000_000, help="Synthetic trips to load before querying")
+    parser.add_argument("--batch-size", type=int, default=100_000, help="Rows inserted per statement batch")
+    parser.add_argument("--boxes", type=int, default=20, help="Random bounding boxes queried per variant")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed for trips and boxes")
+    parser.add_argument(
+        "--reuse", action="store_true", help="Query the existing trips and rollup instead of reloading them"
+    )
+    return parser.parse_args()
+
+
+def load_trips(rows: int, batch_size: int, rng: np.random.Generator) -> None:
+    Base.metadata.drop_all(bind=sync_engine)
+    Base.metadata.create_all(bind=sync_engine)
+    with get_sync_session() as session:
+        # Trips only need a valid group id here; grouping is not part of this benchmark.
+        group_ids = []
+        for name, _, _ in REGIONS:
+            group = TripGroup(
+                region=name,
+                origin_geohash="",
+                destination_geohash="",
+                time_bucket_start=from_epoch_seconds(np.array([0]))[0],
+                time_bucket_minutes=settings.time_bucket_minutes,
+            )
+            session.add(group)
+            session.flush()
+            group_ids.append(group.id)
+    start = time.perf_counter()
+    for offset in range(0, rows, batch_size):
+        count = min(batch_size, rows - offset)
+        region_index = rng.integers(0, len(REGIONS), count)
+        centres = np.array([(lat, lng) for _, lat, lng in REGIONS])[region_index]
+        lats = centres[:, 0] + rng.normal(0.0, 0.1, count)
+        lngs = centres[:, 1] + rng.normal(0.0, 0.15, count)
+        started_at = from_epoch_seconds(rng.integers(1_514_764_800, 1_546_300_800, count))
+        cells = origin_cells(lats, lngs)
+        batch = [
+            {
+                "region": REGIONS[index][0],
+                "origin_lat": lat,
+                "origin_lng": lng,
+                "destination_lat": lat,
+                "destination_lng": lng,
+                "started_at": started,
+                "datasource": "cheap_mobile",
+                "group_id": group_ids[index],
+                "origin_cell": cell,
+            }
+            for index, lat, lng, started, cell in zip(
+                region_index.tolist(), lats.tolist(), lngs.tolist(), started_at.tolist(), cells.tolist()
+            )
+        ]
+        with get_sync_session() as session:
+            session.execute(insert(Trip.__table__), batch)
+    print(f"Loaded {rows} trips in {time.perf_counter() - start:.1f}s")
+
+
+def random_boxes(count: int, rng: np.random.Generator) -> List[Tuple[Optional[str], BBox]]:
+    boxes = []
+    for index in range(count):
+        name, lat, lng = REGIONS[index % len(REGIONS)]
+        half_lat, half_lng = rng.uniform(0.005, 0.1), rng.uniform(0.005, 0.15)
+        lat += rng.normal(0.0, 0.05)
+        lng += rng.normal(0.0, 0.05)
+        region = name if index % 2 == 0 else None
+        boxes.append((region, (lat - half_lat, lng - half_lng, lat + half_lat, lng + half_lng)))
+    return boxes
+
+
+def cell_range_query(session, *, region: Optional[str], bbox: BBox) -> Tuple[float, int, int]:
+    """Raw trips by origin cell ranges over the whole box, without the rollup."""
+    trips = Trip.__table__
+    query = select(func.count(trips.c.id), func.min(trips.c.started_at), func.max(trips.c.started_at)).where(
+        *_trip_filters(trips, region, bbox), _origin_cell_filter(trips, bbox)
+    )
+    return _weekly_average(*session.execute(query).one())
+
+
+def set_legacy_indexes(enabled: bool) -> None:
+    """Toggle the single-column origin indexes the bounding-box query used before origin cells."""
+    with sync_engine.begin() as connection:
+        for column in ("origin_lat", "origin_lng"):
+            if enabled:
+                connection.exec_driver_sql(f"CREATE INDEX IF NOT EXISTS ix_trips_{column} ON trips ({column})")
+            else:
+                connection.exec_driver_sql(f"DROP INDEX IF EXISTS ix_trips_{column}")
+        connection.exec_driver_sql("ANALYZE")
+
+
+def run_variant(name: str, compute: Callable, boxes: List[Tuple[Optional[str], BBox]]) -> List[tuple]:
+    timings, results = [], []
+    with get_sync_session() as session:
+        for region, bbox in boxes:
+            start = time.perf_counter()
+            results.append(compute(session, region=region, bbox=bbox))
+            timings.append(time.perf_counter() - start)
+    print(
+        f"[{name}] median {statistics.median(timings) * 1000:.1f}ms, "
+        f"p95 {sorted(timings)[int(0.95 * (len(timings) - 1))] * 1000:.1f}ms over {len(boxes)} boxes"
+    )
+    return results
+
+
+def main() -> None:
+    args = parse_args()
+    rng = np.random.default_rng(args.seed)
+    if not args.reuse:
+        load_trips(args.rows, args.batch_size, rng)
+        with get_sync_session() as session:
+            rebuild_weekly_rollup(session)
+    boxes = random_boxes(args.boxes, rng)
+    set_legacy_indexes(True)
+    try:
+        baseline = run_variant("raw trips, lat/lng indexes", compute_weekly_average_from_trips, boxes)
+    finally:
+        set_legacy_indexes(False)
+    variants = [
+        ("raw trips, origin cell ranges", cell_range_query),
+        ("rollup + edge cell ranges", compute_weekly_average),
+    ]
+    for name, compute in variants:
+        if run_variant(name, compute, boxes) != baseline:
+            raise RuntimeError(f"{name} returned different results from the lat/lng query")
+
+
+if __name__ == "__main__":
+    main()
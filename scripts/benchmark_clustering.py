@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import argparse
+import math
+import resource
+import time
+from typing import Dict, List, Optional, Tuple
+
+from app.clustering import (
+    Anchor,
+    GroupKey,
+    NeighborCellStrategy,
+    distance_m,
+    get_clustering_strategy,
+)
+from app.crud import trip_group_keys
+from app.parsing import TripColumns, parse_csv_block
+from benchmarks.generator import FIELDNAMES, iter_blocks
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Compare exact-cell and neighbor-cell trip clustering in memory")
+    parser.add_argument("--rows", type=int, default=10_000_000, help="Synthetic trips to cluster")
+    parser.add_argument("--chunk-size", type=int, default=10_000, help="Trips assigned per call, like a chunk")
+    parser.add_argument("--seed", type=int, default=42, help="Seed for the synthetic trips")
+    parser.add_argument(
+        "--route-share",
+        type=float,
+        default=0.5,
+        help="Share of trips that repeat a recurring route, so that close trips exist to be grouped",
+    )
+    parser.add_argument(
+        "--max-cells",
+        type=int,
+        default=0,
+        help="Spatial hash cells kept in memory (0 keeps all); evicted cells are reloaded from the database in a job",
+    )
+    parser.add_argument(
+        "--pairwise-rows",
+        type=int,
+        default=5_000,
+        help="Also cluster this many trips by comparing every trip with every group, and check the results match",
+    )
+    return parser.parse_args()
+
+
+def chunks(rows: int, chunk_size: int, seed: int, route_share: float):
+    for block in iter_blocks(rows, seed, route_share=route_share):
+        columns = parse_csv_block(block, FIELDNAMES)
+        for start in range(0, columns.row_count, chunk_size):
+            yield TripColumns(*(_slice(value, start, chunk_size) for value in columns))
+
+
+def _slice(value, start: int, size: int):
+    return value if isinstance(value, list) else value[start : start + size]
+
+
+def chunk_keys(columns: TripColumns) -> Tuple[List[GroupKey], tuple]:
+    arrays = (
+        columns.origin_lat,
+        columns.origin_lng,
+        columns.destination_lat,
+        columns.destination_lng,
+        columns.started_at_seconds(),
+    )
+    return trip_group_keys(columns.region_values(), *arrays), arrays
+
+
+def pairwise(keys: List[GroupKey], arrays: tuple, strategy: NeighborCellStrategy) -> List[GroupKey]:
+    """The neighbor rules applied by comparing every trip with every group founded so far: O(n^2)."""
+    groups: Dict[GroupKey, Anchor] = {}
+    assigned: List[GroupKey] = []
+    for key, *trip in zip(keys, *(array.tolist() for array in arrays)):
+        origin_lat, origin_lng, destination_lat, destination_lng, started = trip
+        if key in groups:
+            assigned.append(key)
+            continue
+        best: Optional[GroupKey] = None
+        best_distance = math.inf
+        for group_key, anchor in groups.items():
+            if group_key[0] != key[0] or abs(anchor.started_at - started) > strategy.time_tolerance:
+                continue
+            origin = distance_m(origin_lat, origin_lng, anchor.origin_lat, anchor.origin_lng)
+            destination = distance_m(destination_lat, destination_lng, anchor.destination_lat, anchor.destination_lng)
+            within = origin <= strategy.distance_m and destination <= strategy.distance_m
+            if within and origin + destination < best_distance:
+                best, best_distance = group_key, origin + destination
+        if best is None:
+            groups[key] = Anchor(origin_lat, origin_lng, destination_lat, destination_lng, started)
+            best = key
+        assigned.append(best)
+    return assigned
+
+
+def main() -> None:
+    args = parse_args()
+    no_database = lambda cells: []  # noqa: E731
+    strategies = {
+        "exact": get_clustering_strategy("exact"),
+        "neighbor": NeighborCellStrategy(max_cells=args.max_cells or args.rows * 30),
+    }
+    seconds = {"keys": 0.0, **{name: 0.0 for name in strategies}}
+    # Key hashes rather than keys keep the distinct count of 10M exact keys in memory.
+    exact_groups = set()
+    neighbor_groups = 0
+    rows = 0
+    start = time.perf_counter()
+    for columns in chunks(args.rows, args.chunk_size, args.seed, args.route_share):
+        key_start = time.perf_counter()
+        keys, arrays = chunk_keys(columns)
+        seconds["keys"] += time.perf_counter() - key_start
+        for name, strategy in strategies.items():
+            assign_start = time.perf_counter()
+            assigned, founded = strategy.assign(keys, *arrays, no_database)
+            seconds[name] += time.perf_counter() - assign_start
+            if name == "exact":
+                exact_groups.update(map(hash, assigned))
+            else:
+                neighbor_groups += len(founded)
+        rows += len(keys)
+    print(f"Clustered {rows} trips in {time.perf_counter() - start:.1f}s (including generation and parsing)")
+    print(f"[group keys] {seconds['keys']:.1f}s -> {rows / seconds['keys']:,.0f} trips/s")
+    for name, group_count in (("exact", len(exact_groups)), ("neighbor", neighbor_groups)):
+        rate = rows / max(seconds[name], 1e-9)
+        print(f"[{name}] {seconds[name]:.1f}s -> {rate:,.0f} trips/s, {group_count:,} groups")
+    if args.max_cells:
+        # Without a database evicted cells reload empty, so groups in them are founded again.
+        print("Cells were evicted without a database to reload them from, so neighbor groups are over-counted")
+    print(f"Peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:,.0f} MiB")
+
+    if args.pairwise_rows:
+        columns = next(chunks(args.pairwise_rows, args.pairwise_rows, args.seed, args.route_share))
+        keys, arrays = chunk_keys(columns)
+        strategy = NeighborCellStrategy(max_cells=args.pairwise_rows * 30)
+        hashed_start = time.perf_counter()
+        hashed, _ = strategy.assign(keys, *arrays, no_database)
+        hashed_seconds = time.perf_counter() - hashed_start
+        pairwise_start = time.perf_counter()
+        expected = pairwise(keys, arrays, strategy)
+        pairwise_seconds = time.perf_counter() - pairwise_start
+        if hashed != expected:
+            raise RuntimeError("The spatial hash assigned different groups from the pairwise comparison")
+        print(
+            f"[{len(keys)} trips] spatial hash {hashed_seconds * 1000:.0f}ms, "
+            f"pairwise {pairwise_seconds * 1000:.0f}ms, identical groups"
+        )
+
+
+if __name__ == "__main__":
+    main()
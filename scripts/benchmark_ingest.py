@@ -3,40 +3,186 @@ from __future__ import annotations
 
 import argparse
 import asyncio
+import gzip
+import shutil
+import tempfile
 import time
+from itertools import product
 from pathlib import Path
 
+from app.clustering import CLUSTERING_STRATEGIES
+from app.config import settings
 from app.crud import create_ingestion_job
 from app.db import get_sync_session, sync_engine
+from app.formats import CSV, CSV_GZIP, CSV_ZSTD, PARQUET, ensure_available
 from app.ingestion import ingest_file
+from app.loaders import LOADERS, get_loader
 from app.models import Base, IngestionJob
 
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Benchmark ingestion throughput")
     parser.add_argument("csv", type=Path, help="Path to the CSV file to ingest")
+    parser.add_argument(
+        "--loader",
+        action="append",
+        choices=["auto", *LOADERS],
+        help="Trip loader backend to benchmark; repeat the flag to compare several side by side",
+    )
+    parser.add_argument(
+        "--grouping",
+        action="append",
+        choices=["cache", "staging"],
+        help="Trip grouping mode to benchmark; repeat the flag to compare both",
+    )
+    parser.add_argument(
+        "--clustering",
+        nargs="+",
+        choices=list(CLUSTERING_STRATEGIES),
+        help="Trip clustering strategies to benchmark",
+    )
+    parser.add_argument(
+        "--format",
+        nargs="+",
+        choices=[CSV, CSV_GZIP, CSV_ZSTD, PARQUET],
+        help="Input formats to benchmark; the CSV is converted to each one before timing starts",
+    )
+    parser.add_argument(
+        "--row-group-rows",
+        type=int,
+        default=100_000,
+        help="Rows per Parquet row group when converting to Parquet",
+    )
+    parser.add_argument(
+        "--queue-depth",
+        type=int,
+        nargs="+",
+        help="Pipeline queue depths to benchmark; 0 runs read, parse and write sequentially",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        nargs="+",
+        help="Ingestion worker process counts to benchmark, e.g. --workers 1 2 4 8",
+    )
+    parser.add_argument(
+        "--sqlite-profile",
+        nargs="+",
+        choices=["stock", "tuned"],
+        help="SQLite connection profiles to benchmark: stock pragmas or the WAL tuning profile",
+    )
+    parser.add_argument(
+        "--bulk-load",
+        nargs="+",
+        choices=["off", "on"],
+        help="Benchmark with trips indexes kept up to date per chunk (off) or rebuilt after the job (on)",
+    )
+    parser.add_argument(
+        "--metrics",
+        nargs="+",
+        choices=["off", "on"],
+        help="Benchmark with ingestion metrics disabled and/or enabled to measure their overhead",
+    )
     return parser.parse_args()
 
 
-async def run_benchmark(csv_path: Path) -> None:
+def convert_input(csv_path: Path, input_format: str, directory: Path, row_group_rows: int) -> Path:
+    if input_format == CSV:
+        return csv_path
+    ensure_available(input_format)
+    target = directory / f"{csv_path.stem}.{input_format}"
+    if input_format == CSV_GZIP:
+        with csv_path.open("rb") as source, gzip.open(target, "wb", compresslevel=6) as sink:
+            shutil.copyfileobj(source, sink)
+    elif input_format == CSV_ZSTD:
+        import zstandard
+
+        with csv_path.open("rb") as source, target.open("wb") as sink:
+            zstandard.ZstdCompressor().copy_stream(source, sink)
+    else:
+        import pyarrow as pa
+        import pyarrow.csv as pa_csv
+        import pyarrow.parquet as pq
+
+        options = pa_csv.ConvertOptions(column_types={"datetime": pa.string()})
+        pq.write_table(pa_csv.read_csv(csv_path, convert_options=options), target, row_group_size=row_group_rows)
+    return target
+
+
+def use_sqlite_profile(profile: str) -> None:
+    """Reconnect so the next connections pick up the profile's pragmas."""
+    settings.sqlite_tuning = profile == "tuned"
+    sync_engine.dispose()
+    if sync_engine.dialect.name == "sqlite" and profile == "stock":
+        # WAL is persistent in the database file, so it has to be switched back explicitly.
+        with sync_engine.connect() as connection:
+            connection.exec_driver_sql("PRAGMA journal_mode=DELETE")
+
+
+async def run_benchmark(
+    input_path: Path,
+    loader: str,
+    workers: int,
+    grouping: str,
+    clustering: str,
+    queue_depth: int,
+    profile: str,
+    bulk_load: str,
+    metrics: str,
+) -> None:
+    settings.ingestion_loader = loader
+    settings.ingestion_workers = workers
+    settings.ingestion_queue_depth = queue_depth
+    settings.ingestion_bulk_load = bulk_load == "on"
+    settings.metrics_enabled = metrics == "on"
+    use_sqlite_profile(profile)
+    resolved = get_loader(sync_engine.dialect.name).name
     Base.metadata.drop_all(bind=sync_engine)
     Base.metadata.create_all(bind=sync_engine)
     with get_sync_session() as session:
-        job = create_ingestion_job(session, filename=csv_path.name)
+        job = create_ingestion_job(
+            session, filename=input_path.name, grouping_mode=grouping, clustering=clustering
+        )
         job_id = job.id
     start = time.perf_counter()
-    await ingest_file(job_id, csv_path)
+    await ingest_file(job_id, input_path)
     elapsed = time.perf_counter() - start
     with get_sync_session() as session:
         job = session.get(IngestionJob, job_id)
     if job is None:
         raise RuntimeError("Ingestion job missing after benchmark")
-    print(f"Ingested {job.processed_rows} rows in {elapsed:.2f}s -> {job.processed_rows / elapsed:.2f} rows/s")
+    print(
+        f"[{input_path.name}, {resolved}, {grouping}, {clustering} clustering, {workers} worker(s), "
+        f"queue depth {queue_depth}, "
+        f"{profile} sqlite, bulk load {bulk_load}, metrics {metrics}] "
+        f"Ingested {job.processed_rows} rows in {elapsed:.2f}s -> {job.processed_rows / elapsed:.2f} rows/s "
+        f"(read {job.read_seconds:.2f}s, parse {job.parse_seconds:.2f}s, write {job.write_seconds:.2f}s)"
+    )
 
 
 def main() -> None:
     args = parse_args()
-    asyncio.run(run_benchmark(args.csv))
+    with tempfile.TemporaryDirectory() as directory:
+        inputs = [
+            convert_input(args.csv, input_format, Path(directory), args.row_group_rows)
+            for input_format in args.format or [CSV]
+        ]
+        for input_path, loader, grouping, clustering, workers, queue_depth, profile, bulk_load, metrics in product(
+            inputs,
+            args.loader or [settings.ingestion_loader],
+            args.grouping or [settings.grouping_mode],
+            args.clustering or [settings.clustering],
+            args.workers or [settings.ingestion_workers],
+            args.queue_depth or [settings.ingestion_queue_depth],
+            args.sqlite_profile or ["tuned" if settings.sqlite_tuning else "stock"],
+            args.bulk_load or ["on" if settings.ingestion_bulk_load else "off"],
+            args.metrics or ["on" if settings.metrics_enabled else "off"],
+        ):
+            asyncio.run(
+                run_benchmark(
+                    input_path, loader, workers, grouping, clustering, queue_depth, profile, bulk_load, metrics
+                )
+            )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import argparse
+import csv
+import time
+from datetime import datetime
+from pathlib import Path
+
+from app.clustering import parse_point
+from app.parsing import parse_csv_block
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Compare CSV parsing backends")
+    parser.add_argument("csv", type=Path, help="Path to the CSV file to parse, e.g. 1M synthetic rows")
+    parser.add_argument("--chunk-size", type=int, default=100_000, help="Rows handed to the columnar parser at once")
+    return parser.parse_args()
+
+
+def parse_legacy(csv_path: Path) -> int:
+    rows = 0
+    with csv_path.open("r", encoding="utf-8") as csvfile:
+        for record in csv.DictReader(csvfile):
+            parse_point(record["origin_coord"])
+            parse_point(record["destination_coord"])
+            datetime.fromisoformat(record["datetime"].strip())
+            rows += 1
+    return rows
+
+
+def parse_columnar(csv_path: Path, parser: str, chunk_size: int) -> int:
+    rows = 0
+    with csv_path.open("rb") as raw:
+        fieldnames = next(csv.reader([raw.readline().decode("utf-8")]))
+        lines = []
+        for line in raw:
+            lines.append(line)
+            if len(lines) >= chunk_size:
+                rows += parse_csv_block(b"".join(lines), fieldnames, parser=parser).row_count
+                lines = []
+        if lines:
+            rows += parse_csv_block(b"".join(lines), fieldnames, parser=parser).row_count
+    return rows
+
+
+def main() -> None:
+    args = parse_args()
+    runs = {
+        "legacy (DictReader + parse_point)": lambda: parse_legacy(args.csv),
+        "columnar (pandas)": lambda: parse_columnar(args.csv, "pandas", args.chunk_size),
+        "columnar (python)": lambda: parse_columnar(args.csv, "python", args.chunk_size),
+    }
+    for name, run in runs.items():
+        start = time.perf_counter()
+        rows = run()
+        elapsed = time.perf_counter() - start
+        print(f"{name}: {rows} rows in {elapsed:.2f}s -> {rows / elapsed:.2f} rows/s")
+
+
+if __name__ == "__main__":
+    main()
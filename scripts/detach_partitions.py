@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import argparse
+from datetime import datetime
+
+from app.db import get_sync_session
+from app.partitioning import detach_partitions
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Detach (or drop) trip partitions whose whole week is before a date")
+    parser.add_argument("before", type=datetime.fromisoformat, help="Cut-off date, e.g. 2018-06-01")
+    parser.add_argument("--drop", action="store_true", help="Drop detached tables instead of renaming them")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    with get_sync_session() as session:
+        tables = detach_partitions(session, args.before, drop=args.drop)
+    for table in tables:
+        print(f"{'Dropped' if args.drop else 'Detached'} {table}")
+    print(f"{len(tables)} partitions before {args.before:%Y-%m-%d}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import argparse
+import re
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from sqlalchemy import event, func, select
+from sqlalchemy.engine import Connection, Engine
+
+from app.crud import compute_weekly_average, list_trip_group_rollups, list_trip_groups, rebuild_trip_group_counts
+from app.db import SyncSessionLocal, get_sync_session, sync_engine
+from app.models import Trip, TripGroup, TripWeeklyRollup
+
+SQL_QUERIES = Path(__file__).resolve().parent.parent / "sql_queries.sql"
+
+# Index names in SQLite "EXPLAIN QUERY PLAN" rows and PostgreSQL "EXPLAIN" lines.
+INDEX_PATTERN = re.compile(
+    r"USING (?:COVERING )?INDEX (\w+)|Index (?:Only )?Scan (?:Backward )?using (\w+)|Bitmap Index Scan on (\w+)"
+)
+
+Statement = Tuple[str, Any]
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="EXPLAIN every endpoint query and report which indexes they use")
+    parser.add_argument("--region", help="Region for the region filters; defaults to the most common one")
+    parser.add_argument(
+        "--bbox",
+        type=float,
+        nargs=4,
+        metavar=("MIN_LAT", "MIN_LNG", "MAX_LAT", "MAX_LNG"),
+        help="Bounding box for the weekly-average queries; defaults to one around the region's trips",
+    )
+    parser.add_argument("--analyze", action="store_true", help="Run ANALYZE first so the planner has statistics")
+    parser.add_argument("--plans", action="store_true", help="Print the full plan of every query")
+    return parser.parse_args()
+
+
+@contextmanager
+def captured_statements(engine: Engine) -> Iterator[List[Statement]]:
+    """Record the read statements ``engine`` executes, with their driver-level parameters."""
+    captured: List[Statement] = []
+
+    def record(connection, cursor, statement, parameters, context, executemany) -> None:
+        if not executemany and statement.lstrip().upper().startswith(("SELECT", "WITH")):
+            captured.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        yield captured
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+
+
+def explain(connection: Connection, statement: str, parameters: Any) -> List[str]:
+    if connection.dialect.name == "sqlite":
+        return [row[-1] for row in connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters)]
+    return [row[0] for row in connection.exec_driver_sql(f"EXPLAIN {statement}", parameters)]
+
+
+def indexes_used(plan: List[str]) -> List[str]:
+    return sorted({name for line in plan for match in INDEX_PATTERN.finditer(line) for name in match.groups() if name})
+
+
+def sample_filters(region: Optional[str], bbox: Optional[List[float]]) -> Tuple[str, Tuple[float, ...]]:
+    with get_sync_session() as session:
+        if region is None:
+            region = session.execute(
+                select(Trip.region).group_by(Trip.region).order_by(func.count().desc()).limit(1)
+            ).scalar()
+            region = region or "Prague"
+        if bbox is None:
+            lat, lng = session.execute(
+                select(func.avg(Trip.origin_lat), func.avg(Trip.origin_lng)).where(Trip.region == region)
+            ).one()
+            lat, lng = lat or 50.08, lng or 14.43
+            bbox = [lat - 0.05, lng - 0.08, lat + 0.05, lng + 0.08]
+    return region, tuple(bbox)
+
+
+def endpoint_queries(region: str, bbox: Tuple[float, ...]) -> Dict[str, Callable]:
+    queries: Dict[str, Callable] = {
+        "GET /trip-groups": lambda session: list_trip_groups(session, limit=50),
+        "GET /trip-groups?after_count&after_id": lambda session: list_trip_groups(
+            session, limit=50, after_count=1, after_id=1_000_000
+        ),
+        "GET /trip-groups?region": lambda session: list_trip_groups(session, limit=50, region=region),
+        "GET /trip-groups/rollup?geohash_precision=3&bucket_minutes=1440": lambda session: list_trip_group_rollups(
+            session, geohash_precision=3, bucket_minutes=1440
+        ),
+        "GET /trip-groups/rollup?geohash_precision=2&bucket_minutes=2880": lambda session: list_trip_group_rollups(
+            session, geohash_precision=2, bucket_minutes=2880
+        ),
+        "GET /analytics/weekly-average?region": lambda session: compute_weekly_average(session, region=region),
+        "GET /analytics/weekly-average?bbox": lambda session: compute_weekly_average(session, bbox=bbox),
+        "GET /analytics/weekly-average?region&bbox": lambda session: compute_weekly_average(
+            session, region=region, bbox=bbox
+        ),
+    }
+    # The group_id index serves maintenance rather than an endpoint.
+    queries["crud.rebuild_trip_group_counts"] = rebuild_trip_group_counts
+    sql = "\n".join(line for line in SQL_QUERIES.read_text().splitlines() if not line.lstrip().startswith("--"))
+    statements = [statement.strip() for statement in sql.split(";") if statement.strip()]
+    for number, statement in enumerate(statements, start=1):
+        queries[f"sql_queries.sql #{number}"] = raw_query(statement)
+    return queries
+
+
+def raw_query(statement: str) -> Callable:
+    return lambda session: session.connection().exec_driver_sql(statement).all()
+
+
+def main() -> None:
+    args = parse_args()
+    if args.analyze:
+        with sync_engine.begin() as connection:
+            connection.exec_driver_sql("ANALYZE")
+    region, bbox = sample_filters(args.region, args.bbox)
+    print(f"Region {region!r}, bounding box {bbox}\n")
+
+    usage: Dict[str, List[str]] = {}
+    for label, run in endpoint_queries(region, bbox).items():
+        # Queries run in a transaction that is rolled back, so maintenance queries change nothing.
+        with SyncSessionLocal() as session, captured_statements(sync_engine) as statements:
+            run(session)
+            session.rollback()
+        with sync_engine.connect() as connection:
+            plans = [explain(connection, statement, parameters) for statement, parameters in statements]
+        used = sorted({name for plan in plans for name in indexes_used(plan)})
+        for name in used:
+            usage.setdefault(name, []).append(label)
+        print(f"{label}: {len(statements)} statement(s), indexes: {', '.join(used) or 'none (full scan)'}")
+        if args.plans:
+            for plan in plans:
+                print("\n".join(f"    {line}" for line in plan))
+
+    print("\nIndex usage:")
+    for table in (Trip.__table__, TripGroup.__table__, TripWeeklyRollup.__table__):
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            print(f"  {index.name}: {', '.join(usage.get(index.name, [])) or 'UNUSED'}")
+
+
+if __name__ == "__main__":
+    main()
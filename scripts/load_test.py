@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import argparse
+import asyncio
+import time
+from typing import Dict, List
+
+import httpx
+
+DEFAULT_ENDPOINTS = [
+    "/trip-groups?limit=50",
+    "/analytics/weekly-average?region=Prague",
+    "/analytics/weekly-average?min_lat=49.9&max_lat=50.2&min_lng=14.2&max_lng=14.7",
+    "/health",
+]
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Measure read endpoint latency under concurrency")
+    parser.add_argument("--base-url", default="http://localhost:8000", help="Base URL of a running API")
+    parser.add_argument("--concurrency", type=int, default=32, help="Concurrent clients per endpoint")
+    parser.add_argument("--requests", type=int, default=500, help="Requests per endpoint")
+    parser.add_argument(
+        "--endpoint",
+        action="append",
+        help="Path (with query string) to load; repeat to test several. Defaults to every read endpoint",
+    )
+    return parser.parse_args()
+
+
+def percentile(samples: List[float], fraction: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+
+async def load_endpoint(client: httpx.AsyncClient, path: str, total: int, concurrency: int) -> Dict[str, float]:
+    latencies: List[float] = []
+    errors = 0
+    remaining = iter(range(total))
+
+    async def worker() -> None:
+        nonlocal errors
+        for _ in remaining:
+            start = time.perf_counter()
+            try:
+                response = await client.get(path)
+                if response.status_code >= 500:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    return {
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "rps": len(latencies) / elapsed,
+        "errors": errors,
+    }
+
+
+async def run(args: argparse.Namespace) -> None:
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.base_url, limits=limits, timeout=30.0) as client:
+        for path in args.endpoint or DEFAULT_ENDPOINTS:
+            result = await load_endpoint(client, path, args.requests, args.concurrency)
+            print(
+                f"{path}: p50 {result['p50_ms']:.1f}ms, p99 {result['p99_ms']:.1f}ms, "
+                f"{result['rps']:.1f} req/s, {result['errors']} errors"
+            )
+
+
+def main() -> None:
+    asyncio.run(run(parse_args()))
+
+
+if __name__ == "__main__":
+    main()
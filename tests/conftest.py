@@ -0,0 +1,6 @@
+import os
+
+# Configure environment before any test module imports the application settings
+os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite:///./test_tripdata.db")
+os.environ.setdefault("SYNC_DATABASE_URL", "sqlite:///./test_tripdata.db")
+os.environ.setdefault("ENVIRONMENT", "test")
@@ -0,0 +1,410 @@
+import random
+from collections import Counter
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Float,
+    ForeignKey,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    UniqueConstraint,
+    delete,
+    event,
+    inspect,
+    select,
+)
+
+from app import config, main
+from app.clustering import encode_geohash
+from app.crud import (
+    RollupLevel,
+    add_missing_columns,
+    backfill_weekly_rollup,
+    choose_rollup_level,
+    compute_weekly_average,
+    compute_weekly_average_from_trips,
+    create_ingestion_job,
+    create_trip_indexes,
+    drop_legacy_trip_indexes,
+    list_trip_group_rollups,
+    rebuild_group_rollups,
+    rebuild_weekly_rollup,
+    sync_group_rollup_levels,
+)
+from app.db import get_sync_session, sync_engine
+from app.ingestion import ingest_file
+from app.models import Base, IngestionJob, Trip, TripGroup, TripGroupRollup, TripWeeklyRollup
+
+# ``trip_groups``, ``trips`` and ``ingestion_jobs`` as the original schema created them.
+BASELINE = MetaData()
+Table(
+    "trip_groups",
+    BASELINE,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("region", String, index=True, nullable=False),
+    Column("origin_geohash", String, index=True, nullable=False),
+    Column("destination_geohash", String, index=True, nullable=False),
+    Column("time_bucket_start", DateTime, index=True, nullable=False),
+    Column("time_bucket_minutes", Integer, nullable=False),
+    UniqueConstraint("region", "origin_geohash", "destination_geohash", "time_bucket_start", name="uq_trip_group"),
+)
+Table(
+    "trips",
+    BASELINE,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("region", String, index=True, nullable=False),
+    Column("origin_lat", Float, index=True, nullable=False),
+    Column("origin_lng", Float, index=True, nullable=False),
+    Column("destination_lat", Float, index=True, nullable=False),
+    Column("destination_lng", Float, index=True, nullable=False),
+    Column("started_at", DateTime, index=True, nullable=False),
+    Column("datasource", String, index=True, nullable=False),
+    Column("group_id", Integer, ForeignKey("trip_groups.id"), nullable=False),
+)
+Table(
+    "ingestion_jobs",
+    BASELINE,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("filename", String, nullable=False),
+    Column("status", String, index=True, nullable=False),
+    Column("created_at", DateTime, nullable=False),
+    Column("updated_at", DateTime, nullable=False),
+    Column("total_rows", Integer, nullable=True),
+    Column("processed_rows", Integer, nullable=True),
+    Column("message", String, nullable=True),
+)
+
+# Width of a rollup cell at precision 6 on each axis.
+LAT_CELL = 180.0 / (1 << 15)
+LNG_CELL = 360.0 / (1 << 15)
+
+
+@pytest.fixture(autouse=True)
+def clean_database():
+    Base.metadata.drop_all(bind=sync_engine)
+    Base.metadata.create_all(bind=sync_engine)
+    yield
+    Base.metadata.drop_all(bind=sync_engine)
+
+
+def write_random_trips(path, count=400, seed=7):
+    rng = random.Random(seed)
+    start = datetime(2018, 1, 1)
+    lines = ["region,origin_coord,destination_coord,datetime,datasource"]
+    for _ in range(count):
+        lat = rng.uniform(49.95, 50.15)
+        lng = rng.uniform(14.3, 14.6)
+        if rng.random() < 0.2:
+            # Snap onto a rollup cell edge to exercise the boundary rules.
+            lat = round(lat / LAT_CELL) * LAT_CELL
+            lng = round(lng / LNG_CELL) * LNG_CELL
+        started_at = start + timedelta(minutes=rng.randint(0, 60 * 24 * 120))
+        region = rng.choice(["Prague", "Brno"])
+        lines.append(
+            f"{region},POINT ({lng!r} {lat!r}),POINT ({lng + 0.01!r} {lat + 0.01!r}),"
+            f"{started_at:%Y-%m-%d %H:%M:%S},cheap_mobile"
+        )
+    path.write_text("\n".join(lines) + "\n")
+
+
+async def ingest(path):
+    with get_sync_session() as session:
+        job_id = create_ingestion_job(session, filename=path.name).id
+    await ingest_file(job_id, path)
+
+
+def random_bboxes(seed=11, count=60):
+    rng = random.Random(seed)
+    boxes = [(49.9, 14.2, 50.2, 14.7), (50.0, 14.4, 50.0, 14.4)]
+    for _ in range(count):
+        lat_a, lat_b = sorted(rng.uniform(49.95, 50.15) for _ in range(2))
+        lng_a, lng_b = sorted(rng.uniform(14.3, 14.6) for _ in range(2))
+        if rng.random() < 0.3:
+            lat_a, lat_b = (round(value / LAT_CELL) * LAT_CELL for value in (lat_a, lat_b))
+            lng_a, lng_b = (round(value / LNG_CELL) * LNG_CELL for value in (lng_a, lng_b))
+        boxes.append((lat_a, lng_a, lat_b, lng_b))
+    return boxes
+
+
+@pytest.mark.asyncio
+async def test_weekly_average_rollup_matches_raw_trips(tmp_path, monkeypatch):
+    monkeypatch.setattr(config.settings, "ingestion_chunk_size", 64)
+    csv_path = tmp_path / "random.csv"
+    write_random_trips(csv_path)
+    await ingest(csv_path)
+
+    with get_sync_session() as session:
+        for region in (None, "Prague"):
+            assert compute_weekly_average(session, region=region) == compute_weekly_average_from_trips(
+                session, region=region
+            )
+            for bbox in random_bboxes():
+                assert compute_weekly_average(session, region=region, bbox=bbox) == compute_weekly_average_from_trips(
+                    session, region=region, bbox=bbox
+                ), bbox
+
+
+@pytest.mark.asyncio
+async def test_rebuild_weekly_rollup_restores_rollup(tmp_path):
+    csv_path = tmp_path / "random.csv"
+    write_random_trips(csv_path, count=100)
+    await ingest(csv_path)
+    bbox = (49.97, 14.35, 50.12, 14.55)
+    with get_sync_session() as session:
+        expected = compute_weekly_average(session, bbox=bbox)
+
+    with get_sync_session() as session:
+        rebuild_weekly_rollup(session, batch_size=30)
+    with get_sync_session() as session:
+        assert compute_weekly_average(session, bbox=bbox) == expected
+        assert compute_weekly_average(session) == compute_weekly_average_from_trips(session)
+
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def trip_counts(session, precision, minutes):
+    """Trip counts per region, cell pair and bucket start (epoch seconds) computed from the raw trips."""
+    counts = Counter()
+    for trip in session.execute(select(Trip)).scalars():
+        seconds = int((trip.started_at - EPOCH).total_seconds())
+        origin = encode_geohash(trip.origin_lat, trip.origin_lng, precision)
+        destination = encode_geohash(trip.destination_lat, trip.destination_lng, precision)
+        counts[(trip.region, origin, destination, seconds - seconds % (minutes * 60))] += 1
+    return counts
+
+
+def rollup_counts(session):
+    counts = {}
+    for row in session.execute(select(TripGroupRollup)).scalars():
+        level = counts.setdefault((row.geohash_precision, row.bucket_minutes), {})
+        level[(row.region, row.origin_geohash, row.destination_geohash, row.bucket_start)] = row.trip_count
+    return counts
+
+
+def test_choose_rollup_level_picks_the_coarsest_nesting_level(monkeypatch):
+    with pytest.raises(ValueError, match="disabled"):
+        choose_rollup_level(3, 1440)
+    monkeypatch.setattr(config.settings, "group_rollup_precisions", [3, 4, 5])
+    assert choose_rollup_level(3, 1440) == RollupLevel(3, 1440)
+    assert choose_rollup_level(2, 120) == RollupLevel(3, 60)
+    assert choose_rollup_level(4, 45) == RollupLevel(4, 15)
+    assert choose_rollup_level(5, 7 * 1440) == RollupLevel(5, 1440)
+    with pytest.raises(ValueError):
+        choose_rollup_level(6, 60)
+    with pytest.raises(ValueError):
+        choose_rollup_level(3, 10)
+
+
+@pytest.mark.asyncio
+async def test_group_rollups_agree_with_trips_at_every_level(tmp_path, monkeypatch):
+    monkeypatch.setattr(config.settings, "group_rollup_precisions", [3, 4, 5])
+    monkeypatch.setattr(config.settings, "ingestion_chunk_size", 64)
+    csv_path = tmp_path / "random.csv"
+    write_random_trips(csv_path)
+    await ingest(csv_path)
+
+    with get_sync_session() as session:
+        stored = rollup_counts(session)
+        for precision in (3, 4, 5):
+            for minutes in (15, 60, 1440):
+                assert stored[(precision, minutes)] == trip_counts(session, precision, minutes), (precision, minutes)
+                assert sum(stored[(precision, minutes)].values()) == 400
+
+        # Two-hour buckets at precision 2 merge the (3, 60) level; bounds are rounded up to whole buckets.
+        level, rows = list_trip_group_rollups(
+            session,
+            geohash_precision=2,
+            bucket_minutes=120,
+            limit=10_000,
+            region="Prague",
+            bucket_from=datetime(2018, 2, 1, 1, 30),
+            bucket_to=datetime(2018, 3, 1),
+        )
+        first, end = (int((bound - EPOCH).total_seconds()) for bound in (datetime(2018, 2, 1, 2), datetime(2018, 3, 1)))
+        expected = {
+            key[1:]: count
+            for key, count in trip_counts(session, 2, 120).items()
+            if key[0] == "Prague" and first <= key[3] < end
+        }
+        assert level == RollupLevel(3, 60)
+        assert {row[1:4]: row.trip_count for row in rows} == expected
+        assert [row.trip_count for row in rows] == sorted((row.trip_count for row in rows), reverse=True)
+
+    with get_sync_session() as session:
+        rebuild_group_rollups(session, batch_size=30)
+    with get_sync_session() as session:
+        assert rollup_counts(session) == stored
+
+
+@pytest.mark.asyncio
+async def test_startup_rebuilds_group_rollups_when_the_configured_levels_change(tmp_path, monkeypatch):
+    monkeypatch.setattr(config.settings, "resume_jobs_on_startup", False)
+    csv_path = tmp_path / "random.csv"
+    write_random_trips(csv_path, count=100)
+    await ingest(csv_path)
+
+    monkeypatch.setattr(config.settings, "group_rollup_precisions", [3, 4])
+    await main.startup()
+    await main.scheduler.stop()
+    with get_sync_session() as session:
+        stored = rollup_counts(session)
+        assert sorted(stored) == [(precision, minutes) for precision in (3, 4) for minutes in (15, 60, 1440)]
+        for (precision, minutes), counts in stored.items():
+            assert counts == trip_counts(session, precision, minutes), (precision, minutes)
+        assert not sync_group_rollup_levels(session)
+
+    monkeypatch.setattr(config.settings, "group_rollup_precisions", [])
+    with get_sync_session() as session:
+        assert sync_group_rollup_levels(session)
+    with get_sync_session() as session:
+        assert rollup_counts(session) == {}
+
+
+def test_trip_index_profile_serves_the_analytics_queries():
+    with sync_engine.begin() as connection:
+        connection.exec_driver_sql("CREATE INDEX ix_trips_destination_lat ON trips (destination_lat)")
+        drop_legacy_trip_indexes(connection)
+        indexes = {index["name"] for index in inspect(connection).get_indexes("trips")}
+        plan = connection.exec_driver_sql(
+            "EXPLAIN QUERY PLAN SELECT DISTINCT region FROM trips WHERE datasource = 'cheap_mobile' ORDER BY region"
+        ).all()
+
+    assert indexes == {
+        "ix_trips_region_started_at",
+        "ix_trips_datasource_region",
+        "ix_trips_region_origin_cell_started_at",
+        "ix_trips_origin_cell_started_at",
+        "ix_trips_group_id",
+    }
+    assert "COVERING INDEX ix_trips_datasource_region" in plan[0][-1]
+
+
+@pytest.mark.asyncio
+async def test_missing_columns_are_added_to_a_baseline_schema_and_backfilled(tmp_path):
+    csv_path = tmp_path / "trips.csv"
+    write_random_trips(csv_path, count=60)
+    await ingest(csv_path)
+    bbox = (49.95, 14.3, 50.1, 14.55)
+    with get_sync_session() as session:
+        expected_average = compute_weekly_average(session, bbox=bbox)
+    with sync_engine.begin() as connection:
+        expected_counts = dict(connection.execute(select(TripGroup.id, TripGroup.trip_count)).all())
+        expected_cells = dict(connection.execute(select(Trip.id, Trip.origin_cell)).all())
+        for table in (Trip.__table__, TripGroup.__table__):
+            rows = connection.execute(select(*(table.c[column.name] for column in BASELINE.tables[table.name].c)))
+            rows = [row._asdict() for row in rows]
+            table.drop(connection)
+            BASELINE.tables[table.name].create(connection)
+            connection.execute(BASELINE.tables[table.name].insert(), rows)
+
+    with sync_engine.begin() as connection:
+        # The startup sequence.
+        added = add_missing_columns(connection, batch_size=7)
+        drop_legacy_trip_indexes(connection)
+        create_trip_indexes(connection)
+    with sync_engine.begin() as connection:
+        assert add_missing_columns(connection) == {}
+        group_indexes = {index["name"] for index in inspect(connection).get_indexes("trip_groups")}
+        trip_indexes = {index["name"] for index in inspect(connection).get_indexes("trips")}
+        counts = dict(connection.execute(select(TripGroup.id, TripGroup.trip_count)).all())
+        cells = dict(connection.execute(select(Trip.id, Trip.origin_cell)).all())
+    with get_sync_session() as session:
+        average = compute_weekly_average(session, bbox=bbox)
+
+    assert added["trip_groups"][0] == "trip_count" and len(added["trip_groups"]) == 6
+    assert added["trips"] == ["origin_cell"]
+    assert "ix_trip_groups_trip_count" in group_indexes
+    assert trip_indexes == {index.name for index in Trip.__table__.indexes}
+    assert counts == expected_counts and sum(counts.values()) == 60
+    assert cells == expected_cells
+    assert average == expected_average and average[1] > 0
+
+
+@pytest.mark.asyncio
+async def test_startup_upgrades_baseline_ingestion_jobs_and_fails_their_orphans(monkeypatch):
+    monkeypatch.setattr(config.settings, "resume_jobs_on_startup", True)
+    jobs = BASELINE.tables["ingestion_jobs"]
+    created = datetime(2018, 6, 1)
+    with sync_engine.begin() as connection:
+        IngestionJob.__table__.drop(connection)
+        jobs.create(connection)
+        connection.execute(
+            jobs.insert(),
+            [
+                {"filename": "done.csv", "status": "completed", "created_at": created, "updated_at": created},
+                {"filename": "cut.csv", "status": "running", "created_at": created, "updated_at": created},
+            ],
+        )
+
+    await main.startup()
+    await main.scheduler.stop()
+
+    with get_sync_session() as session:
+        done, cut = session.execute(select(IngestionJob).order_by(IngestionJob.id)).scalars().all()
+        assert (done.status, done.grouping_mode, done.clustering, done.priority, done.write_seconds) == (
+            "completed",
+            "cache",
+            "exact",
+            0,
+            0.0,
+        )
+        assert cut.status == "failed" and cut.source_path is None
+    assert "ix_ingestion_jobs_queue" in {index["name"] for index in inspect(sync_engine).get_indexes("ingestion_jobs")}
+
+
+@pytest.mark.asyncio
+async def test_startup_builds_an_empty_weekly_rollup_from_existing_trips(tmp_path, monkeypatch):
+    monkeypatch.setattr(config.settings, "resume_jobs_on_startup", False)
+    csv_path = tmp_path / "trips.csv"
+    write_random_trips(csv_path)
+    await ingest(csv_path)
+    with get_sync_session() as session:
+        expected = compute_weekly_average(session, region="Prague")
+        # As if the trips had been ingested before the rollup existed.
+        session.execute(delete(TripWeeklyRollup))
+    with get_sync_session() as session:
+        assert compute_weekly_average(session, region="Prague") == (0.0, 0, 0)
+
+    await main.startup()
+    await main.scheduler.stop()
+
+    with get_sync_session() as session:
+        assert compute_weekly_average(session, region="Prague") == expected
+        assert not backfill_weekly_rollup(session)
+    assert expected[1] > 0
+
+
+@pytest.mark.asyncio
+async def test_weekly_average_bbox_without_region_searches_trips_by_origin_cell(tmp_path):
+    csv_path = tmp_path / "trips.csv"
+    write_random_trips(csv_path)
+    await ingest(csv_path)
+    statements = []
+
+    def record(connection, cursor, statement, parameters, context, executemany):
+        if "FROM trips" in statement:
+            statements.append((statement, parameters))
+
+    event.listen(sync_engine, "before_cursor_execute", record)
+    try:
+        with get_sync_session() as session:
+            compute_weekly_average(session, bbox=(50.0, 14.35, 50.1, 14.5))
+    finally:
+        event.remove(sync_engine, "before_cursor_execute", record)
+    with sync_engine.connect() as connection:
+        plan = [
+            row[-1]
+            for statement, parameters in statements
+            for row in connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters)
+        ]
+
+    # The edge strips are range scans over origin cells, never a scan of the whole table.
+    assert statements
+    assert not [line for line in plan if line.startswith("SCAN trips")]
+    assert any(line.startswith("SEARCH trips") and "origin_cell>?" in line for line in plan)
@@ -0,0 +1,351 @@
+import asyncio
+import gzip
+
+import httpx
+import pytest
+import pytest_asyncio
+
+from app.cache import analytics_cache
+from app.config import settings
+from app.crud import create_ingestion_job
+from app.db import engine_options, get_sync_session, sync_engine
+import app.ingestion as ingestion
+from app.ingestion import ingest_file, scheduler
+from app.main import app
+from app.models import Base
+
+from .test_ingestion import write_sample_csv
+
+
+@pytest.fixture(autouse=True)
+def clean_database():
+    Base.metadata.drop_all(bind=sync_engine)
+    Base.metadata.create_all(bind=sync_engine)
+    analytics_cache.invalidate()
+    yield
+    Base.metadata.drop_all(bind=sync_engine)
+
+
+@pytest_asyncio.fixture
+async def client():
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        yield client
+
+
+async def ingest_sample(tmp_path) -> int:
+    csv_path = tmp_path / "sample.csv"
+    write_sample_csv(csv_path)
+    with get_sync_session() as session:
+        job_id = create_ingestion_job(session, filename=csv_path.name).id
+    await ingest_file(job_id, csv_path)
+    return job_id
+
+
+@pytest.mark.asyncio
+async def test_trip_groups_pages_by_keyset_filters_and_caches(tmp_path, client):
+    csv_path = tmp_path / "sample.csv"
+    write_sample_csv(csv_path)
+    lines = csv_path.read_text().splitlines(keepends=True)
+    # Three groups holding three, two and one trips.
+    csv_path.write_text("".join(lines[:1] + lines[1:2] * 3 + lines[2:3] * 2 + lines[3:4]))
+    with get_sync_session() as session:
+        job_id = create_ingestion_job(session, filename=csv_path.name).id
+    await ingest_file(job_id, csv_path)
+
+    first = (await client.get("/trip-groups", params={"limit": 2})).json()
+    assert [group["trip_count"] for group in first["groups"]] == [3, 2]
+    second = (
+        await client.get(
+            "/trip-groups",
+            params={"limit": 2, "after_count": first["next_after_count"], "after_id": first["next_after_id"]},
+        )
+    ).json()
+    assert [group["trip_count"] for group in second["groups"]] == [1]
+    assert second["next_after_count"] is None
+
+    prefix = first["groups"][0]["origin_geohash"][:4]
+    filtered = (await client.get("/trip-groups", params={"geohash_prefix": prefix, "region": "Prague"})).json()
+    assert all(group["origin_geohash"].startswith(prefix) for group in filtered["groups"])
+    late = (await client.get("/trip-groups", params={"bucket_from": "2018-05-20T00:00:00"})).json()
+    assert sorted(group["time_bucket_start"][:10] for group in late["groups"]) == ["2018-05-20", "2018-05-28"]
+    assert (await client.get("/trip-groups", params={"after_count": 3})).status_code == 400
+    assert (await client.get("/trip-groups", params={"limit": 0})).status_code == 422
+
+    hits = analytics_cache.hits
+    assert (await client.get("/trip-groups", params={"limit": 2})).json() == first
+    assert analytics_cache.hits == hits + 1
+
+    csv_path.write_text("".join(lines[:1] + lines[3:4] * 3))
+    with get_sync_session() as session:
+        job_id = create_ingestion_job(session, filename=csv_path.name).id
+    await ingest_file(job_id, csv_path)
+    refreshed = (await client.get("/trip-groups", params={"limit": 2})).json()
+    assert [group["trip_count"] for group in refreshed["groups"]] == [4, 3]
+
+
+@pytest.mark.asyncio
+async def test_read_endpoints_use_async_sessions(tmp_path, client):
+    job_id = await ingest_sample(tmp_path)
+
+    job = await client.get(f"/jobs/{job_id}")
+    groups = await client.get("/trip-groups", params={"limit": 10})
+    average = await client.get("/analytics/weekly-average", params={"region": "Prague"})
+
+    assert job.status_code == 200
+    assert job.json()["status"] == "completed"
+    assert job.json()["processed_rows"] == 3
+    assert groups.status_code == 200
+    assert sum(group["trip_count"] for group in groups.json()["groups"]) == 3
+    assert average.status_code == 200
+    assert average.json()["total_trips"] == 3
+
+
+@pytest.mark.asyncio
+async def test_trip_group_rollup_answers_from_the_coarsest_level(tmp_path, client, monkeypatch):
+    monkeypatch.setattr(settings, "group_rollup_precisions", [3, 4, 5])
+    await ingest_sample(tmp_path)
+
+    daily = await client.get("/trip-groups/rollup", params={"geohash_precision": 2, "bucket_minutes": 2880})
+    hourly = await client.get("/trip-groups/rollup", params={"geohash_prefix": "u2"})
+
+    assert daily.status_code == 200
+    body = daily.json()
+    assert (body["level_geohash_precision"], body["level_bucket_minutes"]) == (3, 1440)
+    assert sum(group["trip_count"] for group in body["groups"]) == 3
+    assert all(len(group["origin_geohash"]) == 2 for group in body["groups"])
+    assert all(group["time_bucket_minutes"] == 2880 for group in body["groups"])
+    assert (hourly.json()["level_geohash_precision"], hourly.json()["level_bucket_minutes"]) == (5, 60)
+    assert all(group["origin_geohash"].startswith("u2") for group in hourly.json()["groups"])
+    hits = analytics_cache.hits
+    assert (
+        await client.get("/trip-groups/rollup", params={"geohash_precision": 2, "bucket_minutes": 2880})
+    ).json() == body
+    assert analytics_cache.hits == hits + 1
+    assert (await client.get("/trip-groups/rollup", params={"geohash_precision": 6})).status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_ingestion_invalidates_only_cached_results_for_the_regions_it_touched(tmp_path, client):
+    await ingest_sample(tmp_path)
+    prague = (await client.get("/analytics/weekly-average", params={"region": "Prague"})).json()
+    everywhere = (await client.get("/trip-groups", params={"limit": 10})).json()
+
+    csv_path = tmp_path / "brno.csv"
+    csv_path.write_text(
+        "region,origin_coord,destination_coord,datetime,datasource\n"
+        "Brno,POINT (16.6 49.19),POINT (16.62 49.2),2018-05-21 10:00:00,funny_car\n"
+    )
+    with get_sync_session() as session:
+        job_id = create_ingestion_job(session, filename=csv_path.name).id
+    await ingest_file(job_id, csv_path)
+
+    hits = analytics_cache.hits
+    assert (await client.get("/analytics/weekly-average", params={"region": "Prague"})).json() == prague
+    assert analytics_cache.hits == hits + 1
+    refreshed = (await client.get("/trip-groups", params={"limit": 10})).json()
+    assert analytics_cache.hits == hits + 1
+    assert len(refreshed["groups"]) == len(everywhere["groups"]) + 1
+
+    stats = (await client.get("/cache/stats")).json()
+    assert stats["hits"] == analytics_cache.hits
+    assert stats["entries"] == 2
+    assert stats["bytes"] > 0
+    assert 0 < stats["hit_ratio"] < 1
+
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint_and_job_summary(tmp_path, client, monkeypatch):
+    job_id = await ingest_sample(tmp_path)
+    await client.get("/analytics/weekly-average", params={"region": "Prague"})
+
+    summary = (await client.get(f"/jobs/{job_id}")).json()["metrics"]
+    exposition = await client.get("/metrics")
+
+    assert summary["chunks"] == 1
+    assert summary["db_round_trips"] >= summary["chunks"]
+    assert summary["group_cache_hit_rate"] == 0.0
+    assert {"geohash", "group_lookup", "insert", "rollup", "commit"} <= set(summary["stage_seconds"])
+    assert exposition.status_code == 200
+    assert exposition.headers["content-type"].startswith("text/plain")
+    assert 'ingestion_stage_seconds_bucket{stage="group_lookup",le="+Inf"}' in exposition.text
+    assert 'analytics_query_seconds_count{query="weekly_average"}' in exposition.text
+
+    monkeypatch.setattr(settings, "metrics_enabled", False)
+    assert (await client.get("/metrics")).status_code == 404
+    job_id = await ingest_sample(tmp_path)
+    assert (await client.get(f"/jobs/{job_id}")).json()["metrics"] is None
+
+
+@pytest.mark.asyncio
+async def test_missing_job_returns_404(client):
+    response = await client.get("/jobs/999")
+
+    assert response.status_code == 404
+
+
+def test_engine_options_follow_settings(monkeypatch):
+    monkeypatch.setattr(settings, "db_pool_size", 7)
+    monkeypatch.setattr(settings, "db_statement_timeout_ms", 1500)
+
+    file_sqlite = engine_options("sqlite:///./file.db")
+    memory_sqlite = engine_options("sqlite://")
+    asyncpg = engine_options("postgresql+asyncpg://user@host/db")
+    psycopg = engine_options("postgresql://user@host/db")
+
+    assert file_sqlite["pool_size"] == 7
+    assert "pool_size" not in memory_sqlite
+    assert "connect_args" not in file_sqlite
+    assert asyncpg["connect_args"] == {"server_settings": {"statement_timeout": "1500"}}
+    assert psycopg["connect_args"] == {"options": "-c statement_timeout=1500"}
+
+
+def test_sqlite_tuning_profile_uses_wal_and_a_single_writer(monkeypatch):
+    monkeypatch.setattr(settings, "sqlite_tuning", True)
+    writer = engine_options("sqlite:///./file.db", writer=True)
+    assert (writer["pool_size"], writer["max_overflow"]) == (1, 0)
+    assert engine_options("sqlite:///./file.db")["pool_size"] == settings.db_pool_size
+    assert "pool_size" not in engine_options("sqlite://", writer=True)
+
+    with sync_engine.connect() as connection:
+        assert connection.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+        assert connection.exec_driver_sql("PRAGMA synchronous").scalar() == 1
+        assert connection.exec_driver_sql("PRAGMA temp_store").scalar() == 2
+
+
+async def wait_for_job(client, job_id: int, statuses=("completed", "failed")) -> dict:
+    for _ in range(200):
+        job = (await client.get(f"/jobs/{job_id}")).json()
+        if job["status"] in statuses and job_id not in ingestion._active_jobs:
+            return job
+        await asyncio.sleep(0.05)
+    raise AssertionError(f"Job {job_id} did not finish")
+
+
+@pytest.mark.asyncio
+async def test_streaming_upload_ingests_body_and_tees_to_disk(tmp_path, client, monkeypatch):
+    csv_path = tmp_path / "sample.csv"
+    write_sample_csv(csv_path)
+    payload = csv_path.read_bytes()
+    monkeypatch.setattr(settings, "data_dir", tmp_path / "uploads")
+    monkeypatch.setattr(settings, "ingestion_chunk_size", 1)
+    monkeypatch.setattr(settings, "ingestion_stream_queue_size", 1)
+
+    async def body():
+        # Odd-sized pieces so rows straddle piece boundaries.
+        for start in range(0, len(payload), 37):
+            yield payload[start : start + 37]
+
+    response = await client.post(
+        "/ingest/stream", params={"filename": "sample.csv", "tee": "true"}, content=body()
+    )
+    assert response.status_code == 200
+    job = await wait_for_job(client, response.json()["job_id"])
+
+    assert job["status"] == "completed"
+    assert job["processed_rows"] == 3
+    assert job["processed_bytes"] == len(payload)
+    assert (settings.data_dir / response.json()["filename"]).read_bytes() == payload
+
+
+@pytest.mark.asyncio
+async def test_streaming_upload_reports_malformed_rows(client, monkeypatch):
+    monkeypatch.setattr(settings, "ingestion_stream_tee", False)
+    payload = (
+        b"region,origin_coord,destination_coord,datetime,datasource\n"
+        b"Prague,POINT (1 2),oops,2018-05-28 09:03:40,x\n"
+    )
+
+    response = await client.post("/ingest/stream", content=payload)
+    job = await wait_for_job(client, response.json()["job_id"])
+
+    assert response.json()["filename"] is None
+    assert job["status"] == "failed"
+    assert job["message"].startswith("Row 2")
+
+
+@pytest.mark.asyncio
+async def test_ingest_rejects_unsupported_formats(client):
+    upload = await client.post("/ingest", files={"file": ("trips.json", b"{}")})
+    stream = await client.post("/ingest/stream", params={"filename": "trips.parquet"}, content=b"PAR1")
+
+    assert upload.status_code == 400
+    assert ".csv.gz" in upload.json()["detail"]
+    assert stream.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_streaming_gzip_upload_is_decompressed_on_the_fly(tmp_path, client, monkeypatch):
+    csv_path = tmp_path / "sample.csv"
+    write_sample_csv(csv_path)
+    monkeypatch.setattr(settings, "ingestion_stream_tee", False)
+
+    response = await client.post(
+        "/ingest/stream", params={"filename": "sample.csv.gz"}, content=gzip.compress(csv_path.read_bytes())
+    )
+    job = await wait_for_job(client, response.json()["job_id"])
+
+    assert job["status"] == "completed"
+    assert job["processed_rows"] == 3
+
+
+@pytest.mark.asyncio
+async def test_resume_endpoint_rejects_missing_and_finished_jobs(tmp_path, client):
+    job_id = await ingest_sample(tmp_path)
+
+    missing = await client.post("/jobs/999/resume")
+    finished = await client.post(f"/jobs/{job_id}/resume")
+
+    assert missing.status_code == 404
+    assert finished.status_code == 409
+    assert "already completed" in finished.json()["detail"]
+
+
+@pytest.mark.asyncio
+async def test_resume_endpoint_restarts_failed_job(tmp_path, client):
+    csv_path = tmp_path / "sample.csv"
+    write_sample_csv(csv_path)
+    with get_sync_session() as session:
+        job = create_ingestion_job(session, filename=csv_path.name, source_path=str(csv_path))
+        job.status = "failed"
+        job_id = job.id
+
+    response = await client.post(f"/jobs/{job_id}/resume")
+    job = await wait_for_job(client, job_id, statuses=("completed",))
+
+    assert response.status_code == 200
+    assert job["status"] == "completed"
+    assert job["processed_rows"] == 3
+
+
+@pytest.mark.asyncio
+async def test_ingest_returns_429_with_retry_after_when_queue_is_full(tmp_path, client, monkeypatch):
+    monkeypatch.setattr(scheduler, "max_queued", 0)
+    csv_path = tmp_path / "sample.csv"
+    write_sample_csv(csv_path)
+
+    response = await client.post("/ingest", files={"file": ("sample.csv", csv_path.read_bytes())})
+
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == str(settings.ingestion_retry_after_seconds)
+
+
+@pytest.mark.asyncio
+async def test_upload_is_queued_and_cancel_endpoint(tmp_path, client, monkeypatch):
+    monkeypatch.setattr(settings, "data_dir", tmp_path)
+    csv_path = tmp_path / "sample.csv"
+    write_sample_csv(csv_path)
+
+    upload = await client.post("/ingest", params={"priority": 3}, files={"file": ("sample.csv", csv_path.read_bytes())})
+    job = await wait_for_job(client, upload.json()["job_id"])
+    stats = await client.get("/jobs/queue")
+    cancel_finished = await client.delete(f"/jobs/{job['id']}")
+    cancel_missing = await client.delete("/jobs/999")
+
+    assert job["status"] == "completed"
+    assert job["priority"] == 3
+    assert job["started_at"] >= job["queued_at"]
+    assert stats.status_code == 200
+    assert stats.json()["queue_depth"] == 0
+    assert cancel_finished.status_code == 409
+    assert cancel_missing.status_code == 404
@@ -0,0 +1,65 @@
+import io
+
+import numpy as np
+
+from app.parsing import parse_csv_block
+from benchmarks.generator import FIELDNAMES, generate_block, write_trips
+from benchmarks.results import Result, compare, load_results, write_results
+
+
+def test_generator_is_seeded_streaming_and_independent_of_workers():
+    single, parallel, reseeded = io.BytesIO(), io.BytesIO(), io.BytesIO()
+    write_trips(single, 2_500, seed=7, workers=1, block_rows=1_000)
+    write_trips(parallel, 2_500, seed=7, workers=2, block_rows=1_000)
+    write_trips(reseeded, 2_500, seed=8, workers=1, block_rows=1_000)
+
+    header, body = single.getvalue().split(b"\n", 1)
+    columns = parse_csv_block(body, FIELDNAMES, parser="python")
+
+    assert single.getvalue() == parallel.getvalue()
+    assert single.getvalue() != reseeded.getvalue()
+    assert header.decode() == ",".join(FIELDNAMES)
+    assert columns.row_count == 2_500
+    assert set(columns.regions) <= {"Prague", "Turin", "Hamburg", "Berlin", "Madrid"}
+
+
+def test_generator_route_share_repeats_routes():
+    def trips_with_a_twin(body: bytes) -> int:
+        columns = parse_csv_block(body, FIELDNAMES, parser="python")
+        points = np.stack(
+            [columns.origin_lat, columns.origin_lng, columns.destination_lat, columns.destination_lng], axis=1
+        )
+        # Route trips are jittered by tens of metres, so their endpoints stay within ~0.003 degrees.
+        close = (np.abs(points[:, None, :] - points[None, :, :]) < 0.003).all(axis=2)
+        return int((close.sum(axis=1) > 1).sum())
+
+    assert trips_with_a_twin(generate_block(seed=7, index=0, rows=2_000)) == 0
+    assert trips_with_a_twin(generate_block(seed=7, index=0, rows=2_000, route_share=0.5)) > 200
+
+
+def test_compare_flags_gated_results_past_the_tolerance(tmp_path):
+    path = tmp_path / "baseline.json"
+    write_results(
+        path,
+        [
+            Result("ingest.rows", 1000.0, "rows/s"),
+            Result("endpoint.p50_ms", 10.0, "ms", higher_is_better=False),
+            Result("endpoint.p99_ms", 20.0, "ms", higher_is_better=False, gated=False),
+            Result("micro.parse", 500.0, "rows/s"),
+        ],
+        {"seed": 42},
+    )
+    current = [
+        Result("ingest.rows", 700.0, "rows/s"),
+        Result("endpoint.p50_ms", 13.0, "ms", higher_is_better=False),
+        Result("endpoint.p99_ms", 60.0, "ms", higher_is_better=False, gated=False),
+        Result("micro.parse", 450.0, "rows/s"),
+        Result("micro.new", 1.0, "calls/s"),
+    ]
+
+    regressions = compare(current, load_results(path), tolerance=0.2)
+
+    assert [(regression.name, round(regression.change, 2)) for regression in regressions] == [
+        ("ingest.rows", 0.3),
+        ("endpoint.p50_ms", 0.3),
+    ]
@@ -0,0 +1,177 @@
+import asyncio
+
+import pytest
+
+import app.cache as cache
+from app.cache import LocalCacheBackend, ResultCache, bbox_prefixes, cache_key, scope_tags, touched_tags
+from app.clustering import encode_geohash
+
+
+def constant(value: bytes, calls: list):
+    async def compute() -> bytes:
+        calls.append(value)
+        return value
+
+    return compute
+
+
+@pytest.mark.asyncio
+async def test_entries_expire_and_least_recently_used_are_evicted(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    results = ResultCache(2, ttl_seconds=60)
+    calls = []
+    tags = scope_tags()
+
+    for key in ("a", "b", "a", "c", "a", "b"):
+        await results.get_or_compute("test", key, tags, constant(key.encode(), calls))
+    # "b" was least recently used when "c" arrived.
+    assert calls == [b"a", b"b", b"c", b"b"]
+    assert results.stats().evictions == 2
+    assert results.stats().bytes == 2
+
+    now[0] += 61
+    await results.get_or_compute("test", "a", tags, constant(b"a", calls))
+    assert calls[-1] == b"a"
+    assert results.stats().expirations == 1
+
+
+def test_cache_key_normalises_parameters():
+    assert cache_key("groups", {"limit": 10, "region": None, "lat": 1.00000001}) == cache_key(
+        "groups", {"lat": 1.0, "limit": 10}
+    )
+    assert cache_key("groups", {"limit": 10}) != cache_key("rollup", {"limit": 10})
+
+
+@pytest.mark.asyncio
+async def test_invalidation_drops_only_results_reading_touched_cells():
+    results = ResultCache(16, ttl_seconds=60)
+    cell = encode_geohash(50.0, 14.5, 4)
+    scopes = {
+        "everything": scope_tags(),
+        "prague": scope_tags(["Prague"]),
+        "prague_parent": scope_tags(["Prague"], [cell[:2]]),
+        "prague_other_cell": scope_tags(["Prague"], ["u2fm" if cell != "u2fm" else "u2fk"]),
+        "turin": scope_tags(["Turin"]),
+        "any_region_cell": scope_tags(None, [cell + "zz"]),
+    }
+    for key, tags in scopes.items():
+        await results.get_or_compute("test", key, tags, constant(b"{}", []))
+
+    results.invalidate(touched_tags({"Prague": {cell}}))
+
+    kept = []
+    for key, tags in scopes.items():
+        calls = []
+        await results.get_or_compute("test", key, tags, constant(b"{}", calls))
+        if not calls:
+            kept.append(key)
+    assert kept == ["prague_other_cell", "turin"]
+    assert results.stats().invalidations == 4
+
+
+@pytest.mark.asyncio
+async def test_concurrent_identical_requests_share_one_computation():
+    results = ResultCache(16, ttl_seconds=60)
+    calls = []
+
+    async def compute() -> bytes:
+        calls.append(None)
+        await asyncio.sleep(0.05)
+        return b"[]"
+
+    values = await asyncio.gather(*(results.get_or_compute("test", "key", scope_tags(), compute) for _ in range(5)))
+
+    assert values == [b"[]"] * 5
+    assert len(calls) == 1
+    stats = results.stats()
+    assert (stats.misses, stats.coalesced, stats.hits) == (1, 4, 0)
+    assert stats.hit_ratio == pytest.approx(0.8)
+
+
+@pytest.mark.asyncio
+async def test_cancelled_leader_hands_the_computation_to_a_waiter():
+    results = ResultCache(16, ttl_seconds=60)
+    calls = []
+
+    async def compute() -> bytes:
+        calls.append(None)
+        await asyncio.sleep(0.05)
+        return b"[]"
+
+    leader = asyncio.create_task(results.get_or_compute("test", "key", scope_tags(), compute))
+    await asyncio.sleep(0)
+    waiters = [asyncio.create_task(results.get_or_compute("test", "key", scope_tags(), compute)) for _ in range(3)]
+    await asyncio.sleep(0.01)
+    leader.cancel()
+
+    assert await asyncio.gather(*waiters) == [b"[]"] * 3
+    assert leader.cancelled()
+    assert len(calls) == 2
+    stats = results.stats()
+    assert (stats.misses, stats.coalesced, stats.entries) == (2, 2, 1)
+
+
+@pytest.mark.asyncio
+async def test_result_computed_across_an_invalidation_is_not_stored():
+    results = ResultCache(16, ttl_seconds=60)
+    tags = scope_tags(["Prague"])
+
+    async def compute() -> bytes:
+        results.invalidate(touched_tags({"Turin": {"u0j2"}}))
+        results.invalidate(touched_tags({"Prague": {"u2fk"}}))
+        return b"[]"
+
+    await results.get_or_compute("test", "key", tags, compute)
+    assert results.stats().entries == 0
+
+    async def unrelated() -> bytes:
+        results.invalidate(touched_tags({"Turin": {"u0j2"}}))
+        return b"[]"
+
+    await results.get_or_compute("test", "key", tags, unrelated)
+    assert results.stats().entries == 1
+
+
+@pytest.mark.asyncio
+async def test_failed_computations_are_not_cached():
+    results = ResultCache(16, ttl_seconds=60)
+
+    async def fail() -> bytes:
+        await asyncio.sleep(0.01)
+        raise RuntimeError("query failed")
+
+    outcomes = await asyncio.gather(
+        *(results.get_or_compute("test", "key", scope_tags(), fail) for _ in range(3)), return_exceptions=True
+    )
+
+    assert all(isinstance(outcome, RuntimeError) for outcome in outcomes)
+    assert results.stats().entries == 0
+
+
+@pytest.mark.asyncio
+async def test_local_backend_shares_results_and_invalidations_between_caches():
+    first = ResultCache(16, ttl_seconds=60, backend=LocalCacheBackend("test-shared"))
+    second = ResultCache(16, ttl_seconds=60, backend=LocalCacheBackend("test-shared"))
+    tags = scope_tags(["Prague"])
+    calls = []
+
+    await first.get_or_compute("test", "key", tags, constant(b"[1]", calls))
+    assert await second.get_or_compute("test", "key", tags, constant(b"[2]", calls)) == b"[1]"
+    assert calls == [b"[1]"]
+    assert second.stats().hits == 1
+
+    first.invalidate(touched_tags({"Prague": {"u2fk"}}))
+    assert second.stats().entries == 0
+    assert await second.get_or_compute("test", "key", tags, constant(b"[3]", calls)) == b"[3]"
+
+
+def test_bbox_prefixes_cover_the_box_and_coarsen_large_ones():
+    cells = bbox_prefixes(50.0, 14.3, 50.15, 14.55)
+    assert cells is not None and all(len(cell) == 4 for cell in cells)
+    for lat, lng in ((50.0, 14.3), (50.15, 14.55), (50.07, 14.42)):
+        assert encode_geohash(lat, lng, 4) in cells
+
+    assert all(len(cell) < 4 for cell in bbox_prefixes(40.0, 0.0, 55.0, 20.0))
+    assert len(bbox_prefixes(-90.0, -180.0, 90.0, 180.0)) == 32
+    assert bbox_prefixes(-90.0, -180.0, 90.0, 180.0, max_cells=16) is None
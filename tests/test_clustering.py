@@ -0,0 +1,143 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+from app.clustering import (
+    Anchor,
+    NeighborCellStrategy,
+    bbox_cell_ranges,
+    encode_geohash,
+    encode_geohash_batch,
+    from_epoch_seconds,
+    geohash_axis_bits,
+    geohash_cells,
+    get_clustering_strategy,
+    time_bucket,
+    time_bucket_batch,
+    to_epoch_seconds,
+)
+from app.crud import trip_group_keys
+
+
+def cell_edges(low: float, high: float, bits: int) -> np.ndarray:
+    cells = 1 << bits
+    step = max(1, cells // 64)
+    return low + np.arange(0, cells, step) * ((high - low) / cells)
+
+
+def sample_coordinates(precision: int, count: int = 2000):
+    rng = np.random.default_rng(precision)
+    bits = 5 * precision
+    # Points exactly on cell edges and on the extremes exercise the tie-breaking rules.
+    edge_lats = np.concatenate([cell_edges(-90.0, 90.0, bits // 2), [-90.0, 0.0, 90.0, 5e-324, -5e-324]])
+    edge_lngs = np.concatenate([cell_edges(-180.0, 180.0, (bits + 1) // 2), [-180.0, 0.0, 180.0, 5e-324, -5e-324]])
+    size = min(len(edge_lats), len(edge_lngs))
+    lats = np.concatenate(
+        [rng.uniform(-90.0, 90.0, count), edge_lats[:size], np.nextafter(edge_lats[:size], 100.0)]
+    )
+    lngs = np.concatenate(
+        [rng.uniform(-180.0, 180.0, count), edge_lngs[:size], np.nextafter(edge_lngs[:size], -200.0)]
+    )
+    return lats, lngs
+
+
+@pytest.mark.parametrize("precision", range(1, 13))
+def test_encode_geohash_batch_matches_scalar(precision):
+    lats, lngs = sample_coordinates(precision)
+
+    batch = encode_geohash_batch(lats, lngs, precision)
+
+    assert batch.tolist() == [encode_geohash(lat, lng, precision) for lat, lng in zip(lats, lngs)]
+
+
+@pytest.mark.parametrize("minutes", [15, 60, 90])
+def test_time_bucket_batch_matches_scalar(minutes):
+    start = datetime(2018, 5, 28, 0, 0, 0)
+    moments = [start + timedelta(seconds=offset) for offset in range(0, 3 * 86400, 797)]
+
+    buckets = from_epoch_seconds(time_bucket_batch(to_epoch_seconds(moments), minutes))
+
+    assert buckets.tolist() == [time_bucket(moment, minutes) for moment in moments]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_bbox_cell_ranges_cover_every_point_in_the_box(seed):
+    rng = np.random.default_rng(seed)
+    for _ in range(40):
+        min_lat, min_lng = rng.uniform(-85.0, 85.0), rng.uniform(-175.0, 175.0)
+        max_lat, max_lng = min_lat + rng.uniform(0.0, 2.0) ** 3, min_lng + rng.uniform(0.0, 2.0) ** 3
+        lats = np.concatenate([rng.uniform(min_lat, max_lat, 500), [min_lat, max_lat, min_lat, max_lat]])
+        lngs = np.concatenate([rng.uniform(min_lng, max_lng, 500), [min_lng, max_lng, max_lng, min_lng]])
+
+        ranges = bbox_cell_ranges(min_lat, min_lng, max_lat, max_lng, precision=8, max_ranges=16)
+
+        cells = geohash_cells(lats, lngs, 8)
+        covered = np.zeros(len(cells), dtype=bool)
+        for low, high in ranges:
+            covered |= (cells >= low) & (cells <= high)
+        assert covered.all()
+        assert len(ranges) <= 16
+        assert all(high < next_low for (_, high), (next_low, _) in zip(ranges, ranges[1:]))
+
+
+def edge_straddling_trips():
+    """Two trips 22m and five minutes apart across a geohash cell edge and an hourly bucket edge.
+
+    The third trip shares the second one's cell and bucket but starts 1km from the first.
+    """
+    height = 180.0 / (1 << geohash_axis_bits(5)[0])
+    edge = -90.0 + np.ceil((50.08 + 90.0) / height) * height
+    origin_lats = np.array([edge - 0.0001, edge + 0.0001, edge + 0.01])
+    origin_lngs = np.full(3, 14.43)
+    destination_lats = np.array([50.05, 50.0501, 50.05])
+    destination_lngs = np.full(3, 14.46)
+    started_at = to_epoch_seconds(
+        [datetime(2018, 5, 28, 9, 58), datetime(2018, 5, 28, 10, 3), datetime(2018, 5, 28, 10, 0)]
+    )
+    keys = trip_group_keys(["Prague"] * 3, origin_lats, origin_lngs, destination_lats, destination_lngs, started_at)
+    return keys, (origin_lats, origin_lngs, destination_lats, destination_lngs, started_at)
+
+
+def test_neighbor_strategy_groups_close_trips_across_cell_and_bucket_edges():
+    keys, columns = edge_straddling_trips()
+    loaded = []
+
+    def load(cells):
+        loaded.extend(cells)
+        return []
+
+    exact, exact_founded = get_clustering_strategy("exact").assign(keys, *columns, load)
+    assigned, founded = NeighborCellStrategy(distance_m=150, time_tolerance_minutes=10).assign(keys, *columns, load)
+
+    assert exact == keys and exact_founded == {}
+    assert len({keys[0], keys[1]}) == 2 and keys[1] == keys[2]
+    assert assigned == [keys[0], keys[0], keys[2]]
+    assert list(founded) == [keys[0], keys[2]]
+    assert founded[keys[0]].origin_lat == columns[0][0]
+    # Trips near an edge also probe the neighbouring cell and bucket, so four cells are loaded, not 27 per trip.
+    assert len(loaded) == 4
+
+
+def test_neighbor_strategy_reuses_stored_groups():
+    keys, columns = edge_straddling_trips()
+    anchor = Anchor(columns[0][0], columns[1][0], columns[2][0], columns[3][0], int(columns[4][0]))
+    later_trips = [column[1:] for column in columns]
+
+    def loader(stored):
+        return lambda cells: [(key, value) for key, value in stored.items() if (key[0], key[1], key[3]) in cells]
+
+    strategy = NeighborCellStrategy(distance_m=150, time_tolerance_minutes=10)
+    assigned, founded = strategy.assign(keys[1:], *later_trips, loader({keys[0]: anchor}))
+    # An existing group of the trip's own cell and bucket wins, even without an anchor.
+    strategy = NeighborCellStrategy(distance_m=150, time_tolerance_minutes=10)
+    second_trip = [column[:1] for column in later_trips]
+    exact_first, _ = strategy.assign(keys[1:2], *second_trip, loader({keys[0]: anchor, keys[1]: None}))
+
+    assert assigned == [keys[0], keys[2]]
+    assert list(founded) == [keys[2]]
+    assert exact_first == [keys[1]]
+    with pytest.raises(ValueError):
+        NeighborCellStrategy(distance_m=10_000)
+    with pytest.raises(ValueError):
+        get_clustering_strategy("dbscan")
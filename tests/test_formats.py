@@ -0,0 +1,179 @@
+import gzip
+
+import pytest
+from sqlalchemy import func, select
+
+from app import config
+from app.crud import create_ingestion_job
+from app.db import get_sync_session, sync_engine
+from app.formats import decompress_pieces, detect_format
+from app.ingestion import ingest_file
+from app.models import Base, IngestionJob, Trip, TripGroup
+
+from .test_ingestion import write_sample_csv
+
+
+@pytest.fixture(autouse=True)
+def clean_database():
+    Base.metadata.drop_all(bind=sync_engine)
+    Base.metadata.create_all(bind=sync_engine)
+    yield
+    Base.metadata.drop_all(bind=sync_engine)
+
+
+def sample_bytes(tmp_path, copies: int = 1) -> bytes:
+    csv_path = tmp_path / "source.csv"
+    write_sample_csv(csv_path)
+    lines = csv_path.read_bytes().splitlines(keepends=True)
+    return b"".join(lines[:1] + lines[1:] * copies)
+
+
+async def ingest(path):
+    with get_sync_session() as session:
+        job_id = create_ingestion_job(session, filename=path.name).id
+    await ingest_file(job_id, path)
+    with get_sync_session() as session:
+        job = session.get(IngestionJob, job_id)
+        trips = session.execute(
+            select(Trip.region, Trip.origin_lat, Trip.destination_lng, Trip.started_at, Trip.datasource).order_by(
+                Trip.id
+            )
+        ).all()
+        group_count = session.execute(select(func.count(TripGroup.id))).scalar_one()
+    return job, trips, group_count
+
+
+def test_detect_format_by_suffix():
+    assert detect_format("trips.csv") == "csv"
+    assert detect_format("Trips.CSV.GZ") == "csv.gz"
+    assert detect_format("trips.csv.zst") == "csv.zst"
+    assert detect_format("trips.parquet") == "parquet"
+    assert detect_format("trips.json") is None
+
+
+def test_decompress_pieces_handles_split_and_concatenated_gzip_members():
+    payload = gzip.compress(b"first\n") + gzip.compress(b"second\n")
+    pieces = [payload[index : index + 7] for index in range(0, len(payload), 7)]
+
+    assert b"".join(decompress_pieces(pieces, "csv.gz")) == b"first\nsecond\n"
+
+
+@pytest.mark.asyncio
+async def test_gzip_csv_matches_plain_csv(tmp_path, monkeypatch):
+    monkeypatch.setattr(config.settings, "ingestion_chunk_size", 2)
+    payload = sample_bytes(tmp_path, copies=3)
+    plain = tmp_path / "trips.csv"
+    plain.write_bytes(payload)
+    compressed = tmp_path / "trips.csv.gz"
+    compressed.write_bytes(gzip.compress(payload))
+
+    expected = await ingest(plain)
+    Base.metadata.drop_all(bind=sync_engine)
+    Base.metadata.create_all(bind=sync_engine)
+    job, trips, group_count = await ingest(compressed)
+
+    assert job.status == "completed"
+    assert (trips, group_count) == expected[1:]
+    assert job.total_bytes == job.processed_bytes == len(payload)
+
+
+@pytest.mark.asyncio
+async def test_zstd_csv_is_decompressed_as_a_stream(tmp_path):
+    zstandard = pytest.importorskip("zstandard")
+    payload = sample_bytes(tmp_path)
+    path = tmp_path / "trips.csv.zst"
+    path.write_bytes(zstandard.ZstdCompressor().compress(payload))
+
+    job, trips, _ = await ingest(path)
+
+    assert job.status == "completed"
+    assert len(trips) == 3
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("workers", [1, 2])
+async def test_parquet_row_groups_are_ingested_in_order(tmp_path, monkeypatch, workers):
+    pa = pytest.importorskip("pyarrow")
+    pq = pytest.importorskip("pyarrow.parquet")
+    import pyarrow.csv as pa_csv
+
+    monkeypatch.setattr(config.settings, "ingestion_chunk_size", 2)
+    monkeypatch.setattr(config.settings, "ingestion_workers", workers)
+    payload = sample_bytes(tmp_path, copies=3)
+    plain = tmp_path / "trips.csv"
+    plain.write_bytes(payload)
+    table = pa_csv.read_csv(plain, convert_options=pa_csv.ConvertOptions(column_types={"datetime": pa.string()}))
+    parquet_path = tmp_path / "trips.parquet"
+    pq.write_table(table, parquet_path, row_group_size=4)
+
+    expected = await ingest(plain)
+    Base.metadata.drop_all(bind=sync_engine)
+    Base.metadata.create_all(bind=sync_engine)
+    job, trips, group_count = await ingest(parquet_path)
+
+    assert pq.ParquetFile(parquet_path).metadata.num_row_groups == 3
+    assert job.status == "completed"
+    assert job.total_rows == 9
+    assert (trips, group_count) == expected[1:]
+
+
+@pytest.mark.asyncio
+async def test_parquet_timestamp_column_and_malformed_rows(tmp_path):
+    pa = pytest.importorskip("pyarrow")
+    pq = pytest.importorskip("pyarrow.parquet")
+    from datetime import datetime
+
+    table = pa.table(
+        {
+            "region": ["Prague", "Prague"],
+            "origin_coord": ["POINT (14.49 50.00)", "POINT (14.32 50.00)"],
+            "destination_coord": ["POINT (14.43 50.04)", "oops"],
+            "datetime": [datetime(2018, 5, 28, 9, 3, 40), datetime(2018, 5, 13, 8, 52, 25)],
+            "datasource": ["funny_car", "cheap_mobile"],
+        }
+    )
+    path = tmp_path / "trips.parquet"
+    pq.write_table(table, path)
+
+    with get_sync_session() as session:
+        job_id = create_ingestion_job(session, filename=path.name).id
+    with pytest.raises(Exception, match="Row 2"):
+        await ingest_file(job_id, path)
+
+    pq.write_table(table.slice(0, 1), path)
+    job, trips, _ = await ingest(path)
+    assert job.status == "completed"
+    assert trips[0].started_at == datetime(2018, 5, 28, 9, 3, 40)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("suffix", ["csv.gz", "parquet"])
+async def test_compressed_and_parquet_jobs_resume_without_duplicates(tmp_path, monkeypatch, suffix):
+    from .test_ingestion import interrupt_after_chunks, resume_orphaned_jobs, wait_for_completion
+
+    monkeypatch.setattr(config.settings, "ingestion_chunk_size", 2)
+    payload = sample_bytes(tmp_path, copies=3)
+    path = tmp_path / f"trips.{suffix}"
+    if suffix == "csv.gz":
+        path.write_bytes(gzip.compress(payload))
+    else:
+        pa = pytest.importorskip("pyarrow")
+        pq = pytest.importorskip("pyarrow.parquet")
+        import pyarrow.csv as pa_csv
+
+        plain = tmp_path / "trips.csv"
+        plain.write_bytes(payload)
+        options = pa_csv.ConvertOptions(column_types={"datetime": pa.string()})
+        pq.write_table(pa_csv.read_csv(plain, convert_options=options), path, row_group_size=3)
+
+    job_id = await interrupt_after_chunks(path, monkeypatch, chunks=2)
+    with get_sync_session() as session:
+        session.get(IngestionJob, job_id).status = "running"
+
+    await resume_orphaned_jobs()
+    job = await wait_for_completion(job_id)
+
+    with get_sync_session() as session:
+        trip_count = session.execute(select(func.count(Trip.id))).scalar_one()
+    assert job.status == "completed"
+    assert job.processed_rows == trip_count == 9
@@ -1,8 +1,11 @@
+import asyncio
 import os
+import time
+from datetime import datetime
 from pathlib import Path
 
 import pytest
-from sqlalchemy import select, func
+from sqlalchemy import func, inspect, select
 
 # Configure environment before importing application modules
 os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite:///./test_tripdata.db")
@@ -16,9 +19,24 @@ config.get_settings.cache_clear()
 settings = get_settings()
 
 from app.db import get_sync_session, sync_engine  # noqa: E402
-from app.ingestion import ingest_file  # noqa: E402
-from app.models import Base, IngestionJob, Trip, TripGroup  # noqa: E402
-from app.crud import create_ingestion_job, compute_weekly_average  # noqa: E402
+from app.ingestion import (  # noqa: E402
+    IngestionError,
+    _active_jobs,
+    _pipeline,
+    _shard_ranges,
+    ingest_file,
+    resume_orphaned_jobs,
+)
+from app.loaders import get_loader  # noqa: E402
+from app.models import Base, IngestionChunk, IngestionJob, Trip, TripGroup  # noqa: E402
+from app.crud import (  # noqa: E402
+    TripGroupCache,
+    compute_weekly_average,
+    create_ingestion_job,
+    record_ingestion_chunk,
+    resolve_trip_groups,
+    update_ingestion_job,
+)
 
 
 @pytest.fixture(autouse=True)
@@ -58,6 +76,9 @@ async def test_ingestion_creates_trips(tmp_path):
     assert group_count >= 1
     assert job.status == "completed"
     assert job.processed_rows == 3
+    assert job.total_rows == 3
+    assert job.processed_bytes == job.total_bytes == csv_path.stat().st_size
+    assert job.group_cache_misses == group_count
 
 
 @pytest.mark.asyncio
@@ -77,3 +98,417 @@ async def test_weekly_average_by_region(tmp_path):
     assert total == 3
     assert weeks >= 1
     assert average > 0
+
+
+def test_resolve_trip_groups_bulk_creates_and_caches():
+    bucket = datetime(2018, 5, 28, 9)
+    keys = [
+        ("Prague", "u2fkb", "u2fkc", bucket),
+        ("Prague", "u2fkb", "u2fkc", bucket),
+        ("Turin", "u0j2q", "u0j2r", bucket),
+    ]
+    cache = TripGroupCache(maxsize=10)
+
+    with get_sync_session() as session:
+        first = resolve_trip_groups(session, keys, cache)
+    with get_sync_session() as session:
+        second = resolve_trip_groups(session, keys, cache)
+        group_count = session.execute(select(func.count(TripGroup.id))).scalar_one()
+
+    assert first == second
+    assert len(first) == 2
+    assert group_count == 2
+    assert cache.misses == 2
+    assert cache.hits == 2
+
+
+def test_resolve_trip_groups_finds_existing_groups_without_cache():
+    bucket = datetime(2018, 5, 28, 9)
+    key = ("Prague", "u2fkb", "u2fkc", bucket)
+
+    with get_sync_session() as session:
+        created = resolve_trip_groups(session, [key])
+    with get_sync_session() as session:
+        found = resolve_trip_groups(session, [key], TripGroupCache(maxsize=1))
+
+    assert created == found
+
+
+def test_trip_group_cache_evicts_least_recently_used():
+    bucket = datetime(2018, 5, 28, 9)
+    cache = TripGroupCache(maxsize=2)
+    cache.put(("a", "x", "y", bucket), 1)
+    cache.put(("b", "x", "y", bucket), 2)
+    assert cache.get(("a", "x", "y", bucket)) == 1
+    cache.put(("c", "x", "y", bucket), 3)
+
+    assert cache.get(("b", "x", "y", bucket)) is None
+    assert cache.get(("a", "x", "y", bucket)) == 1
+    assert len(cache) == 2
+
+
+def test_get_loader_falls_back_to_core_outside_postgresql():
+    assert get_loader("sqlite", "copy_binary").name == "core"
+    assert get_loader("sqlite", "auto").name == "core"
+    assert get_loader("postgresql", "auto").name == "copy_csv"
+    assert get_loader("sqlite", "orm").name == "orm"
+
+
+@pytest.mark.parametrize("loader_name", ["orm", "core"])
+def test_loaders_write_identical_trips(loader_name):
+    bucket = datetime(2018, 5, 28, 9)
+    with get_sync_session() as session:
+        group_id = resolve_trip_groups(session, [("Prague", "u2fkb", "u2fkc", bucket)])[
+            ("Prague", "u2fkb", "u2fkc", bucket)
+        ]
+        get_loader("sqlite", loader_name).load(
+            session,
+            [("Prague", 50.0, 14.4, 50.1, 14.5, datetime(2018, 5, 28, 9, 3, 40), "funny_car", group_id, 12345)],
+        )
+    with get_sync_session() as session:
+        trip = session.execute(select(Trip)).scalar_one()
+
+    assert (trip.region, trip.origin_lat, trip.destination_lng, trip.datasource) == ("Prague", 50.0, 14.5, "funny_car")
+    assert trip.started_at == datetime(2018, 5, 28, 9, 3, 40)
+    assert trip.group_id == group_id
+    assert trip.origin_cell == 12345
+
+
+def test_shard_ranges_align_to_line_boundaries(tmp_path):
+    csv_path = tmp_path / "sample.csv"
+    write_sample_csv(csv_path)
+
+    fieldnames, ranges = _shard_ranges(csv_path, shard_bytes=10)
+
+    data = csv_path.read_bytes()
+    assert fieldnames == ["region", "origin_coord", "destination_coord", "datetime", "datasource"]
+    assert len(ranges) == 3
+    assert ranges[0][0] == data.index(b"\n") + 1
+    assert ranges[-1][1] == len(data)
+    for (_, end), (start, _) in zip(ranges, ranges[1:]):
+        assert end == start
+        assert data[end - 1 : end] == b"\n"
+
+
+@pytest.mark.asyncio
+async def test_parallel_ingestion_matches_sequential(tmp_path, monkeypatch):
+    csv_path = tmp_path / "sample.csv"
+    write_sample_csv(csv_path)
+    # Duplicate the rows so several shards resolve the same trip groups.
+    lines = csv_path.read_text().splitlines(keepends=True)
+    csv_path.write_text("".join(lines[:1] + lines[1:] * 4))
+
+    monkeypatch.setattr(config.settings, "ingestion_workers", 2)
+    monkeypatch.setattr(config.settings, "ingestion_shard_bytes", 64)
+    monkeypatch.setattr(config.settings, "ingestion_chunk_size", 2)
+
+    with get_sync_session() as session:
+        job = create_ingestion_job(session, filename=csv_path.name)
+        job_id = job.id
+
+    await ingest_file(job_id, csv_path)
+
+    with get_sync_session() as session:
+        trip_count = session.execute(select(func.count(Trip.id))).scalar_one()
+        group_count = session.execute(select(func.count(TripGroup.id))).scalar_one()
+        job = session.get(IngestionJob, job_id)
+
+    assert trip_count == 12
+    assert group_count == 3
+    assert job.status == "completed"
+    assert job.processed_rows == 12
+
+
+@pytest.mark.asyncio
+async def test_ingestion_reads_file_once_and_estimates_total_rows(tmp_path, monkeypatch):
+    csv_path = tmp_path / "sample.csv"
+    write_sample_csv(csv_path)
+    monkeypatch.setattr(config.settings, "ingestion_chunk_size", 1)
+    opened = []
+    original_open = Path.open
+
+    def tracking_open(self, *args, **kwargs):
+        if self == csv_path:
+            opened.append(args)
+        return original_open(self, *args, **kwargs)
+
+    monkeypatch.setattr(Path, "open", tracking_open)
+    updates = []
+
+    def record_update(job_id, message):
+        updates.append(message)
+
+    monkeypatch.setattr("app.notifications.manager.send_update", record_update)
+    monkeypatch.setattr("app.notifications.progress.interval", 0.0)
+
+    with get_sync_session() as session:
+        job = create_ingestion_job(session, filename=csv_path.name)
+        job_id = job.id
+
+    await ingest_file(job_id, csv_path)
+
+    assert len(opened) == 1
+    running = [update for update in updates if update["status"] == "running" and update["processed_rows"]]
+    assert running[0]["total_rows"] >= 2
+    assert [update["processed_bytes"] for update in running] == sorted(update["processed_bytes"] for update in running)
+    assert updates[-1]["status"] == "completed"
+    assert updates[-1]["total_rows"] == 3
+
+
+@pytest.mark.asyncio
+async def test_staging_grouping_matches_cache_grouping(tmp_path, monkeypatch):
+    csv_path = tmp_path / "sample.csv"
+    write_sample_csv(csv_path)
+    lines = csv_path.read_text().splitlines(keepends=True)
+    csv_path.write_text("".join(lines[:1] + lines[1:] * 3))
+    monkeypatch.setattr(config.settings, "ingestion_chunk_size", 2)
+
+    results = {}
+    for mode in ("cache", "staging"):
+        Base.metadata.drop_all(bind=sync_engine)
+        Base.metadata.create_all(bind=sync_engine)
+        with get_sync_session() as session:
+            job_id = create_ingestion_job(session, filename=csv_path.name, grouping_mode=mode).id
+
+        await ingest_file(job_id, csv_path)
+
+        with get_sync_session() as session:
+            job = session.get(IngestionJob, job_id)
+            trips = session.execute(
+                select(
+                    Trip.region,
+                    Trip.origin_lat,
+                    Trip.started_at,
+                    Trip.datasource,
+                    TripGroup.origin_geohash,
+                    TripGroup.destination_geohash,
+                    TripGroup.time_bucket_start,
+                )
+                .join(TripGroup)
+                .order_by(Trip.started_at, Trip.id)
+            ).all()
+            group_count = session.execute(select(func.count(TripGroup.id))).scalar_one()
+            trip_counts = session.execute(select(TripGroup.trip_count)).scalars().all()
+        assert job.status == "completed"
+        assert job.grouping_mode == mode
+        assert trip_counts == [3, 3, 3]
+        results[mode] = (trips, group_count)
+
+    assert results["staging"] == results["cache"]
+    assert results["staging"][1] == 3
+    assert len(results["staging"][0]) == 9
+
+
+@pytest.mark.asyncio
+async def test_bulk_load_defers_trip_indexes_until_the_job_ends(tmp_path, monkeypatch):
+    csv_path = tmp_path / "sample.csv"
+    write_sample_csv(csv_path)
+    monkeypatch.setattr(config.settings, "ingestion_chunk_size", 1)
+    monkeypatch.setattr(config.settings, "ingestion_bulk_load", True)
+    import app.ingestion as ingestion
+
+    persist = ingestion._persist_chunk
+    indexes_while_loading = []
+
+    def record_indexes(session, *args, **kwargs):
+        indexes_while_loading.append(len(inspect(session.connection()).get_indexes("trips")))
+        persist(session, *args, **kwargs)
+
+    monkeypatch.setattr(ingestion, "_persist_chunk", record_indexes)
+    with get_sync_session() as session:
+        job_id = create_ingestion_job(session, filename=csv_path.name).id
+
+    await ingest_file(job_id, csv_path)
+
+    with get_sync_session() as session:
+        assert session.get(IngestionJob, job_id).status == "completed"
+        assert session.execute(select(func.count(Trip.id))).scalar_one() == 3
+    assert indexes_while_loading == [0, 0, 0]
+    assert {index["name"] for index in inspect(sync_engine).get_indexes("trips")} == {
+        index.name for index in Trip.__table__.indexes
+    }
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("grouping_mode", ["cache", "staging"])
+async def test_neighbor_clustering_groups_trips_across_cell_edges_and_jobs(tmp_path, grouping_mode):
+    height = 180.0 / 4096
+    edge = -90.0 + (int((50.08 + 90.0) / height) + 1) * height
+    header = "region,origin_coord,destination_coord,datetime,datasource\n"
+    first, second = tmp_path / "first.csv", tmp_path / "second.csv"
+    # 22m and five minutes apart, across a geohash cell edge and an hourly bucket edge.
+    first.write_text(header + f"Prague,POINT (14.43 {edge - 0.0001}),POINT (14.46 50.05),2018-05-28 09:58:00,x\n")
+    second.write_text(header + f"Prague,POINT (14.43 {edge + 0.0001}),POINT (14.46 50.0501),2018-05-28 10:03:00,x\n")
+
+    for csv_path in (first, second):
+        with get_sync_session() as session:
+            job_id = create_ingestion_job(
+                session, filename=csv_path.name, grouping_mode=grouping_mode, clustering="neighbor"
+            ).id
+        await ingest_file(job_id, csv_path)
+
+    with get_sync_session() as session:
+        assert session.get(IngestionJob, job_id).clustering == "neighbor"
+        groups = session.execute(select(TripGroup)).scalars().all()
+        assert [(group.trip_count, group.anchor_started_at) for group in groups] == [(2, datetime(2018, 5, 28, 9, 58))]
+        assert groups[0].anchor_origin_lat == pytest.approx(edge - 0.0001)
+
+
+def test_pipeline_keeps_order_and_bounds_read_ahead():
+    produced = []
+
+    def source():
+        for index in range(100):
+            produced.append(index)
+            yield index
+
+    stream = _pipeline(source(), (lambda item: item * 2,), depth=2)
+    assert next(stream) == 0
+    time.sleep(0.3)
+    # Two queues of depth 2, plus one item held by each stage thread and the consumer.
+    assert len(produced) <= 2 * 2 + 3
+    assert list(stream) == [index * 2 for index in range(1, 100)]
+
+
+def test_pipeline_surfaces_stage_errors_in_order():
+    def fail_on_three(item):
+        if item == 3:
+            raise ValueError("bad item")
+        return item
+
+    stream = _pipeline(iter(range(10)), (fail_on_three,), depth=1)
+    assert [next(stream) for _ in range(3)] == [0, 1, 2]
+    with pytest.raises(ValueError, match="bad item"):
+        next(stream)
+
+
+@pytest.mark.asyncio
+async def test_pipelined_ingestion_records_stage_timings_and_ordered_progress(tmp_path, monkeypatch):
+    csv_path = tmp_path / "sample.csv"
+    write_sample_csv(csv_path)
+    lines = csv_path.read_text().splitlines(keepends=True)
+    csv_path.write_text("".join(lines[:1] + lines[1:] * 5))
+    monkeypatch.setattr(config.settings, "ingestion_chunk_size", 2)
+    monkeypatch.setattr(config.settings, "ingestion_queue_depth", 1)
+    updates = []
+
+    def record_update(job_id, message):
+        updates.append(message)
+
+    monkeypatch.setattr("app.notifications.manager.send_update", record_update)
+    monkeypatch.setattr("app.notifications.progress.interval", 0.0)
+
+    with get_sync_session() as session:
+        job_id = create_ingestion_job(session, filename=csv_path.name).id
+
+    await ingest_file(job_id, csv_path)
+
+    with get_sync_session() as session:
+        job = session.get(IngestionJob, job_id)
+        trip_count = session.execute(select(func.count(Trip.id))).scalar_one()
+    assert job.status == "completed"
+    assert trip_count == 15
+    assert job.read_seconds > 0 and job.parse_seconds > 0 and job.write_seconds > 0
+    processed = [update["processed_rows"] for update in updates if update["status"] == "running"]
+    assert processed == [0, 2, 4, 6, 8, 10, 12, 14, 15]
+    assert updates[-1]["status"] == "completed"
+    assert updates[-1]["write_seconds"] == pytest.approx(job.write_seconds)
+
+
+async def wait_for_completion(job_id: int) -> IngestionJob:
+    for _ in range(200):
+        with get_sync_session() as session:
+            job = session.get(IngestionJob, job_id)
+        if job.status in ("completed", "failed") and job_id not in _active_jobs:
+            return job
+        await asyncio.sleep(0.05)
+    raise AssertionError(f"Job {job_id} did not finish")
+
+
+async def interrupt_after_chunks(csv_path, monkeypatch, chunks: int) -> int:
+    """Run an ingestion job that dies after committing ``chunks`` chunks."""
+    import app.ingestion as ingestion
+
+    persist = ingestion._persist_chunk
+    calls = []
+
+    def failing_persist(*args, **kwargs):
+        if len(calls) == chunks:
+            raise RuntimeError("connection lost")
+        calls.append(1)
+        return persist(*args, **kwargs)
+
+    monkeypatch.setattr(ingestion, "_persist_chunk", failing_persist)
+    with get_sync_session() as session:
+        job_id = create_ingestion_job(session, filename=csv_path.name, source_path=str(csv_path)).id
+    with pytest.raises(IngestionError):
+        await ingest_file(job_id, csv_path)
+    monkeypatch.setattr(ingestion, "_persist_chunk", persist)
+    return job_id
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("workers", [1, 2])
+async def test_orphaned_job_resumes_from_checkpoint(tmp_path, monkeypatch, workers):
+    csv_path = tmp_path / "sample.csv"
+    write_sample_csv(csv_path)
+    lines = csv_path.read_text().splitlines(keepends=True)
+    csv_path.write_text("".join(lines[:1] + lines[1:] * 3))
+    monkeypatch.setattr(config.settings, "ingestion_chunk_size", 2)
+    monkeypatch.setattr(config.settings, "ingestion_workers", workers)
+    monkeypatch.setattr(config.settings, "ingestion_shard_bytes", 64)
+
+    job_id = await interrupt_after_chunks(csv_path, monkeypatch, chunks=2)
+    with get_sync_session() as session:
+        job = session.get(IngestionJob, job_id)
+        checkpoint_rows = job.processed_rows
+        assert job.status == "failed" and 0 < checkpoint_rows < 9
+        # Simulate a process that died mid-job instead of recording the failure.
+        update_ingestion_job(session, job_id, status="running")
+
+    assert await resume_orphaned_jobs() == [job_id]
+    job = await wait_for_completion(job_id)
+
+    with get_sync_session() as session:
+        started = session.execute(select(Trip.started_at).order_by(Trip.started_at)).scalars().all()
+        ledger = session.execute(select(func.count()).select_from(IngestionChunk)).scalar_one()
+    assert job.status == "completed"
+    assert job.processed_rows == 9
+    assert job.message == f"Resumed from row {checkpoint_rows}"
+    assert len(started) == 9 and len(set(started)) == 3
+    assert ledger == 0
+
+
+@pytest.mark.asyncio
+async def test_replayed_chunks_are_not_inserted_twice(tmp_path, monkeypatch):
+    csv_path = tmp_path / "sample.csv"
+    write_sample_csv(csv_path)
+    monkeypatch.setattr(config.settings, "ingestion_chunk_size", 2)
+
+    job_id = await interrupt_after_chunks(csv_path, monkeypatch, chunks=1)
+    with get_sync_session() as session:
+        # Lose the checkpoint so the first chunk is read and offered again.
+        job = session.get(IngestionJob, job_id)
+        job.processed_rows = 0
+        job.processed_bytes = 0
+        chunk = session.execute(select(IngestionChunk)).scalar_one()
+        assert not record_ingestion_chunk(session, job_id, chunk.start_offset, chunk.end_offset, chunk.row_count)
+
+    await ingest_file(job_id, csv_path)
+
+    with get_sync_session() as session:
+        trip_count = session.execute(select(func.count(Trip.id))).scalar_one()
+    assert trip_count == 3
+
+
+@pytest.mark.asyncio
+async def test_unresumable_orphans_are_marked_failed(tmp_path):
+    with get_sync_session() as session:
+        job_id = create_ingestion_job(session, filename="gone.csv", source_path=str(tmp_path / "gone.csv")).id
+
+    assert await resume_orphaned_jobs() == []
+
+    with get_sync_session() as session:
+        job = session.get(IngestionJob, job_id)
+    assert job.status == "failed"
+    assert "no longer on disk" in job.message
@@ -0,0 +1,73 @@
+import csv
+import io
+import struct
+from datetime import datetime
+
+import pytest
+
+from app.loaders import TRIP_COLUMNS, TripLoader, encode_copy_binary, encode_copy_csv
+
+STARTED_AT = datetime(2018, 5, 28, 9, 3, 40, 5)
+ROW = ("Prague", 50.00136875782316, 14.4973794438195, -0.1, 1e-300, STARTED_AT, "cheap", 7, 2**40)
+
+
+def read_binary_rows(data: bytes):
+    """Decode ``COPY ... (FORMAT binary)`` input into rows of raw field bytes (``None`` for NULL)."""
+    header = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+    assert data.startswith(header) and data.endswith(struct.pack(">h", -1))
+    offset, rows = len(header), []
+    while True:
+        (count,) = struct.unpack_from(">h", data, offset)
+        offset += 2
+        if count == -1:
+            assert offset == len(data)
+            return rows
+        fields = []
+        for _ in range(count):
+            (length,) = struct.unpack_from(">i", data, offset)
+            offset += 4
+            fields.append(None if length == -1 else data[offset : offset + length])
+            offset += max(length, 0)
+        rows.append(dict(zip(TRIP_COLUMNS, fields)))
+
+
+def test_binary_copy_encodes_floats_timestamps_strings_and_nulls():
+    rows = read_binary_rows(encode_copy_binary([ROW, ("Ústí", *ROW[1:6], 'say "hi",\n\\', 8, 0)]))
+
+    first = rows[0]
+    assert first["region"] == b"Prague"
+    coordinates = ("origin_lat", "origin_lng", "destination_lat", "destination_lng")
+    assert [struct.unpack(">d", first[name])[0] for name in coordinates] == list(ROW[1:5])
+    # Microseconds since 2000-01-01.
+    assert struct.unpack(">q", first["started_at"])[0] == 580_813_420_000_005
+    assert struct.unpack(">i", first["group_id"])[0] == 7
+    assert struct.unpack(">q", first["origin_cell"])[0] == 2**40
+    assert rows[1]["region"] == "Ústí".encode("utf-8")
+    assert rows[1]["datasource"] == b'say "hi",\n\\'
+
+    with_nulls = (ROW[0], None, *ROW[2:5], None, "", 7, None)
+    expected = {**first, "origin_lat": None, "started_at": None, "datasource": b"", "origin_cell": None}
+    assert read_binary_rows(encode_copy_binary([with_nulls])) == [expected]
+
+
+def test_csv_copy_quotes_strings_so_only_nulls_are_bare_empty_fields():
+    escaped = ("Prague", *ROW[1:6], 'say "hi",\nagain', 7, 1)
+    encoded = encode_copy_csv([ROW, escaped, (ROW[0], None, *ROW[2:6], "", 7, 1)])
+    lines = encoded.split("\r\n")
+
+    assert lines[0] == (
+        '"Prague",50.00136875782316,14.4973794438195,-0.1,1e-300,"2018-05-28 09:03:40.000005","cheap",7,1099511627776'
+    )
+    assert lines[2] == '"Prague",,14.4973794438195,-0.1,1e-300,"2018-05-28 09:03:40.000005","",7,1'
+    # PostgreSQL's CSV COPY shares the quoting and escaping rules of the csv module's default dialect.
+    parsed = list(csv.reader(io.StringIO(encoded)))
+    assert parsed[1][6] == 'say "hi",\nagain'
+    assert [float(value) for value in parsed[0][1:5]] == list(ROW[1:5])
+
+
+def test_trip_loader_requires_load():
+    class Incomplete(TripLoader):
+        name = "incomplete"
+
+    with pytest.raises(TypeError, match="load"):
+        Incomplete()
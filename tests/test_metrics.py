@@ -0,0 +1,49 @@
+from app import config
+from app.metrics import Counter, Histogram, REGISTRY, collecting, stage
+
+
+def test_histogram_and_counter_render_prometheus_text(monkeypatch):
+    monkeypatch.setattr(config.settings, "metrics_enabled", True)
+    histogram = Histogram("test_seconds", "Test durations", ["stage"], buckets=(0.1, 1.0))
+    counter = Counter("test_rows_total", "Test rows")
+    try:
+        for value in (0.05, 0.5, 5.0):
+            histogram.observe(value, stage='say "hi"')
+        counter.inc(3)
+
+        lines = histogram.render() + counter.render()
+    finally:
+        REGISTRY.remove(histogram)
+        REGISTRY.remove(counter)
+
+    assert lines == [
+        "# HELP test_seconds Test durations",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{stage="say \\"hi\\"",le="0.1"} 1',
+        'test_seconds_bucket{stage="say \\"hi\\"",le="1"} 2',
+        'test_seconds_bucket{stage="say \\"hi\\"",le="+Inf"} 3',
+        'test_seconds_sum{stage="say \\"hi\\""} 5.55',
+        'test_seconds_count{stage="say \\"hi\\""} 3',
+        "# HELP test_rows_total Test rows",
+        "# TYPE test_rows_total counter",
+        "test_rows_total 3",
+    ]
+
+
+def test_stages_reach_the_active_collector_unless_disabled(monkeypatch):
+    class Collector:
+        def __init__(self):
+            self.stages = {}
+
+        def record(self, name, seconds):
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    collector = Collector()
+    with collecting(collector):
+        with stage("geohash"):
+            pass
+        monkeypatch.setattr(config.settings, "metrics_enabled", False)
+        with stage("insert"):
+            pass
+
+    assert list(collector.stages) == ["geohash"]
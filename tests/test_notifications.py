@@ -0,0 +1,90 @@
+import asyncio
+
+import pytest
+
+from app.notifications import InProcessBroker, LocalBroker, ProgressThrottle, WebSocketManager
+
+
+class FakeWebSocket:
+    def __init__(self, delay: float = 0.0) -> None:
+        self.delay = delay
+        self.sent = []
+
+    async def accept(self) -> None:
+        pass
+
+    async def send_json(self, message: dict) -> None:
+        await asyncio.sleep(self.delay)
+        self.sent.append(message)
+
+
+async def settle(seconds: float = 0.05) -> None:
+    await asyncio.sleep(seconds)
+
+
+@pytest.mark.asyncio
+async def test_throttle_coalesces_to_latest_state_and_flushes_terminal_updates():
+    broker = InProcessBroker()
+    published = []
+    broker.subscribe(lambda job_id, message: published.append(message))
+    throttle = ProgressThrottle(broker, max_per_second=10)
+
+    for rows in range(50):
+        throttle.offer(1, {"status": "running", "processed_rows": rows})
+    assert [message["processed_rows"] for message in published] == [0]
+
+    await settle(0.15)
+    assert [message["processed_rows"] for message in published] == [0, 49]
+
+    throttle.offer(1, {"status": "running", "processed_rows": 60})
+    throttle.offer(1, {"status": "completed", "processed_rows": 70})
+    assert published[-1] == {"status": "completed", "processed_rows": 70}
+    await settle(0.15)
+    assert published[-1]["status"] == "completed"
+
+
+@pytest.mark.asyncio
+async def test_slow_socket_does_not_stall_others_and_is_dropped_after_timeout():
+    manager = WebSocketManager(buffer_size=4, send_timeout=0.05)
+    fast, slow = FakeWebSocket(), FakeWebSocket(delay=1.0)
+    await manager.connect(1, fast)
+    await manager.connect(1, slow)
+
+    manager.send_update(1, {"status": "running", "processed_rows": 1})
+    await settle(0.02)
+    assert fast.sent == [{"status": "running", "processed_rows": 1}]
+
+    await settle(0.1)
+    assert manager.active_connections[1] == [fast]
+    assert slow.sent == []
+    manager.disconnect(1, fast)
+
+
+@pytest.mark.asyncio
+async def test_bounded_buffer_keeps_the_newest_updates():
+    manager = WebSocketManager(buffer_size=2, send_timeout=5)
+    websocket = FakeWebSocket(delay=0.05)
+    await manager.connect(1, websocket)
+    await settle(0)
+
+    for rows in range(10):
+        manager.send_update(1, {"processed_rows": rows})
+    await settle(0.3)
+
+    assert [message["processed_rows"] for message in websocket.sent] == [8, 9]
+    manager.disconnect(1, websocket)
+
+
+@pytest.mark.asyncio
+async def test_local_broker_relays_updates_to_every_replica():
+    replicas = [WebSocketManager(LocalBroker("test-replicas")) for _ in range(2)]
+    sockets = [FakeWebSocket() for _ in replicas]
+    for replica, websocket in zip(replicas, sockets):
+        await replica.connect(7, websocket)
+
+    LocalBroker("test-replicas").publish(7, {"status": "completed", "processed_rows": 3})
+    await settle()
+
+    assert [websocket.sent for websocket in sockets] == [[{"status": "completed", "processed_rows": 3}]] * 2
+    for replica, websocket in zip(replicas, sockets):
+        replica.disconnect(7, websocket)
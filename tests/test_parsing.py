@@ -0,0 +1,45 @@
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+from app.parsing import REQUIRED_COLUMNS, MalformedRowError, parse_csv_block
+
+ROWS = b"""Prague,POINT (14.4973794438195 50.00136875782316),POINT (14.43109483523328 50.04052930943246),2018-05-28 09:03:40,funny_car
+Turin,POINT (7.672837913286881 44.9957109242058),POINT (7.720368637535126 45.06782385393849),2018-05-21 02:54:04,baba_car
+Prague,POINT (14.32427345662177 50.00002074358429),POINT (14.47767895969969 50.09339790740321),2018-05-13 08:52:25,cheap_mobile
+"""
+
+
+@pytest.mark.parametrize("parser", ["pandas", "python"])
+def test_parse_csv_block_returns_typed_columns(parser):
+    columns = parse_csv_block(ROWS, REQUIRED_COLUMNS, first_row=2, parser=parser)
+
+    assert columns.row_count == 3
+    assert columns.region_values() == ["Prague", "Turin", "Prague"]
+    assert columns.region_codes.dtype == np.int32
+    assert columns.datasource_values() == ["funny_car", "baba_car", "cheap_mobile"]
+    assert columns.origin_lat.tolist() == [50.00136875782316, 44.9957109242058, 50.00002074358429]
+    assert columns.destination_lng.tolist() == [14.43109483523328, 7.720368637535126, 14.47767895969969]
+    assert columns.started_at_datetimes()[0] == datetime(2018, 5, 28, 9, 3, 40)
+
+
+@pytest.mark.parametrize("parser", ["pandas", "python"])
+@pytest.mark.parametrize(
+    "bad_row, message",
+    [
+        (b"Prague,LINESTRING (1 2),POINT (1 2),2018-05-28 09:03:40,funny_car\n", "Unsupported point format"),
+        (b"Prague,POINT (1 2 3),POINT (1 2),2018-05-28 09:03:40,funny_car\n", "too many values"),
+        (b"Prague,POINT (1 x),POINT (1 2),2018-05-28 09:03:40,funny_car\n", "could not convert"),
+        (b"Prague,POINT (1 2),POINT (1 2),yesterday,funny_car\n", "Invalid isoformat"),
+        (b"Prague,POINT (1 2),POINT (1 2)\n", "Missing value for datetime, datasource"),
+    ],
+)
+def test_parse_csv_block_reports_malformed_row_number(parser, bad_row, message):
+    with pytest.raises(MalformedRowError, match=rf"^Row 5: .*{message}"):
+        parse_csv_block(ROWS + bad_row, REQUIRED_COLUMNS, first_row=2, parser=parser)
+
+
+def test_parse_csv_block_requires_columns():
+    with pytest.raises(MalformedRowError, match="missing required columns: datasource"):
+        parse_csv_block(ROWS, REQUIRED_COLUMNS[:-1])
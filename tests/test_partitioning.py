@@ -0,0 +1,155 @@
+import asyncio
+import os
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+from sqlalchemy import func, inspect, select
+from sqlalchemy.dialects import postgresql
+
+os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite:///./test_tripdata.db")
+os.environ.setdefault("SYNC_DATABASE_URL", "sqlite:///./test_tripdata.db")
+os.environ.setdefault("ENVIRONMENT", "test")
+
+from app import config, partitioning  # noqa: E402
+from app.cache import analytics_cache, cell_precision, scope_tags  # noqa: E402
+from app.clustering import encode_geohash  # noqa: E402
+from app.crud import compute_weekly_average, create_ingestion_job  # noqa: E402
+from app.db import get_sync_session, sync_engine  # noqa: E402
+from app.ingestion import ingest_file  # noqa: E402
+from app.models import Base, Trip, TripGroup, TripGroupRollup, TripPartition  # noqa: E402
+from app.partitioning import (  # noqa: E402
+    detach_partitions,
+    native_partition_ddl,
+    partition_mode,
+    partitioned_trips_ddl,
+    trip_source,
+)
+
+
+def drop_shards() -> None:
+    with sync_engine.begin() as connection:
+        for name in inspect(connection).get_table_names():
+            if name.startswith("trips_"):
+                connection.exec_driver_sql(f"DROP TABLE {name}")
+    partitioning._known.clear()
+    partitioning.shard_metadata.clear()
+
+
+@pytest.fixture(autouse=True)
+def sharded_database(monkeypatch):
+    monkeypatch.setattr(config.settings, "trip_partitioning", "sharded")
+    Base.metadata.drop_all(bind=sync_engine)
+    drop_shards()
+    Base.metadata.create_all(bind=sync_engine)
+    yield
+    Base.metadata.drop_all(bind=sync_engine)
+    drop_shards()
+
+
+def write_sample_csv(path: Path) -> None:
+    path.write_text(
+        """region,origin_coord,destination_coord,datetime,datasource
+Prague,POINT (14.4973794438195 50.00136875782316),POINT (14.43109483523328 50.04052930943246),2018-05-28 09:03:40,funny_car
+Prague,POINT (14.32427345662177 50.00002074358429),POINT (14.47767895969969 50.09339790740321),2018-05-13 08:52:25,cheap_mobile
+Prague,POINT (14.34394689715277 50.12299688052901),POINT (14.45046952210687 50.10077692162883),2018-05-20 02:31:22,cheap_mobile
+"""
+    )
+
+
+async def ingest_sample(tmp_path: Path, grouping_mode: str = "cache") -> None:
+    csv_path = tmp_path / "sample.csv"
+    write_sample_csv(csv_path)
+    with get_sync_session() as session:
+        job_id = create_ingestion_job(session, filename=csv_path.name, grouping_mode=grouping_mode).id
+    await ingest_file(job_id, csv_path)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("grouping_mode", ["cache", "staging"])
+async def test_sharded_ingestion_routes_trips_by_region_and_week(tmp_path, grouping_mode):
+    await ingest_sample(tmp_path, grouping_mode)
+
+    with get_sync_session() as session:
+        weeks = session.execute(select(TripPartition.week_start).order_by(TripPartition.week_start)).scalars().all()
+        parent_rows = session.execute(select(func.count(Trip.id))).scalar_one()
+        prague = trip_source(session, region="Prague")
+        assert session.execute(select(func.count()).select_from(prague)).scalar_one() == 3
+        assert trip_source(session, region="Turin") is Trip.__table__
+        pruned = trip_source(session, region="Prague", started_from=datetime(2018, 5, 27))
+        assert session.execute(select(func.count()).select_from(pruned)).scalar_one() == 1
+        assert compute_weekly_average(session, region="Prague") == (1.0, 3, 3)
+        bbox = (49.9, 14.3, 50.2, 14.6)
+        assert compute_weekly_average(session, region="Prague", bbox=bbox) == (1.0, 3, 3)
+
+    assert weeks == [datetime(2018, 5, 7), datetime(2018, 5, 14), datetime(2018, 5, 28)]
+    assert parent_rows == 0
+
+
+@pytest.mark.asyncio
+async def test_detach_partitions_drops_old_weeks_with_their_aggregates(tmp_path, monkeypatch):
+    monkeypatch.setattr(config.settings, "group_rollup_precisions", [3, 4, 5])
+    await ingest_sample(tmp_path)
+
+    with get_sync_session() as session:
+        detached = detach_partitions(session, datetime(2018, 5, 21), drop=True)
+
+    with get_sync_session() as session:
+        remaining = session.execute(select(TripPartition.week_start)).scalars().all()
+        counted = session.execute(select(func.sum(TripGroup.trip_count))).scalar_one()
+        level = (TripGroupRollup.geohash_precision, TripGroupRollup.bucket_minutes)
+        rolled_up = session.execute(select(*level, func.sum(TripGroupRollup.trip_count)).group_by(*level)).all()
+        assert compute_weekly_average(session, region="Prague") == (1.0, 1, 1)
+        assert compute_weekly_average(session, region="Prague", bbox=(49.9, 14.3, 50.2, 14.6)) == (1.0, 1, 1)
+
+    assert len(detached) == 2
+    assert not set(detached) & set(inspect(sync_engine).get_table_names())
+    assert remaining == [datetime(2018, 5, 28)]
+    assert counted == 1
+    assert len(rolled_up) == 9
+    assert all(count == 1 for _, _, count in rolled_up)
+
+
+@pytest.mark.asyncio
+async def test_detach_partitions_subtracts_trips_of_groups_spanning_weeks_and_invalidates_the_cache(tmp_path):
+    csv_path = tmp_path / "neighbors.csv"
+    # Five minutes apart across the week edge, so both trips join the group founded on Sunday.
+    csv_path.write_text(
+        """region,origin_coord,destination_coord,datetime,datasource
+Prague,POINT (14.43 50.08),POINT (14.46 50.05),2018-05-27 23:58:00,x
+Prague,POINT (14.43 50.0801),POINT (14.46 50.0501),2018-05-28 00:03:00,x
+"""
+    )
+    with get_sync_session() as session:
+        job_id = create_ingestion_job(session, filename=csv_path.name, clustering="neighbor").id
+    await ingest_file(job_id, csv_path)
+    analytics_cache.invalidate(None)
+    cell = encode_geohash(50.08, 14.43, cell_precision())
+    for key, tags in {"prague": scope_tags(["Prague"], [cell]), "turin": scope_tags(["Turin"])}.items():
+        await analytics_cache.get_or_compute("test", key, tags, lambda: asyncio.sleep(0, result=b"[]"))
+
+    with get_sync_session() as session:
+        assert session.execute(select(TripGroup.trip_count)).scalars().all() == [2]
+        detach_partitions(session, datetime(2018, 5, 28), drop=True)
+        assert analytics_cache.stats().entries == 2
+
+    with get_sync_session() as session:
+        assert session.execute(select(TripGroup.trip_count)).scalars().all() == [1]
+    assert analytics_cache.stats().entries == 1
+    assert analytics_cache._lookup("turin") == b"[]"
+
+
+def test_native_partition_ddl_targets_postgresql(monkeypatch):
+    dialect = postgresql.dialect()
+    parent, *indexes = partitioned_trips_ddl(dialect)
+    assert "PARTITION BY LIST (region)" in parent
+    assert "PRIMARY KEY (id, region, started_at)" in parent
+    assert all(statement.startswith("CREATE INDEX IF NOT EXISTS") for statement in indexes)
+
+    region, week = native_partition_ddl(dialect, "O'Hare", datetime(2018, 5, 28))
+    assert "FOR VALUES IN ('O''Hare') PARTITION BY RANGE (started_at)" in region
+    assert "FOR VALUES FROM ('2018-05-28 00:00:00') TO ('2018-06-04 00:00:00')" in week
+
+    monkeypatch.setattr(config.settings, "trip_partitioning", "native")
+    with pytest.raises(ValueError):
+        partition_mode("sqlite")
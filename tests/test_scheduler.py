@@ -0,0 +1,194 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+import pytest
+from sqlalchemy import func, select
+
+import app.ingestion as ingestion
+from app import config
+from app.db import get_sync_session, sync_engine
+from app.ingestion import IngestionScheduler, JobNotResumableError, QueueFullError
+from app.models import Base, IngestionJob, Trip
+
+from .test_ingestion import write_sample_csv
+
+
+@pytest.fixture(autouse=True)
+def clean_database():
+    Base.metadata.drop_all(bind=sync_engine)
+    Base.metadata.create_all(bind=sync_engine)
+    yield
+    Base.metadata.drop_all(bind=sync_engine)
+
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    scheduler = IngestionScheduler(workers=1, max_queued=3)
+    monkeypatch.setattr(ingestion, "scheduler", scheduler)
+    return scheduler
+
+
+def sample_file(tmp_path, name: str):
+    path = tmp_path / name
+    write_sample_csv(path)
+    return path
+
+
+@asynccontextmanager
+async def busy_worker(scheduler):
+    """Hold the only worker slot so submitted jobs stay queued until the block exits."""
+    await scheduler.acquire_slot()
+    try:
+        yield
+    finally:
+        scheduler.release_slot()
+
+
+async def wait_until_idle(job_ids):
+    for _ in range(200):
+        with get_sync_session() as session:
+            statuses = [session.get(IngestionJob, job_id).status for job_id in job_ids]
+        finished = all(status in ("completed", "failed", "cancelled") for status in statuses)
+        # Also wait for the worker tasks so none outlive the test's event loop.
+        if finished and not ingestion._active_jobs:
+            return statuses
+        await asyncio.sleep(0.05)
+    raise AssertionError(f"Jobs did not finish: {statuses}")
+
+
+@pytest.mark.asyncio
+async def test_scheduler_runs_jobs_one_at_a_time_by_priority(tmp_path, monkeypatch, scheduler):
+    started = []
+    running = []
+    peak = []
+    real_ingest = ingestion.ingest_file
+
+    async def tracking_ingest(job_id, path):
+        started.append(job_id)
+        running.append(job_id)
+        peak.append(len(running))
+        try:
+            await real_ingest(job_id, path)
+        finally:
+            running.remove(job_id)
+
+    monkeypatch.setattr(ingestion, "ingest_file", tracking_ingest)
+
+    async with busy_worker(scheduler):
+        low = await ingestion.schedule_ingestion(sample_file(tmp_path, "low.csv"))
+        high = await ingestion.schedule_ingestion(sample_file(tmp_path, "high.csv"), priority=5)
+        middle = await ingestion.schedule_ingestion(sample_file(tmp_path, "middle.csv"), priority=1)
+
+    assert await wait_until_idle([low, high, middle]) == ["completed"] * 3
+    assert started == [high, middle, low]
+    assert max(peak) == 1
+    stats = await scheduler.stats()
+    assert stats["queue_depth"] == 0
+    assert stats["average_wait_seconds"] > 0
+
+
+@pytest.mark.asyncio
+async def test_job_queued_while_an_empty_claim_runs_is_dispatched(tmp_path, monkeypatch, scheduler):
+    claim = ingestion._claim_next_job
+    claims = []
+
+    def slow_claim():
+        claimed = claim()
+        claims.append(claimed)
+        if len(claims) == 1:
+            # The job below commits after this claim's query found the queue empty.
+            time.sleep(0.3)
+        return claimed
+
+    monkeypatch.setattr(ingestion, "_claim_next_job", slow_claim)
+    scheduler.start()
+    await asyncio.sleep(0.1)
+    job_id = await scheduler.submit(sample_file(tmp_path, "sample.csv"))
+
+    assert await wait_until_idle([job_id]) == ["completed"]
+    assert claims[0] is None
+
+
+@pytest.mark.asyncio
+async def test_full_queue_rejects_new_jobs(tmp_path, scheduler):
+    async with busy_worker(scheduler):
+        job_ids = [await scheduler.submit(sample_file(tmp_path, f"{index}.csv")) for index in range(3)]
+
+        assert (await scheduler.stats())["queue_depth"] == 3
+        with pytest.raises(QueueFullError) as excinfo:
+            await scheduler.submit(sample_file(tmp_path, "overflow.csv"))
+    assert excinfo.value.retry_after == config.settings.ingestion_retry_after_seconds
+    await wait_until_idle(job_ids)
+
+
+@pytest.mark.asyncio
+async def test_cancel_queued_job_never_runs(tmp_path, scheduler):
+    async with busy_worker(scheduler):
+        job_id = await scheduler.submit(sample_file(tmp_path, "sample.csv"))
+        assert await scheduler.cancel(job_id) == "cancelled"
+    await asyncio.sleep(0.1)
+
+    with get_sync_session() as session:
+        assert session.get(IngestionJob, job_id).status == "cancelled"
+        assert session.execute(select(func.count(Trip.id))).scalar_one() == 0
+    with pytest.raises(JobNotResumableError):
+        await scheduler.cancel(job_id)
+
+
+@pytest.mark.asyncio
+async def test_cancel_running_job_stops_after_current_chunk(tmp_path, monkeypatch, scheduler):
+    monkeypatch.setattr(config.settings, "ingestion_chunk_size", 1)
+    persist = ingestion._persist_chunk
+    loop = asyncio.get_running_loop()
+    job_ids = []
+
+    def persist_then_cancel(*args, **kwargs):
+        persist(*args, **kwargs)
+        assert asyncio.run_coroutine_threadsafe(scheduler.cancel(job_ids[0]), loop).result() == "cancelling"
+
+    monkeypatch.setattr(ingestion, "_persist_chunk", persist_then_cancel)
+    job_ids.append(await scheduler.submit(sample_file(tmp_path, "sample.csv")))
+
+    assert await wait_until_idle(job_ids) == ["cancelled"]
+    with get_sync_session() as session:
+        job = session.get(IngestionJob, job_ids[0])
+        assert job.processed_rows == 1
+        assert session.execute(select(func.count(Trip.id))).scalar_one() == 1
+
+
+@pytest.mark.asyncio
+async def test_queue_bookkeeping_does_not_wait_for_the_writer_connection(tmp_path, scheduler):
+    # A running chunk holds the writer engine's only SQLite connection until it commits.
+    with sync_engine.connect():
+        job_id = await scheduler.submit(sample_file(tmp_path, "sample.csv"))
+        assert (await scheduler.stats())["queue_depth"] in (0, 1)
+        assert await scheduler.cancel(job_id) in ("cancelled", "cancelling")
+    await wait_until_idle([job_id])
+
+
+@pytest.mark.asyncio
+async def test_queue_queries_run_off_the_event_loop(monkeypatch, scheduler):
+    count = ingestion.count_queued_ingestion_jobs
+
+    def slow_count(session):
+        time.sleep(0.3)
+        return count(session)
+
+    monkeypatch.setattr(ingestion, "count_queued_ingestion_jobs", slow_count)
+    ticks = 0
+
+    async def tick():
+        nonlocal ticks
+        while True:
+            await asyncio.sleep(0.01)
+            ticks += 1
+
+    ticker = asyncio.create_task(tick())
+    try:
+        await scheduler.check_capacity()
+        assert (await scheduler.stats())["queue_depth"] == 0
+    finally:
+        ticker.cancel()
+    # The loop kept running other coroutines while both queries slept.
+    assert ticks >= 20